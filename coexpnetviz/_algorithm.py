@@ -15,52 +15,507 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from time import perf_counter
 import logging
+import os
 
-from varbio import pearson_df, join_lines
+from scipy.special import stdtr, stdtrit
+from threadpoolctl import threadpool_limits
+from varbio import ExpressionMatrix, pearson_df, join_lines
+import attr
 import numpy as np
 import pandas as pd
 
+from coexpnetviz import _kernels
+from coexpnetviz._index import CoexpressionIndex, digest
+from coexpnetviz._similarity import (
+    spearman_df, bicor_df, pairwise_pearson_df, row_transforms, is_sparse,
+    sparse_rows, centred_norms, sparse_pearson_df,
+)
 from coexpnetviz._various import (
-    Network, ExpressionMatrixInfo, distinct_colours, RGB
+    Network, ExpressionMatrixInfo, CorrelationSample, distinct_colours, RGB
 )
 
 
+# Size in bytes of the input rows plus output correlations of a tile, small
+# enough for a tile to stay in the L2/L3 cache of current CPUs while it is
+# being correlated
+_tile_bytes = 2**21
+
+# Number of tiles of _correlate_tiled per shard of
+# _correlate_matrices_sharded, a shard is about 128MB of input and output
+_shard_tiles = 64
+
+# Number of principal axes in the sketch of screening, see
+# _screened_similarity
+_sketch_size = 128
+
+# Max number of genes in the sample of _estimate_confident_cutoffs. Its
+# correlations and its bootstrap take time and memory quadratic in it.
+_max_sample_size = 3200
+
+# Size in bytes of the weights of a batch of resamples of _bootstrap_cutoffs,
+# about 25 resamples of a sample of 800 genes. Larger samples have fewer
+# resamples per batch, but then the per batch overhead does not matter.
+_bootstrap_bytes = 2**26
+
 # In hindsight it would have made sense to either map genes to nodes, with node
 # ids, up front; or to do away with node ids entirely and always use the gene
 # name. Probably the latter is a good option, assuming they are unique.
 
-def create_network(baits, expression_matrices, gene_families, percentiles=(5, 95)):
-    cors, matrix_infos = _correlate_matrices(
-        expression_matrices, baits, percentiles
+def create_network(baits, expression_matrices, gene_families, percentiles=(5, 95),
+                   correlation_method='pearson', keep_sample_matrix=False,
+                   threads=None, max_homology_clique_size=None,
+                   max_cor_edges=None, max_non_bait_nodes=None, fdr=None,
+                   screening_recall=None, top_k=None, index_dir=None,
+                   executor=None, progress=None, preview=None,
+                   cutoff_confidence=None):
+    '''
+    Create a CoExpNetViz network
+
+    `threads` is the number of threads to correlate with, defaulting to the
+    number of CPUs. Families with more than `max_homology_clique_size` baits
+    are returned as a clique instead of as homology edges between all their
+    baits.
+
+    When `max_cor_edges` or `max_non_bait_nodes` is given, `percentiles` is
+    ignored and the cutoffs are instead chosen to get the largest network
+    within those limits, see _solve_cutoffs.
+
+    When `fdr` is given, correlations are instead significant when their
+    q-value is at most `fdr`, see _fdr_cors. This skips the sample and its
+    percentiles entirely.
+
+    When `screening_recall` is given, only pairs which a cheap estimate
+    screens as candidates are correlated exactly, with at least that expected
+    recall of the significant pairs, see _screened_similarity. The
+    correlation matrices then have NaN for the other pairs, so screening
+    only works with percentiles.
+
+    When `top_k` is given, the `top_k` genes with the strongest pearson
+    correlation to each bait are significant instead, found with a
+    CoexpressionIndex of each matrix. When `index_dir` is given, indices are
+    loaded from there when they are up to date and saved there otherwise.
+    The other significance options are ignored and the correlation method
+    must be pearson.
+
+    When an `executor` is given, each matrix is split in shards of rows which
+    are correlated on the executor. This can be any
+    `concurrent.futures.Executor`, e.g. a ProcessPoolExecutor or the
+    executor of a cluster of multiple hosts such as mpi4py's
+    MPIPoolExecutor. The results are the same as without an executor, but
+    the matrix infos have no correlation matrix. So it only works with
+    percentiles and without screening, see _correlate_matrices_sharded.
+
+    When a `preview` is given, only a subset of the columns and genes of each
+    matrix is correlated, see _preview_matrix. The network is approximate and
+    has the preview as attribute.
+
+    When a `cutoff_confidence` is given, confidence intervals of the
+    percentile cutoffs are estimated too, see _estimate_confident_cutoffs.
+    So it only works with percentiles.
+
+    With the pairwise_complete_pearson `correlation_method`, missing values
+    only leave out the pairs of values they are part of, see
+    pairwise_pearson_df. With the other methods, a missing value makes all
+    correlations of its row NaN.
+
+    When `progress` is given, it is called with a dict per event:
+
+    - ``{'type': 'progress', 'stage': stage, 'seconds': seconds}`` after each
+      stage, where stage is correlate, nodes, homology_edges or cor_edges.
+      The correlate stage is reported per matrix and has an
+      ``expression_matrix`` name.
+    - ``{'type': 'matrix', 'expression_matrix': name, 'network': network}``
+      after correlating each matrix, with the Network of just that matrix.
+      Genes of a family may span multiple matrices, so the nodes of the
+      final network are not the union of those of the matrices. Only
+      reported when the significant correlations of each matrix are known
+      before all matrices are correlated; so not with `fdr` or a max
+      network size.
+    '''
+    if top_k is not None and correlation_method != 'pearson':
+        raise ValueError('top_k only works with the pearson correlation method')
+    if fdr is not None:
+        if not 0 < fdr < 1:
+            raise ValueError(f'fdr must be in (0, 1), got: {fdr}')
+        if max_cor_edges is not None or max_non_bait_nodes is not None:
+            raise ValueError('Cannot combine fdr with a max network size')
+        percentiles = None
+    if screening_recall is not None and (
+        percentiles is None or max_cor_edges is not None
+        or max_non_bait_nodes is not None
+    ):
+        raise ValueError('Screening only works with percentiles')
+    if executor is not None and (
+        percentiles is None or max_cor_edges is not None
+        or max_non_bait_nodes is not None or screening_recall is not None
+    ):
+        raise ValueError('Sharding only works with percentiles, without screening')
+    if cutoff_confidence is not None and (
+        percentiles is None or max_cor_edges is not None
+        or max_non_bait_nodes is not None or top_k is not None
+    ):
+        raise ValueError('Cutoff confidence intervals only work with percentiles')
+    if threads is None:
+        threads = os.cpu_count() or 1
+    if preview is not None:
+        expression_matrices = (
+            _preview_matrix(matrix, baits, preview) for matrix in expression_matrices
+        )
+
+    def on_matrix(cors, info, seconds):
+        'Report a matrix, its cors are None when they are not final yet'
+        if progress is None:
+            return
+        name = info.matrix.name
+        progress({
+            'type': 'progress', 'stage': 'correlate', 'expression_matrix': name,
+            'seconds': seconds,
+        })
+        if cors is not None:
+            network = _create_network(
+                baits, cors, gene_families, max_homology_clique_size, (info,)
+            )
+            progress({'type': 'matrix', 'expression_matrix': name, 'network': network})
+
+    if top_k is not None:
+        cors, matrix_infos = _query_matrices(
+            expression_matrices, baits, top_k, index_dir, on_matrix
+        )
+    else:
+        cors, matrix_infos = _correlate_matrices(
+            expression_matrices, baits, percentiles,
+            correlation_method=correlation_method,
+            keep_sample_matrix=keep_sample_matrix, threads=threads,
+            max_cor_edges=max_cor_edges, max_non_bait_nodes=max_non_bait_nodes,
+            fdr=fdr, screening_recall=screening_recall, executor=executor,
+            on_matrix=on_matrix, cutoff_confidence=cutoff_confidence,
+        )
+    network = _create_network(
+        baits, cors, gene_families, max_homology_clique_size, matrix_infos,
+        progress
     )
-    nodes = _create_nodes(baits, cors, gene_families)
-    homology_edges = _create_homology_edges(nodes)
-    cor_edges = _create_cor_edges(nodes, cors)
+    return attr.evolve(network, preview=preview)
+
+def _preview_matrix(matrix, baits, preview):
+    '''
+    Get the subset of a matrix to correlate in a preview
+
+    Selects the columns first and then the genes with the largest standard
+    deviation over those columns, always keeping the baits. Rows without
+    variance are dropped later on, as usual, by _correlate_matrix.
+    '''
+    data = matrix.data
+    if preview.max_columns is not None and preview.max_columns < data.shape[1]:
+        if preview.column_selection == 'random':
+            random = np.random.RandomState(seed=0)  # be deterministic
+            columns = random.choice(data.shape[1], preview.max_columns, replace=False)
+        else:
+            deviations = _column_deviations(data)
+            columns = np.argsort(-deviations, kind='stable')[:preview.max_columns]
+        data = data.iloc[:, np.sort(columns)]
+
+    is_bait = data.index.isin(baits)
+    if preview.max_genes is not None and preview.max_genes < (~is_bait).sum():
+        stds = _row_stds(data)
+        stds[is_bait] = np.inf
+        stds = np.nan_to_num(stds, nan=-np.inf)
+        rows = np.argsort(-stds, kind='stable')[:is_bait.sum() + preview.max_genes]
+        data = _take_rows(data, np.sort(rows))
+
+    logging.info(join_lines(
+        f'''
+        Previewing {matrix} on {data.shape[1]} of {matrix.data.shape[1]} columns
+        and {len(data)} of {len(matrix.data)} genes
+        '''
+    ))
+    return ExpressionMatrix(matrix.name, data)
+
+def _create_network(baits, cors, gene_families, max_homology_clique_size,
+                    matrix_infos, progress=None):
+    '''
+    Create Network of the significant correlations
+
+    Reports the time of each stage to `progress`, see create_network.
+    '''
+    def timed(stage, function, *args):
+        start = perf_counter()
+        result = function(*args)
+        if progress is not None:
+            progress({
+                'type': 'progress', 'stage': stage,
+                'seconds': perf_counter() - start,
+            })
+        return result
+
+    nodes, node_genes = timed('nodes', _create_nodes, baits, cors, gene_families)
+    homology_edges, homology_cliques = timed(
+        'homology_edges', _create_homology_edges, nodes, max_homology_clique_size
+    )
+    cor_edges = timed('cor_edges', _create_cor_edges, node_genes, cors)
 
     return Network(
         significant_cors=cors,
         nodes=nodes,
+        node_genes=node_genes,
         homology_edges=homology_edges,
+        homology_cliques=homology_cliques,
         cor_edges=cor_edges,
         matrix_infos=matrix_infos,
     )
 
-def _correlate_matrices(expression_matrices, baits, percentiles):
-    results = tuple(
-        _correlate_matrix(matrix, baits, percentiles)
-        for matrix in expression_matrices
-    )
+def _reported(results, on_matrix):
+    '''
+    Pass each (cors, info) of results to on_matrix, with the seconds it took
+    to get it
+    '''
+    start = perf_counter()
+    for cors, info in results:
+        on_matrix(cors, info, perf_counter() - start)
+        yield cors, info
+        start = perf_counter()
 
-    cors = pd.concat([result[0] for result in results])
-    # Drop self comparisons and symmetrical ones. There are no duplicates
-    # because baits do not appear in multiple matrices.
-    cors = cors[cors['bait'] < cors['gene']]
+def _correlate_matrices(expression_matrices, baits, percentiles, correlation_method,
+                        keep_sample_matrix, threads, max_cor_edges, max_non_bait_nodes,
+                        fdr, screening_recall, executor, on_matrix,
+                        cutoff_confidence=None):
+    if executor is None:
+        results = (
+            _correlate_matrix(
+                matrix, baits, percentiles, correlation_method=correlation_method,
+                keep_sample_matrix=keep_sample_matrix, threads=threads,
+                screening_recall=screening_recall,
+                cutoff_confidence=cutoff_confidence,
+            )
+            for matrix in expression_matrices
+        )
+    else:
+        results = _correlate_matrices_sharded(
+            expression_matrices, baits, percentiles,
+            correlation_method=correlation_method,
+            keep_sample_matrix=keep_sample_matrix, executor=executor,
+            cutoff_confidence=cutoff_confidence,
+        )
 
+    # The cors of a matrix are final unless its cutoffs are replaced below
+    is_final = max_cor_edges is None and max_non_bait_nodes is None and fdr is None
+    results = tuple(_reported(
+        results,
+        lambda cors, info, seconds: on_matrix(
+            _drop_symmetric_cors(cors) if is_final else None, info, seconds
+        )
+    ))
+    cors = [result[0] for result in results]
     matrix_infos = tuple(result[1] for result in results)
+
+    # Replace the percentile cutoffs by cutoffs for the requested network size
+    if max_cor_edges is not None or max_non_bait_nodes is not None:
+        cutoffs = _solve_cutoffs(
+            matrix_infos, baits, max_cor_edges, max_non_bait_nodes
+        )
+        logging.info(f'cutoffs for network size: {cutoffs}')
+        matrix_infos = tuple(
+            attr.evolve(
+                info,
+                percentile_values=cutoffs,
+                percentiles=info.sample.percentile_ranks(cutoffs),
+                percentile_value_intervals=None,
+            )
+            for info in matrix_infos
+        )
+        cors = [_cut_cors(info.cor_matrix, cutoffs) for info in matrix_infos]
+    elif fdr is not None:
+        cors, matrix_infos = _fdr_cors(matrix_infos, baits, fdr)
+        cors = [cors]
+
+    cors = _drop_symmetric_cors(pd.concat(cors))
     return cors, matrix_infos
 
-def _correlate_matrix(matrix, baits, percentiles):
+def _drop_symmetric_cors(cors):
+    # Drop self comparisons and symmetrical ones. There are no duplicates
+    # because baits do not appear in multiple matrices.
+    return cors[cors['bait'] < cors['gene']]
+
+def _query_matrices(expression_matrices, baits, top_k, index_dir, on_matrix):
+    '''
+    Get the top k correlations of each bait in each matrix
+
+    The matrix infos have no sample or correlation matrix and NaN cutoffs,
+    as each bait has its own cutoff.
+    '''
+    def query(matrix):
+        index = _get_index(matrix, index_dir)
+        dropped = baits[baits.isin(matrix.data.index) & ~baits.isin(index.genes)]
+        if len(dropped):
+            logging.warning(join_lines(
+                f'''
+                Baits of {matrix} with NaN values or without variance get no
+                correlations: {', '.join(map(str, dropped))}
+                '''
+            ))
+        cors = index.query(baits, top_k)
+
+        # Count each pair of baits once, as in _distinct_pairs
+        cors = cors[~cors['gene'].isin(baits) | (cors['bait'] < cors['gene'])]
+        info = ExpressionMatrixInfo(
+            matrix, None, (np.nan, np.nan), None, (np.nan, np.nan)
+        )
+        return cors, info
+
+    results = tuple(_reported(map(query, expression_matrices), on_matrix))
+    cors = pd.concat([result[0] for result in results])
+    return cors, tuple(result[1] for result in results)
+
+def _get_index(matrix, index_dir):
+    '''
+    Get CoexpressionIndex of a matrix, cached in index_dir if not None
+
+    The digest of the matrix is part of the file name, so each selection of
+    columns of a matrix has its own cached index and an index is only used
+    for the data it was built from.
+    '''
+    if index_dir is None:
+        return CoexpressionIndex.from_matrix(matrix)
+    digest_ = digest(matrix)
+    path = index_dir / f'{matrix.name}.{digest_}.index.npz'
+    if path.exists():
+        index = CoexpressionIndex.load(path)
+        if index.digest == digest_:
+            return index
+        logging.info(f'Rebuilding corrupt index of {matrix}')
+    index = CoexpressionIndex.from_matrix(matrix)
+    index.save(path)
+    return index
+
+def _correlate_matrix(matrix, baits, percentiles, correlation_method,
+                      keep_sample_matrix, threads, screening_recall,
+                      cutoff_confidence=None):
+    matrix_df, sample, cutoffs, percentiles, intervals = _prepare_matrix(
+        matrix, percentiles, correlation_method=correlation_method,
+        keep_sample_matrix=keep_sample_matrix, cutoff_confidence=cutoff_confidence,
+    )
+
+    # Correlation matrix
+    present_baits = _present_baits(matrix_df, baits, correlation_method)
+    sparse = is_sparse(matrix_df)
+    similarity_df = _get_similarity_function(correlation_method, sparse)
+    tile_rows = None
+    if similarity_df is sparse_pearson_df:
+        # A single sparse matrix product, tiles would only add overhead
+        tile_rows = max(1, len(matrix_df))
+    if screening_recall is not None:
+        if sparse:
+            logging.info(
+                f'Correlating sparse {matrix} without screening, its sketch needs dense rows'
+            )
+        elif correlation_method not in row_transforms:
+            logging.info(join_lines(
+                f'''
+                Correlating {matrix} without screening, its sketch cannot
+                handle missing values
+                '''
+            ))
+        elif _screening_pays(matrix_df.shape[1], len(present_baits)):
+            similarity_df = _screened_similarity(
+                row_transforms[correlation_method], matrix_df, present_baits,
+                cutoffs, screening_recall
+            )
+        else:
+            logging.info(join_lines(
+                f'''
+                Correlating {matrix} without screening, its sketch would not
+                be cheaper than its correlations.
+                '''
+            ))
+
+    # Correlate each distinct profile once, then give each gene the
+    # correlations of its profile
+    unique_rows = None if sparse else _unique_rows(matrix_df.values)
+    if unique_rows is None:
+        cor_matrix = _correlate_tiled(
+            similarity_df, matrix_df, present_baits, threads, tile_rows
+        )
+    else:
+        first, inverse = unique_rows
+        logging.info(join_lines(
+            f'''
+            Collapsed the {len(matrix_df)} rows of {matrix} into {len(first)}
+            distinct profiles, a compression ratio of
+            {len(matrix_df) / len(first):.2f}
+            '''
+        ))
+        cor_matrix = _correlate_tiled(
+            similarity_df, matrix_df.iloc[first], present_baits, threads, tile_rows
+        )
+        cor_matrix = pd.DataFrame(
+            cor_matrix.values[inverse], index=matrix_df.index,
+            columns=cor_matrix.columns,
+        )
+    cors = _cut_cors(cor_matrix, cutoffs)
+
+    info = ExpressionMatrixInfo(
+        matrix, sample, cutoffs, cor_matrix, percentiles, intervals
+    )
+    return cors, info
+
+def _unique_rows(values):
+    '''
+    Find the rows which are identical to an earlier row
+
+    Rows are hashed by a product of their float bits with random odd
+    multipliers, which wraps around, so only the hashes are sorted rather
+    than the rows. Rows with the same hash are compared to make sure they
+    are the same, falling back to comparing all rows on a collision.
+
+    Returns
+    -------
+    (first, inverse) or None
+        Position of the first row of each distinct row and of the distinct
+        row of each row, such that ``values[first][inverse]`` equals
+        `values`. None when all rows are distinct.
+    '''
+    if len(values) < 2:
+        return None
+    bits = np.ascontiguousarray(values, dtype=float).view(np.uint64)
+    random = np.random.RandomState(seed=0)  # be deterministic
+    multipliers = random.randint(
+        0, np.iinfo(np.int64).max, size=bits.shape[1], dtype=np.int64
+    ).astype(np.uint64) | np.uint64(1)
+    hashes = bits @ multipliers
+    _, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    if len(first) == len(values):
+        return None
+    inverse = inverse.ravel()
+    representatives = first[inverse]
+    chunk_rows = _tile_rows(bits.shape[1], 0)
+    if any(
+        (bits[start:start+chunk_rows] != bits[representatives[start:start+chunk_rows]]).any()
+        for start in range(0, len(bits), chunk_rows)
+    ):
+        rows = bits.view([('', np.void, bits.shape[1] * 8)]).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        if len(first) == len(values):
+            return None
+    return first, inverse.ravel()
+
+def _prepare_matrix(matrix, percentiles, correlation_method, keep_sample_matrix,
+                    cutoff_confidence=None):
+    '''
+    Drop rows without variance and get the cutoffs of a matrix
+
+    Returns
+    -------
+    matrix_df : ~pandas.DataFrame
+        The rows of the matrix which can be correlated.
+    sample : CorrelationSample or None
+    cutoffs : tuple(float, float)
+    percentiles : tuple(float, float)
+    intervals : ~numpy.ndarray or None
+        Confidence interval of each cutoff, if cutoff_confidence.
+    '''
     matrix_df = matrix.data
 
     # Remove rows with no variance as correlation functions yield nan for it
@@ -68,10 +523,10 @@ def _correlate_matrix(matrix, baits, percentiles):
     # Note: we only drop the absolutely necessary so that the user can
     # choose how to clean the expression matrices instead of the algorithm
     # doing it for them
-    tiny_stds = matrix_df.std(axis=1) < np.finfo(float).tiny
+    tiny_stds = _row_stds(matrix_df) < np.finfo(float).tiny
     rows_dropped = sum(tiny_stds)
     if rows_dropped:
-        matrix_df = matrix_df[~tiny_stds]
+        matrix_df = _take_rows(matrix_df, np.flatnonzero(~tiny_stds))
         logging.warning(join_lines(
             f'''
             Dropped {rows_dropped} out of {len(matrix_df)+rows_dropped} rows
@@ -88,53 +543,494 @@ def _correlate_matrix(matrix, baits, percentiles):
                 '''
             ))
 
-    # Get cutoffs
-    sample, cutoffs = _estimate_cutoffs(matrix, percentiles)
-    cutoffs = tuple(cutoffs)
+    # Get cutoffs. Without percentiles, significance is determined later on
+    # and for now the NaN cutoffs cut all correlations.
+    intervals = None
+    if percentiles is None:
+        sample = None
+        cutoffs = percentiles = (np.nan, np.nan)
+    elif cutoff_confidence is None:
+        sample, cutoffs = _estimate_cutoffs(
+            matrix, percentiles, correlation_method, keep_sample_matrix
+        )
+    else:
+        sample, cutoffs, intervals = _estimate_confident_cutoffs(
+            matrix, percentiles, correlation_method=correlation_method,
+            keep_sample_matrix=keep_sample_matrix,
+            cutoff_confidence=cutoff_confidence,
+        )
+    return matrix_df, sample, tuple(cutoffs), tuple(percentiles), intervals
+
+def _take_rows(matrix_df, positions, dense=False):
+    '''
+    Get the rows of a matrix at positions
+
+    Row selections of sparse data frames are slow in pandas, so these go
+    through a sparse matrix instead. If dense, sparse rows are returned
+    dense.
+    '''
+    if not is_sparse(matrix_df):
+        return matrix_df.iloc[positions]
+    rows = sparse_rows(matrix_df)[positions]
+    index = matrix_df.index[positions]
+    if dense:
+        return pd.DataFrame(rows.toarray(), index=index, columns=matrix_df.columns)
+    return pd.DataFrame.sparse.from_spmatrix(rows, index=index, columns=matrix_df.columns)
+
+def _present_baits(matrix_df, baits, correlation_method):
+    '''
+    Get the rows of the baits in the matrix, as a dense data frame
+
+    Baits with missing values are dropped, unless the correlation method
+    handles them.
+    '''
+    how = 'all' if correlation_method == 'pairwise_complete_pearson' else 'any'
+    if not is_sparse(matrix_df):
+        return matrix_df.reindex(baits).dropna(how=how)
+    positions = matrix_df.index.get_indexer(baits)
+    return _take_rows(matrix_df, positions[positions >= 0], dense=True).dropna(how=how)
+
+def _row_stds(matrix_df):
+    'Get standard deviation of each row, without densifying sparse data'
+    if is_sparse(matrix_df):
+        column_count = matrix_df.shape[1]
+        if column_count < 2:
+            return np.full(len(matrix_df), np.nan)
+        return centred_norms(sparse_rows(matrix_df)) / np.sqrt(column_count - 1)
+    return _kernels.row_stds(matrix_df.values)
+
+def _column_deviations(matrix_df):
+    '''
+    Get the sum of squared deviations from the row means of each column
+
+    Sparse data is not densified: each implicit zero deviates by the mean of
+    its row, so a column sums the squared means of all rows and corrects
+    them for its stored values.
+    '''
+    if not is_sparse(matrix_df):
+        values = matrix_df.values
+        return ((values - values.mean(axis=1, keepdims=True))**2).sum(axis=0)
+    rows = sparse_rows(matrix_df)
+    row_count, column_count = rows.shape
+    means = np.bincount(rows.indices, rows.data, minlength=row_count) / column_count
+    stored_means = means[rows.indices]
+    corrections = (rows.data - stored_means)**2 - stored_means**2
+    columns = np.repeat(np.arange(column_count), np.diff(rows.indptr))
+    return (means**2).sum() + np.bincount(columns, corrections, minlength=column_count)
+
+def _correlate_matrices_sharded(expression_matrices, baits, percentiles,
+                                correlation_method, keep_sample_matrix, executor,
+                                cutoff_confidence=None):
+    '''
+    Like _correlate_matrix for each matrix, but correlate shards of rows on an executor
+
+    The coordinator estimates the cutoffs of each matrix once and sends them
+    to each shard along with the baits. Shards return the triples of their
+    significant correlations, which are merged in the order _cut_cors
+    returns them in. Shards are whole tiles of _correlate_tiled, so their
+    correlations are the same as those of an unsharded run.
+
+    Shards of all matrices are submitted before waiting for any of them,
+    then the (cors, info) of each matrix is yielded as its shards complete.
+    The matrix infos have no correlation matrix.
+    '''
+    pending = []
+    for matrix in expression_matrices:
+        matrix_df, sample, cutoffs, percentiles_, intervals = _prepare_matrix(
+            matrix, percentiles, correlation_method=correlation_method,
+            keep_sample_matrix=keep_sample_matrix,
+            cutoff_confidence=cutoff_confidence,
+        )
+        present_baits = _present_baits(matrix_df, baits, correlation_method)
+        tile_rows = _tile_rows(matrix_df.shape[1], len(present_baits))
+        shard_rows = tile_rows * _shard_tiles
+        starts = range(0, len(matrix_df), shard_rows)
+        futures = [
+            executor.submit(
+                _correlate_shard, correlation_method,
+                matrix_df.iloc[start:start+shard_rows], present_baits, cutoffs,
+                tile_rows,
+            )
+            for start in starts
+        ]
+        info = ExpressionMatrixInfo(
+            matrix, sample, cutoffs, None, percentiles_, intervals
+        )
+        pending.append((matrix_df.index, present_baits.index, starts, futures, info))
+
+    for genes, present_baits, starts, futures, info in pending:
+        rows, columns, correlations = zip(*(future.result() for future in futures))
+        rows = np.concatenate([
+            shard_rows + start for start, shard_rows in zip(starts, rows)
+        ])
+        columns = np.concatenate(columns)
+        correlations = np.concatenate(correlations)
+        order = np.lexsort((rows, columns))
+        cors = pd.DataFrame({
+            'gene': genes.values[rows[order]],
+            'bait': present_baits.values[columns[order]],
+            'correlation': correlations[order],
+        })
+        yield cors, info
+
+def _correlate_shard(correlation_method, shard_df, present_baits, cutoffs, tile_rows):
+    'Get the triples of the significant correlations of a shard, see _kernels.cut'
+    similarity_df = _get_similarity_function(correlation_method, is_sparse(shard_df))
+    cor_matrix = _correlate_tiled(similarity_df, shard_df, present_baits, 1, tile_rows)
+    return _kernels.cut(cor_matrix.values, *cutoffs)
+
+def _cut_cors(cor_matrix, cutoffs):
+    '''
+    Cutoff correlations and reformat to relational (DB) format
+
+    Returns
+    -------
+    ~pandas.DataFrame
+        Correlations at or beyond the cutoffs with columns gene, bait,
+        correlation.
+    '''
+    rows, columns, correlations = _kernels.cut(cor_matrix.values, *cutoffs)
+    return pd.DataFrame({
+        'gene': cor_matrix.index.values[rows],
+        'bait': cor_matrix.columns.values[columns],
+        'correlation': correlations,
+    })
+
+def _solve_cutoffs(matrix_infos, baits, max_cor_edges, max_non_bait_nodes):
+    '''
+    Get cutoffs for a network of a given size
+
+    Finds the smallest absolute correlation t for which at most
+    `max_cor_edges` bait-gene pairs and at most `max_non_bait_nodes` non-bait
+    genes correlate at least t (or at most -t) and returns ``(-t, t)``.
+    Correlation edges and non-bait nodes merge these pairs and genes by
+    family, so the network has at most as many of them. Either limit may be
+    None.
+
+    Partially sorts the absolute correlations of all matrices once per limit,
+    instead of trying percentiles until the network has the right size.
+    '''
+    cors = []
+    gene_cors = []
+    for info in matrix_infos:
+        cor_matrix = info.cor_matrix
+        abs_cors = np.abs(cor_matrix.values)
+        abs_cors[~_distinct_pairs(cor_matrix, baits)] = np.nan
+        cors.append(abs_cors.ravel())
+
+        non_bait_cors = abs_cors[~cor_matrix.index.isin(baits)]
+        if non_bait_cors.size:
+            non_bait_cors = np.where(np.isnan(non_bait_cors), -np.inf, non_bait_cors)
+            gene_cors.append(non_bait_cors.max(axis=1))
+
+    thresholds = [0.0]
+    if max_cor_edges is not None:
+        thresholds.append(_size_threshold(np.concatenate(cors), max_cor_edges))
+    if max_non_bait_nodes is not None and gene_cors:
+        thresholds.append(_size_threshold(np.concatenate(gene_cors), max_non_bait_nodes))
+    threshold = max(thresholds)
+    return (-threshold, threshold)
+
+def _distinct_pairs(cor_matrix, baits):
+    '''
+    Get mask of the correlations of distinct pairs in a correlation matrix
+
+    Like _correlate_matrices, counts each pair of baits once and ignores self
+    correlations.
+    '''
+    mask = np.ones(cor_matrix.shape, dtype=bool)
+    is_bait = cor_matrix.index.isin(baits)
+    mask[is_bait] = np.greater.outer(
+        cor_matrix.index.values[is_bait], cor_matrix.columns.values
+    )
+    return mask
+
+def _fdr_cors(matrix_infos, baits, fdr):
+    '''
+    Get correlations which are significant at a false discovery rate
+
+    Tests each distinct bait-gene pair for a correlation different from 0
+    with a Student t-test, which is exact for pearson and an approximation for
+    the other correlation methods. Benjamini-Hochberg then controls the FDR
+    across all matrices.
+
+    Only pairs with a p-value of at most `fdr` can be significant, which is
+    the case for a correlation of at least the `fdr` critical value. So
+    p-values are only calculated and sorted for those pairs, instead of
+    for all pairs.
+
+    Returns
+    -------
+    cors : ~pandas.DataFrame
+        Significant correlations with columns gene, bait, correlation,
+        q_value.
+    matrix_infos : tuple of ExpressionMatrixInfo
+        With the smallest significant absolute correlation of each matrix as
+        cutoffs.
+    '''
+    candidates = []
+    test_count = 0
+    for i, info in enumerate(matrix_infos):
+        cor_matrix = info.cor_matrix
+        values = cor_matrix.values
+
+        # The pairs of a matrix without p-values are not tested, so they do
+        # not count as tests either
+        degrees_of_freedom = info.matrix.data.shape[1] - 2
+        if degrees_of_freedom < 1:
+            logging.warning(
+                f'{info.matrix} has too few columns to calculate p-values'
+            )
+            continue
+        is_test = _distinct_pairs(cor_matrix, baits) & ~np.isnan(values)
+        test_count += is_test.sum()
+
+        # The p-value decreases as the absolute correlation increases. The
+        # critical value is rounded down a bit so rounding errors can't drop
+        # any candidates.
+        t = stdtrit(degrees_of_freedom, 1 - fdr / 2)
+        critical_value = 1 / np.sqrt(degrees_of_freedom / t**2 + 1) * (1 - 1e-9)
+        rows, columns = np.nonzero(is_test & (np.abs(values) >= critical_value))
+        correlations = values[rows, columns]
+        with np.errstate(divide='ignore'):
+            t = correlations * np.sqrt(degrees_of_freedom / (1 - correlations**2))
+        candidates.append(pd.DataFrame({
+            'gene': cor_matrix.index.values[rows],
+            'bait': cor_matrix.columns.values[columns],
+            'correlation': correlations,
+            'p_value': 2 * stdtr(degrees_of_freedom, -np.abs(t)),
+            'matrix': i,
+        }))
+
+    # The candidates have the smallest p-values of all tests, so their rank
+    # among the candidates is their rank among all tests. q-values > fdr may
+    # be underestimated as we do not know the larger p-values, but these are
+    # not significant either way.
+    cors = pd.concat(candidates, ignore_index=True) if candidates else pd.DataFrame(
+        columns=('gene', 'bait', 'correlation', 'p_value', 'matrix')
+    )
+    cors = cors.sort_values('p_value', kind='stable')
+    q_values = cors['p_value'].values * test_count / np.arange(1, len(cors) + 1)
+    q_values = np.minimum.accumulate(q_values[::-1])[::-1]
+    cors['q_value'] = np.minimum(q_values, 1)
+    cors = cors[cors['p_value'] <= fdr]
+    cors = cors[cors['q_value'] <= fdr]
+
+    matrix_infos = tuple(
+        attr.evolve(
+            info,
+            percentile_values=_fdr_cutoffs(cors[cors['matrix'] == i]['correlation']),
+        )
+        for i, info in enumerate(matrix_infos)
+    )
+    cors = cors[['gene', 'bait', 'correlation', 'q_value']]
+    return cors, matrix_infos
+
+def _fdr_cutoffs(correlations):
+    'Cutoffs equivalent to the significant correlations of a matrix'
+    if correlations.empty:
+        return (np.nan, np.nan)
+    cutoff = correlations.abs().min()
+    return (-cutoff, cutoff)
+
+def _size_threshold(values, max_count):
+    '''
+    Get the smallest threshold which at most `max_count` values reach
+
+    NaN values never reach it.
+    '''
+    values = values[~np.isnan(values)]
+    if len(values) <= max_count:
+        return 0.0
+
+    # Just above the (max_count+1)-th largest value, so that ties with it
+    # are excluded as well
+    index = len(values) - max_count - 1
+    largest_excluded = np.partition(values, index)[index]
+    return np.nextafter(largest_excluded, np.inf)
+
+def _correlate_tiled(similarity_df, matrix_df, present_baits, threads, tile_rows=None):
+    '''
+    Correlate all rows of a matrix to the baits, one tile of rows at a time
+
+    The tiles are correlated on a pool of `threads` threads while BLAS is
+    limited to a single thread; else each of our threads would start as many
+    BLAS threads as there are CPUs, oversubscribing the CPUs.
+    '''
+    if tile_rows is None:
+        tile_rows = _tile_rows(matrix_df.shape[1], len(present_baits))
+    tiles = [
+        matrix_df.iloc[start:start+tile_rows]
+        for start in range(0, len(matrix_df), tile_rows)
+    ]
+    with threadpool_limits(limits=1, user_api='blas'):
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            cors = list(executor.map(
+                lambda tile: similarity_df(tile, present_baits), tiles
+            ))
+    return pd.concat(cors)
+
+def _tile_rows(column_count, bait_count):
+    'Get number of rows of a tile of _correlate_tiled'
+    return max(1, _tile_bytes // ((column_count + bait_count) * 8))
+
+def _screening_pays(column_count, bait_count):
+    '''
+    Whether screening is clearly cheaper than correlating all pairs exactly
+
+    Correlating a gene to all baits costs ``column_count * bait_count``
+    multiplications. Its sketch and its estimated correlations cost
+    ``_sketch_size * (column_count + bait_count)``, plus a little for the
+    candidates.
+    '''
+    return 2 * _sketch_size * (column_count + bait_count) < column_count * bait_count
+
+def _screened_similarity(transform_rows, matrix_df, present_baits, cutoffs, recall):
+    '''
+    Get a similarity function which only correlates candidate pairs exactly
+
+    Transformed rows are unit vectors whose dot product is their correlation.
+    Projected onto the top `_sketch_size` principal axes V of a sample of the
+    rows, ``x = xV + e`` and the correlation of 2 rows x and y is ``(xV)(yV) +
+    (e_x)(e_y)``. The first term is the estimate, the second the error. The
+    norm of e follows from that of xV, as x is a unit vector, and by
+    Cauchy-Schwarz the error is at most ``|e_x| |e_y|``. Expression data is
+    highly structured, so the residuals e tend to be small.
+
+    Pairs whose estimate is within ``z |e_x| |e_y|`` of a cutoff, or beyond
+    it, are the candidates. With z = 1 these include all pairs beyond the
+    cutoffs, but as the residuals mostly point in different directions a
+    smaller z suffices: z is the `recall` quantile of the z each pair beyond
+    the cutoffs of a second sample needs to be a candidate. The residuals of
+    the first sample are smaller than those of other rows, so it can't be
+    used for this. If the second sample has too few pairs beyond the cutoffs
+    to estimate the quantile, z = 1.
+
+    Returns
+    -------
+    function(data1, data2) -> ~pandas.DataFrame
+        Correlations of the rows of ``data1`` to the baits, NaN for pairs
+        which are not candidates. ``data2`` must be `present_baits`.
+    '''
+    # Principal axes of a sample, as sampled in _estimate_cutoffs, and a
+    # second sample to calibrate z on
+    random = np.random.RandomState(seed=0)  # be deterministic
+    sample_size = min(len(matrix_df), 1600)
+    sample = matrix_df.values[random.choice(len(matrix_df), sample_size, replace=False)]
+    sample = transform_rows(sample.astype(float))
+    sample = sample[~np.isnan(sample).any(axis=1)]
+    sample, calibration_sample = np.array_split(sample, 2)
+    axes = np.linalg.svd(sample, full_matrices=False)[2][:_sketch_size].T
     lower_cutoff, upper_cutoff = cutoffs
 
-    # Correlation matrix
-    present_baits = matrix_df.reindex(baits).dropna()
-    cors = pearson_df(matrix_df, present_baits)
-    cor_matrix = cors
+    # Calibrate z
+    sample = calibration_sample
+    sample_sketch, sample_errors = _sketch(sample, axes)
+    triu = np.triu_indices(len(sample), 1)
+    cors = (sample @ sample.T)[triu]
+    is_beyond = (cors <= lower_cutoff) | (cors >= upper_cutoff)
+    if is_beyond.sum() >= 10 / (1 - recall):
+        estimates = (sample_sketch @ sample_sketch.T)[triu]
+        scales = np.outer(sample_errors, sample_errors)[triu]
+        # The z each pair needs to be a candidate
+        shortfalls = np.where(
+            cors >= upper_cutoff, upper_cutoff - estimates, estimates - lower_cutoff
+        )
+        with np.errstate(invalid='ignore', divide='ignore'):
+            needed_z = np.clip(shortfalls / scales, 0, 1)
+        needed_z = np.nan_to_num(needed_z[is_beyond])
+        z = np.quantile(needed_z, recall)
+    else:
+        z = 1.0
 
-    # Cutoff and reformat to relational (DB) format
-    cors = cors[(cors <= lower_cutoff) | (cors >= upper_cutoff)]
-    cors.index.name = None
-    cors = cors.reset_index()
-    cors = cors.rename(columns={'index': 'gene'})
-    cors = pd.melt(cors, id_vars=['gene'], var_name='bait', value_name='correlation')
-    cors = cors.dropna(subset=['correlation'])
+    bait_rows = transform_rows(present_baits.values.astype(float))
+    bait_sketch, bait_errors = _sketch(bait_rows, axes)
+
+    def similarity_df(data, baits):
+        rows = transform_rows(data.values.astype(float))
+        sketch, errors = _sketch(rows, axes)
+        estimates = sketch @ bait_sketch.T
+        margins = np.outer(errors * z, bait_errors)
+
+        # Rows without variance have NaN estimates, these are never candidates
+        # and so stay NaN like their correlations
+        with np.errstate(invalid='ignore'):
+            is_candidate = (
+                (estimates - margins <= lower_cutoff)
+                | (estimates + margins >= upper_cutoff)
+            )
+
+        # Correlate the candidates bait by bait, unless there are so many
+        # that correlating the whole tile with BLAS is faster
+        if is_candidate.mean() > .1:
+            cors = rows @ bait_rows.T
+            cors[~is_candidate] = np.nan
+        else:
+            cors = np.full(estimates.shape, np.nan)
+            for bait, bait_row in enumerate(bait_rows):
+                candidates = np.flatnonzero(is_candidate[:, bait])
+                cors[candidates, bait] = rows[candidates] @ bait_row
+        np.clip(cors, -1, 1, out=cors)
+        return pd.DataFrame(cors, index=data.index, columns=present_baits.index)
+
+    return similarity_df
+
+def _sketch(rows, axes):
+    'Get the projection of unit rows onto the axes and the norm of the rest'
+    sketch = rows @ axes
+    errors = np.sqrt(np.clip(1 - (sketch**2).sum(axis=1), 0, None))
+    return sketch, errors
 
-    return cors, ExpressionMatrixInfo(matrix, sample, cutoffs, cor_matrix)
+def _get_similarity_function(correlation_method, sparse=False):
+    '''
+    Get function which correlates the rows of 2 data frames
+
+    The cutoff sample and the bait correlations must use the same function,
+    else the percentiles do not apply to the correlations they cut. For
+    sparse rows, pearson uses sparse_pearson_df which gives the same
+    correlations. The other methods transform the rows, which makes them
+    dense, so they densify one tile at a time.
+    '''
+    if sparse and correlation_method == 'pearson':
+        return sparse_pearson_df
+    functions = {
+        'pearson': pearson_df,
+        'spearman': spearman_df,
+        'biweight_midcorrelation': bicor_df,
+        'pairwise_complete_pearson': pairwise_pearson_df,
+    }
+    return functions[correlation_method]
 
-def _estimate_cutoffs(matrix, percentiles):
+def _estimate_cutoffs(matrix, percentiles, correlation_method, keep_sample_matrix,
+                      sample_size=800):
     '''
     Estimate upper and lower correlation cutoffs
 
     Takes the x-th and y-th percentile of a sample similarity matrix of
-    `matrix`, returning these as the lower and upper cut-off respectively.
+    `matrix`, returning these as the lower and upper cut-off respectively,
+    along with the `CorrelationSample` they were taken from.
 
     Using a sample as calculating all correlations is n**2. Sample size is
     chosen to be easy enough to calculate; for a large matrix our estimate
-    is less accurate than for a small matrix. We could report a confidence
-    interval for the cut-off estimate if that bothers us or more likely delve
-    into statistics to find a better cut-off. In practice the user just plays
-    with the percentiles until the result is what they want; so this is good
-    enough.
+    is less accurate than for a small matrix. _estimate_confident_cutoffs
+    reports a confidence interval for the cut-off estimate if that bothers
+    us. In practice the user just plays with the percentiles until the
+    result is what they want; so this is good enough.
     '''
     matrix_df = matrix.data
 
     # Take a sample unless it's a tiny matrix
-    if len(matrix_df) <= 800:
+    if len(matrix_df) <= sample_size:
         sample = matrix_df
     else:
-        sample_size = 800
         sample = np.random.choice(len(matrix_df), sample_size, replace=False)
-        sample = matrix_df.iloc[sample]
+        sample = _take_rows(matrix_df, sample)
+    if is_sparse(sample):
+        sample = _take_rows(sample, np.arange(len(sample)), dense=True)
 
     sample = sample.sort_index()  # for prettier output later
-    cors = pearson_df(sample, sample)
+    similarity_df = _get_similarity_function(correlation_method)
+    cors = similarity_df(sample, sample)
 
     # Get the upper triangle as 1D array, excluding the diagonal.
     #
@@ -156,125 +1052,375 @@ def _estimate_cutoffs(matrix, percentiles):
 
     # Ignore NaN values when calculating percentiles
     triu = triu[~np.isnan(triu)]
-    cutoffs = np.percentile(triu, percentiles)
+    triu.sort()
 
-    return cors, cutoffs
+    sample = CorrelationSample(
+        size=len(cors),
+        values=triu,
+        matrix=cors if keep_sample_matrix else None,
+    )
+    cutoffs = sample.percentiles(percentiles)
+
+    return sample, cutoffs
+
+def _estimate_confident_cutoffs(matrix, percentiles, correlation_method,
+                                keep_sample_matrix, cutoff_confidence):
+    '''
+    Like _estimate_cutoffs, but also estimate confidence intervals of the cutoffs
+
+    The cutoffs are the inverted CDF percentiles of _bootstrap_cutoffs rather
+    than the interpolated percentiles of _estimate_cutoffs, so that they are
+    estimated the same way as the intervals.
+
+    When an interval is wider than the tolerance of the CutoffConfidence,
+    the sample size is doubled, up to `_max_sample_size` genes, and the
+    cutoffs estimated anew.
+
+    Returns
+    -------
+    sample : CorrelationSample
+    cutoffs : ~numpy.ndarray
+    intervals : ~numpy.ndarray
+        (low, high) of the interval of the lower and of the upper cutoff.
+    '''
+    tolerance = cutoff_confidence.tolerance
+    sample_size = 800
+    while True:
+        sample, _ = _estimate_cutoffs(
+            matrix, percentiles, correlation_method=correlation_method,
+            keep_sample_matrix=True, sample_size=sample_size,
+        )
+        cutoffs, intervals = _bootstrap_cutoffs(
+            sample.matrix.values, percentiles, cutoff_confidence
+        )
+        width = (intervals[:, 1] - intervals[:, 0]).max()
+        if tolerance is None or width <= tolerance or sample.size < sample_size:
+            break
+        if sample_size >= _max_sample_size:
+            logging.warning(join_lines(
+                f'''
+                The confidence intervals of the cutoffs of {matrix} are
+                {width:.3g} wide with a sample of {sample.size} genes, wider
+                than the tolerance of {tolerance}. Using them anyway.
+                '''
+            ))
+            break
+        sample_size = min(2 * sample_size, _max_sample_size)
+        logging.info(join_lines(
+            f'''
+            The confidence intervals of the cutoffs of {matrix} are
+            {width:.3g} wide, increasing the sample size to {sample_size}
+            '''
+        ))
+
+    if not keep_sample_matrix:
+        sample = attr.evolve(sample, matrix=None)
+    return sample, cutoffs, intervals
+
+def _bootstrap_cutoffs(sample_matrix, percentiles, cutoff_confidence):
+    '''
+    Get bootstrap confidence intervals of the percentiles of a correlation sample
+
+    Resamples the genes of the sample rather than the correlations, as the
+    correlations of a gene are not independent. Resampling genes needs no
+    new correlations: a resample has w_i copies of each gene i, so each
+    correlation (i, j) occurs w_i w_j times in it, not counting correlations
+    of copies of the same gene. The percentiles of a resample are weighted
+    percentiles of the sorted upper triangle: a pass over the triangle per
+    resample, batched in a matrix of resamples, and a binary search per
+    percentile.
+
+    Percentiles are the inverted CDF, the smallest value with at least the
+    percentile of the weight at or below it, for the cutoffs as well as for
+    the resamples.
+
+    Returns
+    -------
+    cutoffs : ~numpy.ndarray
+        Percentiles of the sample.
+    intervals : ~numpy.ndarray
+        (low, high) of the percentile interval of each percentile.
+    '''
+    rows, columns = np.triu_indices(len(sample_matrix), 1)
+    values = sample_matrix[rows, columns]
+    rows = rows.astype(np.int32)  # gathers of half the size
+    columns = columns.astype(np.int32)
+    order = np.argsort(values, kind='stable')
+    order = order[~np.isnan(values[order])]
+    values = values[order]
+    rows = rows[order]
+    columns = columns[order]
+    if not len(values):
+        return (
+            np.full(len(percentiles), np.nan), np.full((len(percentiles), 2), np.nan)
+        )
+
+    quantiles = np.asarray(percentiles, dtype=float) / 100
+    def weighted_percentiles(cumulative_weights):
+        positions = np.searchsorted(
+            cumulative_weights, cumulative_weights[-1] * quantiles
+        )
+        return values[np.minimum(positions, len(values) - 1)]
+    cutoffs = weighted_percentiles(np.arange(1, len(values) + 1, dtype=float))
+
+    random = np.random.RandomState(seed=0)  # be deterministic
+    size = len(sample_matrix)
+    weights = random.multinomial(
+        size, np.full(size, 1 / size), size=cutoff_confidence.resamples
+    ).astype(float)
+    resampled = np.empty((len(weights), len(quantiles)))
+
+    # Weigh and accumulate a batch in place, in a buffer reused across batches
+    batch_size = max(1, _bootstrap_bytes // (8 * len(values)))
+    cumulative_weights = np.empty((min(batch_size, len(weights)), len(values)))
+    for start in range(0, len(weights), batch_size):
+        batch = weights[start:start+batch_size]
+        batch_weights = cumulative_weights[:len(batch)]
+        np.take(batch, rows, axis=1, out=batch_weights)
+        batch_weights *= batch[:, columns]
+        np.cumsum(batch_weights, axis=1, out=batch_weights)
+        for i, resample_weights in enumerate(batch_weights, start):
+            resampled[i] = weighted_percentiles(resample_weights)
+
+    alpha = (1 - cutoff_confidence.level) / 2
+    return cutoffs, np.quantile(resampled, (alpha, 1 - alpha), axis=0).T
 
 def _create_nodes(baits, cors, gene_families):
     '''
-    Create DataFrame of nodes
+    Create DataFrames of nodes and of the genes in each node
+
+    Returns
+    -------
+    nodes : ~pandas.DataFrame
+        Columns (see node attrs in the docs):
 
-    Columns (see node attrs in the docs):
+        id : int
+        label : str
+        type : 'bait', 'family' or 'gene'
+        family : str or None
+        colour : RGB
+        partition_id : int
+    node_genes : ~pandas.DataFrame
+        Columns:
 
-    id : int
-    label : str
-    type : 'bait', 'family' or 'gene'
-    genes : FrozenSet of str
-    family : str or None
-    colour : RGB
-    partition_id : int
+        node : int
+            Node id.
+        gene : str
     '''
     bait_nodes = _create_bait_nodes(baits, gene_families)
-    family_nodes, gene_nodes = _create_non_bait_nodes(baits, cors, gene_families)
-    return _concat_nodes(bait_nodes, family_nodes, gene_nodes)
+    non_bait_nodes, non_bait_genes = _create_non_bait_nodes(baits, cors, gene_families)
+    return _concat_nodes(bait_nodes, non_bait_nodes, non_bait_genes)
 
 def _create_bait_nodes(baits, gene_families):
-    nodes = baits.to_frame('genes')
+    nodes = baits.to_frame('label')
     nodes = nodes.reset_index(drop=True)
     nodes['type'] = 'bait'
     nodes = pd.merge(
-        nodes, gene_families, left_on='genes', right_on='gene', how='left'
+        nodes, gene_families, left_on='label', right_on='gene', how='left'
     )
     del nodes['gene']
-    nodes['label'] = nodes['genes']
-    nodes['genes'] = nodes['genes'].apply(lambda gene: frozenset({gene}))
     nodes['colour'] = RGB((255, 255, 255))
-    nodes['partition_id'] = hash(frozenset())
+
+    # Baits are in the partition of the empty set of baits, see _partition_ids
+    nodes['partition_id'] = 0
     return nodes
 
 def _create_non_bait_nodes(baits, cors, gene_families):
+    '''
+    Create family and gene nodes of the genes correlating to the baits
+
+    Works on integer codes of the nodes and baits rather than on sets of
+    names.
+
+    Returns
+    -------
+    nodes : ~pandas.DataFrame
+        With columns label, type, family and partition_id. Family nodes come
+        first, followed by gene nodes.
+    node_genes : ~pandas.DataFrame
+        With columns node, the row number of the node in ``nodes``; and gene.
+    '''
     is_not_a_bait = ~cors['gene'].isin(baits)
-    cors = cors[is_not_a_bait]
-    family_nodes = pd.DataFrame(
-        columns=('baits', 'label', 'type', 'genes', 'family')
+    cors = cors.loc[is_not_a_bait, ['bait', 'gene']]
+    if cors.empty:
+        nodes = pd.DataFrame(columns=('label', 'type', 'family', 'partition_id'))
+        node_genes = pd.DataFrame(columns=('node', 'gene'))
+        return nodes, node_genes
+
+    # Each family is a node and each gene without a family is a node
+    cors = pd.merge(cors, gene_families, on='gene', how='left')
+    is_gene_node = cors['family'].isnull().values
+    family_codes, families = pd.factorize(cors['family'][~is_gene_node], sort=True)
+    gene_codes, genes = pd.factorize(cors['gene'][is_gene_node], sort=True)
+    node_codes = np.empty(len(cors), dtype=int)
+    node_codes[~is_gene_node] = family_codes
+    node_codes[is_gene_node] = gene_codes + len(families)
+    nodes = pd.DataFrame({
+        'label': np.concatenate((families, genes)),
+        'type': ['family'] * len(families) + ['gene'] * len(genes),
+        'family': np.concatenate((families, np.full(len(genes), None))),
+    })
+
+    # Nodes which correlate to the same baits are in the same partition
+    bait_codes, bait_names = pd.factorize(cors['bait'])
+    pairs = np.unique(node_codes * len(bait_names) + bait_codes)
+    pair_nodes, pair_baits = np.divmod(pairs, len(bait_names))
+    bait_hashes = _stable_hashes(bait_names)
+    nodes['partition_id'] = _partition_ids(
+        pair_nodes, bait_hashes[pair_baits], len(nodes)
     )
-    gene_nodes = pd.DataFrame(
-        columns=('baits', 'label', 'type', 'gene')
+
+    node_genes = pd.DataFrame({'node': node_codes, 'gene': cors['gene'].values})
+    node_genes = node_genes.drop_duplicates('gene', ignore_index=True)
+    return nodes, node_genes
+
+def _stable_hashes(strings):
+    '''
+    Hash each string to a uint64
+
+    Unlike hash(), the hashes do not depend on PYTHONHASHSEED and are thus the
+    same in every process and every run.
+    '''
+    return np.array(
+        [
+            int.from_bytes(blake2b(string.encode(), digest_size=8).digest(), 'little')
+            for string in strings
+        ],
+        dtype=np.uint64,
     )
-    if not cors.empty:
-        # Split into family and gene nodes
-        cors = pd.merge(cors, gene_families, on='gene', how='left')
-        gene_nodes = cors[cors['family'].isnull()]
-        cors = cors.dropna()  # drop gene nodes
-
-        if not cors.empty:
-            family_nodes = (
-                cors.groupby('family')[['bait', 'gene']]
-                .agg(frozenset)
-                .reset_index()
-            )
-            family_nodes.columns = ('family', 'baits', 'genes')
-            family_nodes['type'] = 'family'
-            family_nodes['label'] = family_nodes['family']
-
-        if not gene_nodes.empty:
-            gene_nodes = (
-                gene_nodes.groupby('gene')[['bait']]
-                .agg(frozenset)
-                .reset_index()
-            )
-            gene_nodes.columns = ('gene', 'baits')
-            gene_nodes['label'] = gene_nodes['gene']
-            gene_nodes['type'] = 'gene'
-            gene_nodes['genes'] = gene_nodes['gene'].apply(lambda gene: frozenset({gene}))
-            del gene_nodes['gene']
-    return family_nodes, gene_nodes
 
-def _concat_nodes(bait_nodes, family_nodes, gene_nodes):
-    nodes = pd.concat((family_nodes, gene_nodes), ignore_index=True)
+def _partition_ids(pair_nodes, pair_bait_hashes, node_count):
+    '''
+    Get the partition id of each node from the baits it correlates to
+
+    The id only depends on the set of bait names, so it is stable across
+    processes and runs. It is the sum of the stable hashes of the baits, mixed
+    to spread it over all 64 bits. A bait occurs in only 1 matrix so a
+    family spanning matrices can sum its unmixed parts per matrix and still get
+    the same id.
+
+    Parameters
+    ----------
+    pair_nodes : ~numpy.ndarray
+        Sorted node code of each distinct (node, bait) pair.
+    pair_bait_hashes : ~numpy.ndarray
+        Stable hash of the bait of each pair.
+    node_count : int
+        Number of nodes. Nodes without pairs get the id of the empty set, 0.
 
-    # Add partitions and colours to non-bait nodes
+    Returns
+    -------
+    ~numpy.ndarray
+        int64 partition id per node.
+    '''
+    sums = np.zeros(node_count, dtype=np.uint64)
+    if len(pair_nodes):
+        starts = np.flatnonzero(np.diff(pair_nodes, prepend=-1))
+        sums[pair_nodes[starts]] = np.add.reduceat(pair_bait_hashes, starts)
+    return _mix64(sums).view(np.int64)
+
+def _mix64(values):
+    'Mix uint64 values with the splitmix64 finaliser; wraps around on overflow'
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+def _concat_nodes(bait_nodes, non_bait_nodes, non_bait_genes):
+    nodes = non_bait_nodes.copy()
+
+    # Add colours to non-bait nodes, a distinct colour per partition. The
+    # colours are assigned in order of partition id rather than of
+    # appearance, so the same network gets the same colours in every run.
     if not nodes.empty:
-        nodes['partition_id'] = nodes['baits'].apply(hash)
-        del nodes['baits']
-        partitions = nodes[['partition_id']].drop_duplicates()
-        colours = list(distinct_colours(len(partitions)))
-        partitions['colour'] = colours
-        nodes = pd.merge(nodes, partitions, on='partition_id')
-
-    # Assign ids to all nodes
+        partition_ids = np.sort(nodes['partition_id'].unique())
+        colours = np.empty(len(partition_ids), dtype=object)
+        colours[:] = list(distinct_colours(len(partition_ids)))
+        nodes['colour'] = colours[
+            np.searchsorted(partition_ids, nodes['partition_id'].values)
+        ]
+
+    # Assign ids to all nodes, baits come last
     nodes = pd.concat((nodes, bait_nodes), ignore_index=True)
     nodes.index.name = 'id'
     nodes = nodes.reset_index()
 
+    bait_genes = pd.DataFrame({
+        'node': np.arange(len(bait_nodes)) + len(non_bait_nodes),
+        'gene': bait_nodes['label'].values,
+    })
+    node_genes = pd.concat((non_bait_genes, bait_genes), ignore_index=True)
+    node_genes['node'] = node_genes['node'].astype(int)
+
     # Replace NaN with None (can't use replacena for that)
     nodes = nodes.where(pd.notna(nodes), None)
 
-    return nodes
+    return nodes, node_genes
 
-def _create_homology_edges(nodes):
+def _create_homology_edges(nodes, max_clique_size=None):
     '''
-    Create DataFrame of homology edges between baits with columns:
+    Create DataFrame of homology edges between baits of the same family
 
-    bait_node1 : int
-    bait_node2 : int
-        Node id
+    Instead of fully connecting the baits of families with more than
+    `max_clique_size` baits, these families are returned as cliques.
+
+    Returns
+    -------
+    homology_edges : ~pandas.DataFrame
+        Columns:
+
+        bait_node1 : int
+        bait_node2 : int
+            Node id, greater than bait_node1.
+    homology_cliques : ~pandas.DataFrame
+        Columns:
+
+        family : str
+        bait_nodes : tuple of int
+            Ids of the bait nodes of the family, sorted.
     '''
     bait_nodes = nodes[nodes['type'] == 'bait'][['id', 'family']]
-    bait_nodes = bait_nodes.dropna(subset=('family',)).rename(columns={'id': 'bait_node'})
-    homology_edges = pd.merge(bait_nodes, bait_nodes, on='family', suffixes=('1', '2'))
-    del homology_edges['family']
-    # Avoid self/symmetrical edges (and there are no duplicate edges to begin
-    # with)
-    bait1_lt_bait2 = homology_edges['bait_node1'] < homology_edges['bait_node2']
-    homology_edges = homology_edges[bait1_lt_bait2].copy()
-    return homology_edges
+    bait_nodes = bait_nodes.dropna(subset=('family',))
+    bait_nodes = bait_nodes.sort_values(['family', 'id'])
+    ids = bait_nodes['id'].values
+    _, families, sizes = np.unique(
+        bait_nodes['family'].values, return_index=True, return_counts=True
+    )
+    is_clique = np.zeros(len(sizes), dtype=bool)
+    if max_clique_size is not None:
+        is_clique = sizes > max_clique_size
+
+    # Only emit the upper triangle of each family's pairs, so there are no
+    # self or symmetrical edges. Families of the same size share the same
+    # triangle of offsets, so generate their edges together.
+    edges = [np.empty((0, 2), dtype=int)]
+    for size in np.unique(sizes[~is_clique & (sizes > 1)]):
+        starts = families[~is_clique & (sizes == size)]
+        offsets1, offsets2 = np.triu_indices(size, 1)
+        edges.append(np.column_stack((
+            ids[(starts[:, np.newaxis] + offsets1).ravel()],
+            ids[(starts[:, np.newaxis] + offsets2).ravel()],
+        )))
+    homology_edges = pd.DataFrame(
+        np.concatenate(edges), columns=('bait_node1', 'bait_node2')
+    )
+
+    homology_cliques = pd.DataFrame({
+        'family': bait_nodes['family'].values[families[is_clique]],
+        'bait_nodes': [
+            tuple(ids[start:start+size].tolist())
+            for start, size in zip(families[is_clique], sizes[is_clique])
+        ],
+    }, columns=('family', 'bait_nodes'))
+    return homology_edges, homology_cliques
 
-def _create_cor_edges(nodes, cors):
+def _create_cor_edges(node_genes, cors):
     '''
     Create DataFrame of correlation edges between nodes.
 
-    cors param has no self/symmetrical/duplicate edges.
+    cors param has no self/symmetrical/duplicate edges. node_genes maps genes
+    to their node, see _create_nodes.
 
     Columns:
 
@@ -288,12 +1434,12 @@ def _create_cor_edges(nodes, cors):
     # Map cors.bait and cors.gene to their node id.
     #
     # Do include bait-bait cors (coexpnetviz/coexpnetviz#13)
-    cors = cors.copy()
-    nodes = nodes[['id', 'genes', 'type']].copy()
-    nodes = nodes.explode('genes').set_index('genes')
-    cors.update(cors['bait'].map(nodes['id']))
-    cors.update(cors['gene'].map(nodes['id']))
-    cors = cors.rename(columns={'bait': 'bait_node', 'gene': 'node'})
+    gene_nodes = node_genes.set_index('gene')['node']
+    cors = pd.DataFrame({
+        'bait_node': cors['bait'].map(gene_nodes),
+        'node': cors['gene'].map(gene_nodes),
+        'correlation': cors['correlation'],
+    })
 
     # Summarise correlations per edge by taking the max (in the abs sense)
     # per nodes of an edge
@@ -0,0 +1,243 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Difference between two networks in the records JSON format
+
+Node ids are only meaningful within one response, so nodes are matched by
+their type and label instead: a bait or gene node is labelled by its gene
+and a family node by its family, and there is at most 1 node of each. Edges
+are matched by the nodes they connect and homology cliques by their family.
+Partition ids are derived from the names of the baits, so they can be
+compared across responses as they are.
+
+Each table is matched in one outer merge on its keys; the indicator of the
+merge tells added, removed and kept rows apart.
+'''
+
+import numpy as np
+import pandas as pd
+
+
+# Version of the delta format, increment on incompatible changes
+version = 1
+
+_node_columns = ('id', 'label', 'type', 'family', 'colour', 'partition_id', 'genes')
+_cor_edge_columns = ('bait_node', 'node', 'max_correlation')
+_homology_edge_columns = ('bait_node1', 'bait_node2')
+_clique_columns = ('family', 'bait_nodes')
+
+def network_delta(previous, current):
+    '''
+    Get the changes from a previous network to the current one
+
+    Parameters
+    ----------
+    previous : dict
+        Network in the records JSON format, as parsed from a previous
+        response.
+    current : dict
+        Network in the records JSON format.
+
+    Returns
+    -------
+    dict
+        The delta (version 1):
+
+        - ``node_ids``: ``previous`` and ``current`` id of each node in both
+          networks, to map the ids of the previous network to the ids used
+          by the rest of the delta.
+        - ``nodes``, ``cor_edges``, ``homology_edges`` and
+          ``homology_cliques``: each has ``added`` records of the current
+          network; ``removed``, records of the previous network (only the
+          ids of nodes); and, except for homology edges whose only
+          attributes are their nodes, ``changed`` records of the current
+          network whose other attributes differ.
+        - ``preview``: as in the current network.
+    '''
+    previous_nodes = _table(previous, 'nodes', _node_columns)
+    current_nodes = _table(current, 'nodes', _node_columns)
+
+    # Number each (type, label) across both networks, then refer to nodes
+    # by that key rather than by id
+    keys = pd.concat(
+        (previous_nodes[['type', 'label']], current_nodes[['type', 'label']]),
+        ignore_index=True,
+    ).groupby(['type', 'label'], sort=False).ngroup().values
+    previous_keys = pd.Series(keys[:len(previous_nodes)], index=previous_nodes['id'])
+    current_keys = pd.Series(keys[len(previous_nodes):], index=current_nodes['id'])
+    previous_nodes['key'] = previous_keys.values
+    current_nodes['key'] = current_keys.values
+
+    removed, added, kept = _match(previous_nodes, current_nodes, ['key'])
+    # Colours are assigned over all partitions of a network, so adding a
+    # partition can recolour the others. Only the partition id tells whether
+    # a node's partition changed.
+    changed = _differs(previous_nodes, current_nodes, kept, ('family', 'partition_id'))
+    changed |= np.isin(
+        current_nodes['key'].values[kept[1]],
+        _changed_genes(previous_nodes, current_nodes),
+    )
+    delta = {
+        'format': 'delta',
+        'version': version,
+        'node_ids': {
+            'previous': previous_nodes['id'].values[kept[0]].tolist(),
+            'current': current_nodes['id'].values[kept[1]].tolist(),
+        },
+        'nodes': {
+            'added': _records(current, 'nodes', added),
+            'removed': previous_nodes['id'].values[removed].tolist(),
+            'changed': _records(current, 'nodes', kept[1][changed]),
+        },
+    }
+
+    # Correlation edges from a bait to a node
+    edge_ends = ('bait_node', 'node')
+    previous_edges = _keyed_edges(
+        _table(previous, 'cor_edges', _cor_edge_columns), previous_keys, edge_ends
+    )
+    current_edges = _keyed_edges(
+        _table(current, 'cor_edges', _cor_edge_columns), current_keys, edge_ends
+    )
+    delta['cor_edges'] = _table_delta(
+        previous, current, 'cor_edges', previous_edges, current_edges,
+        ['bait_node_key', 'node_key'], ('max_correlation',),
+    )
+
+    # Homology edges are undirected, bait_node1 is merely the lesser id
+    edge_ends = ('bait_node1', 'bait_node2')
+    previous_edges = _keyed_edges(
+        _table(previous, 'homology_edges', _homology_edge_columns),
+        previous_keys, edge_ends, undirected=True,
+    )
+    current_edges = _keyed_edges(
+        _table(current, 'homology_edges', _homology_edge_columns),
+        current_keys, edge_ends, undirected=True,
+    )
+    delta['homology_edges'] = _table_delta(
+        previous, current, 'homology_edges', previous_edges, current_edges,
+        ['bait_node1_key', 'bait_node2_key'],
+    )
+
+    # A clique per family, changed when its baits are
+    previous_cliques = _keyed_cliques(
+        _table(previous, 'homology_cliques', _clique_columns), previous_keys
+    )
+    current_cliques = _keyed_cliques(
+        _table(current, 'homology_cliques', _clique_columns), current_keys
+    )
+    delta['homology_cliques'] = _table_delta(
+        previous, current, 'homology_cliques', previous_cliques, current_cliques,
+        ['family'], ('bait_node_keys',),
+    )
+
+    if 'preview' in current:
+        delta['preview'] = current['preview']
+    return delta
+
+def _table(network, key, columns):
+    return pd.DataFrame(network.get(key, []), columns=list(columns))
+
+def _match(previous, current, on):
+    '''
+    Match the rows of two tables by their keys
+
+    Returns
+    -------
+    removed : ~numpy.ndarray
+        Positions of the previous rows without a current row.
+    added : ~numpy.ndarray
+        Positions of the current rows without a previous row.
+    kept : (~numpy.ndarray, ~numpy.ndarray)
+        Positions of the previous and of the current row of each match.
+    '''
+    # Merge only keys and positions, an outer merge turns the int columns
+    # of unmatched rows into float
+    merged = pd.merge(
+        previous[on].assign(_previous=np.arange(len(previous))),
+        current[on].assign(_current=np.arange(len(current))),
+        on=on, how='outer', indicator=True,
+    )
+    indicator = merged['_merge'].values
+    positions = merged[['_previous', '_current']]
+    removed = positions['_previous'].values[indicator == 'left_only']
+    added = positions['_current'].values[indicator == 'right_only']
+    kept = positions[indicator == 'both'].astype(int).sort_values('_current')
+    return (
+        np.sort(removed.astype(int)), np.sort(added.astype(int)),
+        (kept['_previous'].values, kept['_current'].values),
+    )
+
+def _table_delta(previous, current, key, previous_table, current_table, on,
+                 attributes=None):
+    '''
+    Get added, removed and, if attributes is not None, changed records
+
+    Rows are changed when any of the attributes differs.
+    '''
+    removed, added, kept = _match(previous_table, current_table, on)
+    delta = {
+        'added': _records(current, key, added),
+        'removed': _records(previous, key, removed),
+    }
+    if attributes is not None:
+        changed = _differs(previous_table, current_table, kept, attributes)
+        delta['changed'] = _records(current, key, kept[1][changed])
+    return delta
+
+def _differs(previous, current, kept, columns):
+    'Whether any of the columns of each kept row differs, None equals None'
+    differs = np.zeros(len(kept[0]), dtype=bool)
+    for column in columns:
+        previous_values = previous[column].iloc[kept[0]].reset_index(drop=True)
+        values = current[column].iloc[kept[1]].reset_index(drop=True)
+        differs |= (
+            (values != previous_values) & ~(values.isnull() & previous_values.isnull())
+        ).values
+    return differs
+
+def _changed_genes(previous_nodes, current_nodes):
+    'Get keys of the nodes whose genes differ'
+    def genes(nodes):
+        genes = nodes[['key', 'genes']].explode('genes').dropna()
+        return genes.drop_duplicates()
+    merged = pd.merge(
+        genes(previous_nodes), genes(current_nodes), how='outer', indicator=True,
+    )
+    return merged.loc[merged['_merge'] != 'both', 'key'].unique()
+
+def _keyed_edges(edges, keys, columns, undirected=False):
+    'Add node keys of the edge ends, as column + _key'
+    ends = [keys.reindex(edges[column]).values for column in columns]
+    if undirected and len(edges):
+        ends = [np.minimum(*ends), np.maximum(*ends)]
+    for column, end in zip(columns, ends):
+        edges[column + '_key'] = end
+    return edges
+
+def _keyed_cliques(cliques, keys):
+    'Add the sorted node keys of the baits of each clique as a tuple'
+    cliques['bait_node_keys'] = [
+        tuple(sorted(keys.reindex(bait_nodes).values)) for bait_nodes in cliques['bait_nodes']
+    ]
+    return cliques
+
+def _records(network, key, positions):
+    'Get the records of a table of the network as they are'
+    records = network.get(key, [])
+    return [records[position] for position in positions]
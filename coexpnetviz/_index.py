@@ -0,0 +1,247 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Nearest neighbour index of the genes of an expression matrix
+
+Standardised rows are unit vectors x, y with ``|x - y|**2 = 2 - 2 pearson(x,
+y)``, so the genes nearest to a bait are the ones it correlates best with and
+those nearest to the negated bait the ones it anti-correlates best with.
+
+The index is a single level ball tree: the rows are clustered and each
+cluster is a ball around its centroid. By the triangle inequality, a row in
+a ball of radius R around centroid c is at least ``|b - c| - R`` away from
+a bait b, which bounds its correlation. A query correlates the rows of the
+balls with the best bound first and stops at the first ball whose bound is
+worse than the k-th best correlation so far. Expression data is highly
+structured, so most balls are never opened. The results are exact either
+way.
+'''
+
+from hashlib import blake2b
+
+import numpy as np
+import pandas as pd
+
+from coexpnetviz import _kernels
+from coexpnetviz._similarity import pearson_rows
+
+
+# Number of rows to correlate at a time while building or querying
+_chunk_rows = 4096
+
+class CoexpressionIndex:
+
+    '''
+    Index to query the genes most co-expressed with a bait
+
+    Build it with `from_matrix` or `load` it from a file saved earlier.
+
+    Parameters
+    ----------
+    genes : ~numpy.ndarray
+        Gene names, ordered by ball.
+    rows : ~numpy.ndarray
+        Standardised row of each gene, see `~coexpnetviz._similarity.pearson_rows`.
+    offsets : ~numpy.ndarray
+        Start of each ball in `rows`, and the end of the last ball.
+    centroids : ~numpy.ndarray
+        Centre of each ball.
+    radii : ~numpy.ndarray
+        Radius of each ball.
+    digest : str
+        Digest of the expression matrix the index was built from.
+    '''
+
+    def __init__(self, genes, rows, offsets, centroids, radii, digest):
+        self._genes = np.asarray(genes, dtype=object)
+        self._rows = rows
+        self._offsets = offsets
+        self._centroids = centroids
+        self._radii = radii
+        self._digest = digest
+        self._gene_indices = pd.Series(np.arange(len(self._genes)), index=self._genes)
+
+    @staticmethod
+    def from_matrix(matrix):
+        '''
+        Build index of an `~varbio.ExpressionMatrix`
+
+        Rows with (near) 0 standard deviation have no correlation and are
+        left out, as are rows with NaN values: they would normalise to NaN
+        and make the bounds of their ball NaN.
+        '''
+        data = matrix.data
+        values = data.values
+        keep = _kernels.row_stds(values) >= np.finfo(float).tiny
+        keep &= ~np.isnan(values).any(axis=1)
+        if not keep.any():
+            raise ValueError(
+                f'{matrix} has no rows without NaN values and with variance to index'
+            )
+        data = data[keep]
+        rows = pearson_rows(data.values.astype(float))
+
+        # Spherical k-means on a sample to find the balls, about sqrt(n) of
+        # them, followed by assigning all rows to their nearest centroid
+        random = np.random.RandomState(seed=0)  # be deterministic
+        ball_count = max(1, int(np.sqrt(len(rows))))
+        sample = rows[random.choice(len(rows), min(len(rows), 50 * ball_count), replace=False)]
+        centroids = sample[random.choice(len(sample), ball_count, replace=False)]
+        for _ in range(5):
+            balls = _nearest_centroids(sample, centroids)
+            centroids = _centroids(sample, balls, centroids)
+        balls = _nearest_centroids(rows, centroids)
+
+        order = np.argsort(balls, kind='stable')
+        balls = balls[order]
+        rows = rows[order]
+        offsets = np.searchsorted(balls, np.arange(ball_count + 1))
+        radii = np.zeros(ball_count)
+        np.maximum.at(
+            radii, balls, np.linalg.norm(rows - centroids[balls], axis=1)
+        )
+        return CoexpressionIndex(
+            data.index.values[order], rows, offsets, centroids, radii,
+            digest(matrix),
+        )
+
+    @staticmethod
+    def load(path):
+        'Load index saved with `save`'
+        with np.load(path, allow_pickle=False) as file:
+            return CoexpressionIndex(
+                file['genes'], file['rows'], file['offsets'], file['centroids'],
+                file['radii'], str(file['digest']),
+            )
+
+    def save(self, path):
+        'Save the index to an npz file'
+        with open(path, 'wb') as file:
+            np.savez(
+                file, genes=self._genes.astype(str), rows=self._rows,
+                offsets=self._offsets, centroids=self._centroids,
+                radii=self._radii, digest=self._digest,
+            )
+
+    @property
+    def digest(self):
+        return self._digest
+
+    @property
+    def genes(self):
+        'Genes in the index, in no particular order'
+        return self._genes
+
+    def query(self, baits, k):
+        '''
+        Get the genes with the strongest correlation to each bait
+
+        Parameters
+        ----------
+        baits : ~pandas.Series
+            Baits to query. Baits which are not in the index, e.g. those with
+            NaN values, are ignored.
+        k : int
+            Number of genes to get per bait, excluding the bait itself.
+
+        Returns
+        -------
+        ~pandas.DataFrame
+            The top `k` genes by absolute pearson correlation of each bait,
+            with columns gene, bait, correlation.
+        '''
+        bait_indices = self._gene_indices.reindex(baits).dropna().astype(int).values
+        k = min(k, len(self._genes) - 1)
+        if not len(bait_indices) or k < 1:
+            return pd.DataFrame(columns=('gene', 'bait', 'correlation'))
+        genes, correlations = zip(*(
+            self._query_bait(bait_index, k) for bait_index in bait_indices
+        ))
+        return pd.DataFrame({
+            'gene': self._genes[np.concatenate(genes)],
+            'bait': np.repeat(self._genes[bait_indices], list(map(len, genes))),
+            'correlation': np.concatenate(correlations),
+        })
+
+    def _query_bait(self, bait_index, k):
+        bait_row = self._rows[bait_index]
+
+        # Bound the absolute correlation of the rows of each ball by the
+        # distance of the ball to the bait or to the negated bait
+        centroid_cors = self._centroids @ bait_row
+        distances = np.sqrt(np.clip(2 - 2 * np.abs(centroid_cors), 0, None))
+        gaps = np.clip(distances - self._radii, 0, None)
+        bounds = 1 - gaps**2 / 2
+        balls = np.argsort(-bounds, kind='stable')
+
+        best_genes = np.empty(0, dtype=int)
+        best_cors = np.empty(0)
+        kth_best = -np.inf
+        start = 0
+        while start < len(balls) and bounds[balls[start]] >= kth_best:
+            # Open balls until there are enough rows to correlate in one go
+            end = start
+            size = 0
+            while end < len(balls) and size < _chunk_rows and bounds[balls[end]] >= kth_best:
+                size += self._offsets[balls[end] + 1] - self._offsets[balls[end]]
+                end += 1
+            genes = np.concatenate([
+                np.arange(self._offsets[ball], self._offsets[ball + 1])
+                for ball in balls[start:end]
+            ])
+            genes = genes[genes != bait_index]
+            start = end
+
+            best_genes = np.concatenate([best_genes, genes])
+            best_cors = np.concatenate([best_cors, self._rows[genes] @ bait_row])
+            if len(best_genes) >= k:
+                best = np.argpartition(-np.abs(best_cors), k - 1)[:k]
+                best_genes = best_genes[best]
+                best_cors = best_cors[best]
+                kth_best = np.abs(best_cors).min()
+
+        order = np.argsort(-np.abs(best_cors), kind='stable')
+        return best_genes[order], np.clip(best_cors[order], -1, 1)
+
+def _nearest_centroids(rows, centroids):
+    return np.concatenate([
+        np.argmax(rows[start:start+_chunk_rows] @ centroids.T, axis=1)
+        for start in range(0, len(rows), _chunk_rows)
+    ])
+
+def _centroids(rows, balls, centroids):
+    'Get normalised mean of the rows of each ball, keep empty balls as they are'
+    sums = np.zeros_like(centroids)
+    np.add.at(sums, balls, rows)
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    return np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+
+def digest(matrix):
+    '''
+    Get digest of the names and values of an expression matrix
+
+    The column names are part of it, so selecting other columns of the same
+    matrix gives a different digest even when their values happen to be equal.
+    '''
+    data = matrix.data
+    hash_ = blake2b(digest_size=16)
+    hash_.update('\0'.join(map(str, data.index)).encode())
+    hash_.update(b'\1')
+    hash_.update('\0'.join(map(str, data.columns)).encode())
+    hash_.update(np.ascontiguousarray(data.values, dtype=float).tobytes())
+    return hash_.hexdigest()
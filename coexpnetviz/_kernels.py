@@ -0,0 +1,174 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Kernels of the passes over whole matrices, besides the correlation itself
+
+Each kernel has a numba backend, which fuses the pass into loops without any
+temporary arrays, and a numpy backend with the same results which is used
+when numba is not installed. The matrix products stay with BLAS, a JIT
+compiled loop does not beat it.
+'''
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+backends = ('numpy', 'numba')
+default_backend = 'numba' if numba else 'numpy'
+
+def row_stds(data, backend=None):
+    '''
+    Get the sample standard deviation of each row, ignoring NaN
+
+    Like `pandas.DataFrame.std` with ``axis=1``, but in a single pass over
+    each row with the numba backend.
+
+    Parameters
+    ----------
+    data : ~numpy.ndarray
+        2D array of float.
+    backend : str or None
+        One of `backends`, defaults to `default_backend`.
+
+    Returns
+    -------
+    ~numpy.ndarray
+        Standard deviation per row, NaN for rows with less than 2 values.
+    '''
+    return _get_kernel(_row_stds_kernels, backend)(_as_float(data))
+
+def cut(values, lower_cutoff, upper_cutoff, backend=None):
+    '''
+    Get the values at or beyond the cutoffs as triples
+
+    Emits the triples directly, column by column, instead of masking,
+    melting and dropping NaN; NaN values are never beyond the cutoffs.
+
+    Parameters
+    ----------
+    values : ~numpy.ndarray
+        2D array of float.
+    lower_cutoff : float
+    upper_cutoff : float
+    backend : str or None
+        One of `backends`, defaults to `default_backend`.
+
+    Returns
+    -------
+    rows : ~numpy.ndarray
+        Row index of each value.
+    columns : ~numpy.ndarray
+        Column index of each value.
+    values : ~numpy.ndarray
+        The values, ordered by column and then by row.
+    '''
+    kernel = _get_kernel(_cut_kernels, backend)
+    return kernel(_as_float(values), float(lower_cutoff), float(upper_cutoff))
+
+def _get_kernel(kernels, backend):
+    backend = backend or default_backend
+    if backend not in backends:
+        raise ValueError(f'Invalid backend: {backend}')
+    if backend == 'numba' and not numba:
+        raise ValueError('The numba backend requires the numba package')
+    return kernels[backend]
+
+def _as_float(data):
+    return np.asarray(data, dtype=float)
+
+def _row_stds_numpy(data):
+    if not np.isnan(data).any():
+        if data.shape[1] < 2:
+            return np.full(len(data), np.nan)
+        return data.std(axis=1, ddof=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts = (~np.isnan(data)).sum(axis=1)
+        centred = data - np.nanmean(data, axis=1, keepdims=True)
+        stds = np.sqrt(np.nansum(centred**2, axis=1) / (counts - 1))
+    stds[counts < 2] = np.nan
+    return stds
+
+def _cut_numpy(values, lower_cutoff, upper_cutoff):
+    is_cut = (values <= lower_cutoff) | (values >= upper_cutoff)
+    columns, rows = np.nonzero(is_cut.T)
+    return rows, columns, values[rows, columns]
+
+_row_stds_kernels = {'numpy': _row_stds_numpy}
+_cut_kernels = {'numpy': _cut_numpy}
+
+if numba:
+    # With the numpy error model a division by 0 gives inf/NaN instead of
+    # raising, as in numpy
+    _jit = numba.njit(cache=True, nogil=True, error_model='numpy')
+
+    @_jit
+    def _row_stds_numba(data):
+        stds = np.empty(data.shape[0])
+        for i in range(data.shape[0]):
+            # The row fits in cache, so the second loop does not go to memory
+            count = 0
+            total = 0.0
+            for value in data[i]:
+                if not np.isnan(value):
+                    count += 1
+                    total += value
+            if count < 2:
+                stds[i] = np.nan
+                continue
+            mean = total / count
+            squares = 0.0
+            for value in data[i]:
+                if not np.isnan(value):
+                    squares += (value - mean)**2
+            stds[i] = np.sqrt(squares / (count - 1))
+        return stds
+
+    @_jit
+    def _cut_numba(values, lower_cutoff, upper_cutoff):
+        row_count, column_count = values.shape
+
+        # Count first so the triples need no temporary arrays. Data frames
+        # store their values column by column, so column by column is also
+        # the order in memory.
+        count = 0
+        for j in range(column_count):
+            for i in range(row_count):
+                value = values[i, j]
+                if value <= lower_cutoff or value >= upper_cutoff:
+                    count += 1
+
+        rows = np.empty(count, np.intp)
+        columns = np.empty(count, np.intp)
+        cut_values = np.empty(count)
+        k = 0
+        for j in range(column_count):
+            for i in range(row_count):
+                value = values[i, j]
+                if value <= lower_cutoff or value >= upper_cutoff:
+                    rows[k] = i
+                    columns[k] = j
+                    cut_values[k] = value
+                    k += 1
+        return rows, columns, cut_values
+
+    _row_stds_kernels['numba'] = _row_stds_numba
+    _cut_kernels['numba'] = _cut_numba
@@ -0,0 +1,155 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+from pathlib import Path
+import gzip
+import io
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+compressions = (None, 'gzip', 'zstd')
+
+class TableWriter:
+
+    '''
+    Writes data frames to tab separated files
+
+    Rows are written a chunk at a time, so memory use does not grow with the
+    size of the table beyond that of a formatted chunk.
+
+    Parameters
+    ----------
+    float_precision : int or None
+        Number of decimals to round floats to. Rounding is vectorised and
+        makes pandas write the shortest repr of the rounded float, e.g. 0.5
+        instead of 0.49999999999999994. None writes floats at full
+        precision.
+    compression : str or None
+        One of `compressions`. 'gzip' adds a .gz suffix to the file name,
+        'zstd' adds .zst and compresses on all CPUs but requires the
+        zstandard package.
+    chunk_rows : int
+        Number of rows to format and write at a time.
+    '''
+
+    _suffixes = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, float_precision=None, compression=None, chunk_rows=10000):
+        if compression not in compressions:
+            raise ValueError(f'Invalid compression: {compression}')
+        if compression == 'zstd' and not zstandard:
+            raise ValueError('zstd compression requires the zstandard package')
+        self._float_precision = float_precision
+        self._compression = compression
+        self._chunk_rows = chunk_rows
+
+    def write(self, data, path, index=False):
+        '''
+        Write data frame to file
+
+        Parameters
+        ----------
+        data : ~pandas.DataFrame
+        path : ~pathlib.Path
+            File to write to, minus the compression suffix.
+        index : bool
+            Whether to write the index as first column.
+
+        Returns
+        -------
+        ~pathlib.Path
+            The file written to.
+        '''
+        path = Path(str(path) + self._suffixes[self._compression])
+        with self._open(path) as f:
+            # Always write at least the header, even when there are no rows
+            for start in range(0, max(len(data), 1), self._chunk_rows):
+                chunk = data.iloc[start:start+self._chunk_rows]
+                if self._float_precision is not None:
+                    chunk = chunk.round(self._float_precision)
+                chunk.to_csv(
+                    f, sep='\t', na_rep=str(np.nan), index=index,
+                    header=start == 0,
+                )
+        return path
+
+    def _open(self, path):
+        if self._compression == 'gzip':
+            return gzip.open(path, 'wt', newline='')
+        elif self._compression == 'zstd':
+            compressor = zstandard.ZstdCompressor(threads=-1)
+            return io.TextIOWrapper(
+                compressor.stream_writer(open(path, 'wb')), newline=''
+            )
+        else:
+            return open(path, 'w', newline='')
+
+def write_sqlite(tables, path, indices, chunk_rows=10000):
+    '''
+    Write data frames to a new SQLite database
+
+    An existing database at path is replaced. The tables are written in a
+    single transaction and the indices are created after the rows are
+    inserted, which is faster than maintaining them while inserting.
+
+    Parameters
+    ----------
+    tables : dict(str -> ~pandas.DataFrame)
+        Data frame to write per table name, without its index.
+    path : ~pathlib.Path
+    indices : iterable((str, str))
+        Table and column to create an index on.
+    chunk_rows : int
+        Number of rows to insert at a time.
+    '''
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+    connection = sqlite3.connect(str(path))
+    try:
+        # DataFrame.to_sql commits each table, so insert the rows ourselves.
+        # Begin explicitly, else sqlite3 would run CREATE TABLE outside of
+        # the transaction.
+        with connection:
+            connection.execute('BEGIN')
+            for name, data in tables.items():
+                connection.execute(pd.io.sql.get_schema(data, name, con=connection))
+                placeholders = ', '.join('?' * data.shape[1])
+                for start in range(0, len(data), chunk_rows):
+                    chunk = data.iloc[start:start+chunk_rows]
+                    connection.executemany(
+                        f'INSERT INTO "{name}" VALUES ({placeholders})',
+                        zip(*(_sql_values(chunk[column]) for column in chunk.columns)),
+                    )
+            for table, column in indices:
+                connection.execute(
+                    f'CREATE INDEX {table}_{column} ON {table} ({column})'
+                )
+    finally:
+        connection.close()
+
+def _sql_values(values):
+    'Get the values of a column as Python objects, None for missing values'
+    return values.astype(object).where(values.notnull(), None).tolist()
@@ -0,0 +1,311 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Readers of expression matrices in other formats than CSV
+
+AnnData and loom are HDF5 files. Only the names are read up front. The values of the selected columns are
+then read in chunks of about `_chunk_bytes` straight into the array of the
+expression matrix, so the file is never loaded as a whole and unselected
+columns (samples) are skipped rather than read and dropped. A sparse X of
+AnnData stays sparse: its chunks are stacked into a sparse data frame.
+
+AnnData stores samples as rows (obs) and genes as columns (var), loom genes
+as rows; either way the result has genes as rows like a CSV matrix.
+
+Matrix Market files, as written by 10x Genomics' Cell Ranger, are read into
+a sparse data frame, see `coexpnetviz._similarity.is_sparse`. CSV files can
+be read into one too, a chunk of rows at a time, so the dense matrix never
+exists as a whole.
+'''
+
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+import scipy.io
+import scipy.sparse
+from varbio import ExpressionMatrix, UserError, join_lines, parse_csv
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+hdf5_suffixes = ('.h5ad', '.loom')
+mtx_suffixes = ('.mtx', '.mtx.gz')
+
+# Bytes to read at a time
+_chunk_bytes = 2**26
+
+def read_hdf5_matrix(path, select_columns=None):
+    '''
+    Read an expression matrix from an AnnData (.h5ad) or loom file
+
+    Requires the h5py package.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        File with one of `hdf5_suffixes`, the name of the file is the name
+        of the matrix.
+    select_columns : callable or None
+        Given the column names as a `pandas.Index`, returns the sorted
+        positions of the columns to read. None reads all columns.
+
+    Returns
+    -------
+    ~varbio.ExpressionMatrix
+        Matrix with sparse data if X of an AnnData file is sparse.
+    '''
+    if not h5py:
+        raise ValueError(f'Reading {path.suffix} files requires the h5py package')
+    readers = {'.h5ad': _read_h5ad, '.loom': _read_loom}
+    if path.suffix not in readers:
+        raise ValueError(f'Not an HDF5 expression matrix: {path}')
+    with h5py.File(path, 'r') as file:
+        genes, columns, read_values = readers[path.suffix](file)
+        _raise_if_duplicate_genes(path, genes)
+        positions = np.arange(len(columns))
+        if select_columns is not None:
+            positions = np.asarray(select_columns(columns), dtype=int)
+        values = read_values(positions)
+    if scipy.sparse.issparse(values):
+        data = pd.DataFrame.sparse.from_spmatrix(
+            values, index=genes, columns=columns[positions]
+        )
+    else:
+        data = pd.DataFrame(values, index=genes, columns=columns[positions], copy=False)
+    return ExpressionMatrix(path.name, data)
+
+def is_mtx(path):
+    'Whether the path is of a Matrix Market file'
+    return path.name.endswith(mtx_suffixes)
+
+def read_mtx_matrix(path, select_columns=None):
+    '''
+    Read a sparse expression matrix from a Matrix Market file
+
+    The gene names are the first column of features.tsv or genes.tsv, the
+    column names those of barcodes.tsv, in the directory of the file as
+    Cell Ranger writes them. These may be gzipped.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        File with one of `mtx_suffixes`, the name of the file is the name of
+        the matrix. Rows are genes and columns samples.
+    select_columns : callable or None
+        See `read_hdf5_matrix`.
+
+    Returns
+    -------
+    ~varbio.ExpressionMatrix
+        Matrix with sparse data.
+    '''
+    genes = _read_names(path, ('features.tsv', 'genes.tsv'))
+    _raise_if_duplicate_genes(path, genes)
+    columns = _read_names(path, ('barcodes.tsv',))
+    values = scipy.sparse.csc_matrix(scipy.io.mmread(str(path)), dtype=float)
+    if values.shape != (len(genes), len(columns)):
+        raise ValueError(join_lines(
+            f'''
+            Matrix {path} has shape {values.shape} but there are {len(genes)}
+            gene names and {len(columns)} column names
+            '''
+        ))
+    if select_columns is not None:
+        positions = np.asarray(select_columns(columns), dtype=int)
+        values = values[:, positions]
+        columns = columns[positions]
+    data = pd.DataFrame.sparse.from_spmatrix(values, index=genes, columns=columns)
+    return ExpressionMatrix(path.name, data)
+
+def read_sparse_csv_matrix(path, select_columns=None):
+    '''
+    Read an expression matrix from a CSV file into a sparse data frame
+
+    Each chunk of rows, of about `_chunk_bytes` once parsed, is made into a
+    dense matrix, like a whole file normally is, and then made sparse.
+
+    Parameters
+    ----------
+    path : ~pathlib.Path
+        CSV file, the name of the file is the name of the matrix.
+    select_columns : callable or None
+        See `read_hdf5_matrix`.
+
+    Returns
+    -------
+    ~varbio.ExpressionMatrix
+        Matrix with sparse data.
+    '''
+    rows = iter(parse_csv(path))
+    header = next(rows)
+    columns = pd.Index(header[1:], dtype=object)
+    positions = np.arange(len(columns))
+    if select_columns is not None:
+        positions = np.asarray(select_columns(columns), dtype=int)
+    # A parsed value is a str of about 60 bytes rather than a float of 8
+    chunk_rows = max(1, _chunk_bytes // (64 * max(len(columns), 1)))
+    genes = []
+    chunks = []
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            break
+        data = ExpressionMatrix.from_csv(path.name, [header] + chunk).data
+        genes.append(data.index)
+        chunks.append(scipy.sparse.csc_matrix(data.values[:, positions]))
+    genes = genes[0].append(genes[1:]) if genes else pd.Index([], dtype=object)
+    _raise_if_duplicate_genes(path, genes)
+    values = (
+        scipy.sparse.vstack(chunks, format='csc') if chunks
+        else scipy.sparse.csc_matrix((0, len(positions)))
+    )
+    data = pd.DataFrame.sparse.from_spmatrix(
+        values, index=genes, columns=columns[positions]
+    )
+    return ExpressionMatrix(path.name, data)
+
+def _raise_if_duplicate_genes(path, genes):
+    duplicates = genes[genes.duplicated()].unique()
+    if len(duplicates):
+        raise UserError(join_lines(
+            f'''
+            Expression matrix {path.name} has duplicate genes:
+            {', '.join(map(str, duplicates))}
+            '''
+        ))
+
+def _read_names(path, file_names):
+    for file_name in file_names:
+        for suffix in ('', '.gz'):
+            names_path = path.parent / (file_name + suffix)
+            if names_path.exists():
+                names = pd.read_csv(
+                    names_path, sep='\t', header=None, usecols=[0], dtype=str
+                )
+                return pd.Index(names[0].values, dtype=object)
+    raise ValueError(
+        f'Matrix {path} has no {" or ".join(file_names)} next to it'
+    )
+
+def _read_h5ad(file):
+    genes = _read_anndata_index(file['var'])
+    columns = _read_anndata_index(file['obs'])
+    x = file['X']
+    encoding = x.attrs.get('encoding-type', None) if isinstance(x, h5py.Group) else None
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+
+    def read_dense(positions):
+        # Samples are rows of X
+        values = np.empty((len(genes), len(positions)))
+        for start, stop, selected in _chunks(x.shape[0], x.shape[1], positions):
+            values[:, selected] = x[start:stop][positions[selected] - start].T
+        return values
+
+    def read_csr(positions):
+        # Only read the slab of rows of each chunk out of data and indices.
+        # The selected rows of each slab are the next columns of the matrix.
+        indptr = x['indptr'][:]
+        slabs = [scipy.sparse.csc_matrix((len(genes), 0))]
+        for start, stop, selected in _chunks(len(indptr) - 1, len(genes), positions):
+            begin, end = indptr[start], indptr[stop]
+            slab = scipy.sparse.csr_matrix(
+                (x['data'][begin:end], x['indices'][begin:end], indptr[start:stop+1] - begin),
+                shape=(stop - start, len(genes)),
+            )
+            slabs.append(slab[positions[selected] - start].T)
+        return scipy.sparse.hstack(slabs, format='csc', dtype=float)
+
+    def read_csc(positions):
+        # Columns of X are genes, so chunk along genes and pick the samples.
+        # Each slab gives the next rows of the matrix.
+        indptr = x['indptr'][:]
+        slabs = [scipy.sparse.csc_matrix((0, len(positions)))]
+        for start, stop, _ in _chunks(len(indptr) - 1, len(columns), None):
+            begin, end = indptr[start], indptr[stop]
+            slab = scipy.sparse.csc_matrix(
+                (x['data'][begin:end], x['indices'][begin:end], indptr[start:stop+1] - begin),
+                shape=(len(columns), stop - start),
+            )
+            slabs.append(slab[positions].T)
+        return scipy.sparse.vstack(slabs, format='csc', dtype=float)
+
+    if encoding is None:
+        return genes, columns, read_dense
+    if encoding == 'csr_matrix':
+        return genes, columns, read_csr
+    if encoding == 'csc_matrix':
+        return genes, columns, read_csc
+    raise ValueError(f'Unsupported AnnData X encoding: {encoding}')
+
+def _read_anndata_index(group):
+    # Since AnnData 0.7 obs and var are groups naming their index column,
+    # before that compound datasets with an index field
+    if isinstance(group, h5py.Group):
+        return _decode(group[group.attrs.get('_index', '_index')][:])
+    return _decode(group['index'])
+
+def _read_loom(file):
+    matrix = file['matrix']
+    try:
+        genes = _decode(file['row_attrs/Gene'][:])
+        columns = _decode(file['col_attrs/CellID'][:])
+    except KeyError as ex:
+        raise ValueError(
+            f'Loom file {file.filename} has no Gene row or CellID column attribute'
+        ) from ex
+
+    def read(positions):
+        values = np.empty((len(genes), len(positions)))
+        all_columns = len(positions) == matrix.shape[1]
+        for start, stop, _ in _chunks(matrix.shape[0], matrix.shape[1], None):
+            if all_columns:
+                values[start:stop] = matrix[start:stop]
+            else:
+                values[start:stop] = matrix[start:stop, positions]
+        return values
+
+    return genes, columns, read
+
+def _chunks(length, width, positions):
+    '''
+    Split range(length) into chunks of rows of width values each
+
+    Yields start, stop and, if positions is not None, the indices into the
+    sorted positions which fall in [start, stop). Chunks without positions
+    are skipped.
+    '''
+    step = max(1, _chunk_bytes // (8 * max(width, 1)))
+    for start in range(0, length, step):
+        stop = min(start + step, length)
+        if positions is None:
+            yield start, stop, None
+            continue
+        selected = np.arange(*np.searchsorted(positions, (start, stop)))
+        if len(selected):
+            yield start, stop, selected
+
+def _decode(values):
+    return pd.Index([
+        value.decode() if isinstance(value, bytes) else str(value)
+        for value in values
+    ], dtype=object)
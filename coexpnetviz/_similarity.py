@@ -0,0 +1,263 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Similarity measures between rows of expression data
+
+Each measure first transforms every row, independently of the other rows, into
+a unit vector such that the dot product of 2 transformed rows is the
+similarity of the original rows. All similarities between 2 sets of rows then
+come down to a single matrix product, which numpy hands to BLAS.
+'''
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+correlation_methods = (
+    'pearson', 'spearman', 'biweight_midcorrelation', 'pairwise_complete_pearson'
+)
+
+# Number of values of a sparse matrix to process at a time
+_chunk_values = 2**20
+
+def pearson_rows(data):
+    '''
+    Transform rows so that their dot products are pearson correlations
+
+    Parameters
+    ----------
+    data : ~numpy.ndarray
+        2D array of float.
+
+    Returns
+    -------
+    ~numpy.ndarray
+        Centred rows with unit norm. Rows without variance become NaN.
+    '''
+    centred = data - data.mean(axis=1, keepdims=True)
+    return _normalise_rows(centred)
+
+def spearman_rows(data):
+    '''
+    Transform rows so that their dot products are spearman correlations
+
+    Ranks each row once (ties get their average rank) after which spearman is
+    simply pearson on the ranks.
+    '''
+    ranks = pd.DataFrame(data).rank(axis=1).values
+    return pearson_rows(ranks)
+
+def bicor_rows(data):
+    '''
+    Transform rows so that their dot products are biweight midcorrelations
+
+    Rows with a median absolute deviation of 0 fall back to pearson, as
+    WGCNA's bicor does by default, rather than becoming NaN.
+    '''
+    median = np.median(data, axis=1, keepdims=True)
+    centred = data - median
+    mad = np.median(np.abs(centred), axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = centred / (9 * mad)
+        weights = (1 - u**2)**2 * (np.abs(u) < 1)
+    weighted = centred * weights
+
+    zero_mad = (mad == 0).ravel()
+    if zero_mad.any():
+        fallback = data[zero_mad]
+        weighted[zero_mad] = fallback - fallback.mean(axis=1, keepdims=True)
+
+    return _normalise_rows(weighted)
+
+# Transform of each correlation method, by name
+row_transforms = {
+    'pearson': pearson_rows,
+    'spearman': spearman_rows,
+    'biweight_midcorrelation': bicor_rows,
+}
+
+def _normalise_rows(data):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return data / np.linalg.norm(data, axis=1, keepdims=True)
+
+def is_sparse(data):
+    'Whether all columns of a data frame are sparse'
+    return len(data.columns) > 0 and all(
+        isinstance(dtype, pd.SparseDtype) for dtype in data.dtypes
+    )
+
+def sparse_rows(data):
+    '''
+    Get the values of a sparse data frame as a CSC matrix
+
+    Built straight from the sparse columns, which is lighter than
+    `pandas.DataFrame.sparse.to_coo` as it needs no column index per value.
+    '''
+    columns = [data[column].array for column in data.columns]
+    lengths = [column.sp_index.npoints for column in columns]
+    return scipy.sparse.csc_matrix(
+        (
+            np.concatenate([column.sp_values for column in columns]).astype(float, copy=False),
+            np.concatenate([column.sp_index.indices for column in columns]),
+            np.concatenate(([0], np.cumsum(lengths))),
+        ),
+        shape=data.shape,
+    )
+
+def centred_norms(rows):
+    '''
+    Get the norm of each row of a sparse matrix after centring it
+
+    Parameters
+    ----------
+    rows : ~scipy.sparse.csc_matrix
+        Matrix as returned by `sparse_rows`.
+
+    Returns
+    -------
+    ~numpy.ndarray
+        ``|x - mean(x)|`` of each row x, without densifying the rows. Rather
+        than the shortcut ``sum(x**2) - n mean(x)**2``, which suffers from
+        cancellation, the implicit zeros each add ``mean(x)**2``.
+    '''
+    row_count, column_count = rows.shape
+    means = np.bincount(rows.indices, rows.data, minlength=row_count) / column_count
+    nonzero_counts = np.bincount(rows.indices, minlength=row_count)
+
+    # A chunk of values at a time, else the temporary arrays would be several
+    # times the size of the matrix
+    squares = (column_count - nonzero_counts) * means**2
+    for start in range(0, rows.nnz, _chunk_values):
+        indices = rows.indices[start:start+_chunk_values]
+        deviations = rows.data[start:start+_chunk_values] - means[indices]
+        squares += np.bincount(indices, deviations**2, minlength=row_count)
+    return np.sqrt(squares)
+
+def sparse_pearson_df(data1, data2):
+    '''
+    Get pearson correlations between the rows of a sparse and a dense data frame
+
+    As the transformed rows of `data2` are centred, their sum is 0 and
+    centring the rows x of `data1` does not change the dot product: ``(x -
+    mean(x)) . y = x . y``. So the correlations are a sparse matrix product
+    with `data2` divided by the centred norms of `data1`; the rows of
+    `data1` are never densified.
+
+    Parameters
+    ----------
+    data1 : ~pandas.DataFrame
+        Sparse data frame, see `is_sparse`.
+    data2 : ~pandas.DataFrame
+        Dense data frame with the same columns as ``data1``.
+
+    Returns
+    -------
+    ~pandas.DataFrame
+        Correlations with ``data1.index`` as index and ``data2.index`` as
+        columns.
+    '''
+    rows1 = sparse_rows(data1)
+    rows2 = pearson_rows(data2.values.astype(float))
+    similarities = np.asarray(rows1 @ rows2.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarities /= centred_norms(rows1)[:, np.newaxis]
+    np.clip(similarities, -1, 1, out=similarities)
+    return pd.DataFrame(similarities, index=data1.index, columns=data2.index)
+
+def spearman_df(data1, data2):
+    '''
+    Get spearman correlations between the rows of 2 data frames
+
+    Parameters
+    ----------
+    data1 : ~pandas.DataFrame
+    data2 : ~pandas.DataFrame
+        Data frame with the same columns as ``data1``.
+
+    Returns
+    -------
+    ~pandas.DataFrame
+        Correlations with ``data1.index`` as index and ``data2.index`` as
+        columns.
+    '''
+    return _similarity_df(spearman_rows, data1, data2)
+
+def pairwise_pearson_df(data1, data2):
+    '''
+    Get pearson correlations between rows, ignoring missing values per pair
+
+    Each pair of rows is correlated on the columns where both have a value,
+    like ``pandas.DataFrame.corr``. With M the indicator matrices of the
+    values present and X the values with NaN replaced by 0, the count, sums,
+    sums of squares and sum of products of each pair are each a matrix
+    product, e.g. the sums of the rows of ``data1`` over the columns present
+    in each row of ``data2`` are ``X1 @ M2.T``. Rows are centred on their
+    mean first, which does not change their correlations but avoids
+    cancellation in the sums of squares.
+
+    Pairs with less than 2 common values, or without variance in their
+    common values, have a NaN correlation. Without any missing values this
+    is plain pearson.
+
+    Parameters
+    ----------
+    data1 : ~pandas.DataFrame
+    data2 : ~pandas.DataFrame
+        Data frame with the same columns as ``data1``.
+
+    Returns
+    -------
+    ~pandas.DataFrame
+        Correlations with ``data1.index`` as index and ``data2.index`` as
+        columns.
+    '''
+    values1 = data1.values.astype(float)
+    values2 = data2.values.astype(float)
+    present1 = ~np.isnan(values1)
+    present2 = ~np.isnan(values2)
+    if present1.all() and present2.all():
+        return _similarity_df(pearson_rows, data1, data2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values1 = np.where(present1, values1 - np.nanmean(values1, axis=1, keepdims=True), 0)
+        values2 = np.where(present2, values2 - np.nanmean(values2, axis=1, keepdims=True), 0)
+        present1 = present1.astype(float)
+        present2 = present2.astype(float).T
+        counts = present1 @ present2
+        sums1 = values1 @ present2
+        sums2 = present1 @ values2.T
+        products = values1 @ values2.T - sums1 * sums2 / counts
+        squares1 = (values1**2) @ present2 - sums1**2 / counts
+        squares2 = present1 @ (values2**2).T - sums2**2 / counts
+        similarities = products / np.sqrt(squares1 * squares2)
+    similarities[(counts < 2) | (squares1 <= 0) | (squares2 <= 0)] = np.nan
+    np.clip(similarities, -1, 1, out=similarities)
+    return pd.DataFrame(similarities, index=data1.index, columns=data2.index)
+
+def bicor_df(data1, data2):
+    'Get biweight midcorrelations between the rows of 2 data frames'
+    return _similarity_df(bicor_rows, data1, data2)
+
+def _similarity_df(transform_rows, data1, data2):
+    rows1 = transform_rows(data1.values.astype(float))
+    rows2 = transform_rows(data2.values.astype(float))
+
+    # Rounding errors can push the dot product of unit vectors just past 1
+    similarities = np.clip(rows1 @ rows2.T, -1, 1)
+    return pd.DataFrame(similarities, index=data1.index, columns=data2.index)
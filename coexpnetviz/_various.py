@@ -27,20 +27,194 @@ import pandas as pd
 class Network:
 
     nodes = attr.ib()
+    node_genes = attr.ib()
     homology_edges = attr.ib()
+    homology_cliques = attr.ib()
     cor_edges = attr.ib()
     significant_cors = attr.ib()
     matrix_infos = attr.ib()
 
+    # The Preview the network was created with, if any
+    preview = attr.ib(default=None)
+
+    def genes(self):
+        '''
+        Get the genes of each node
+
+        Materialised from `node_genes` on demand; only the output needs them
+        grouped per node.
+
+        Returns
+        -------
+        ~pandas.Series
+            Sorted tuple of genes per node id.
+        '''
+        node_genes = self.node_genes.sort_values('gene')
+        return node_genes.groupby('node')['gene'].agg(tuple)
+
 @attr.s(frozen=True, slots=True)
 class ExpressionMatrixInfo:
 
-    'Intermediate results of an expression matrix (see docs output section)'
+    '''
+    Intermediate results of an expression matrix (see docs output section)
+
+    percentile_values are the lower and upper cutoff, at respectively the
+    lower and upper percentiles of the sample. percentile_value_intervals, if
+    any, are the (low, high) bounds of the confidence interval of each of
+    them, see CutoffConfidence.
+    '''
 
     matrix = attr.ib()
     sample = attr.ib()
     percentile_values = attr.ib()
     cor_matrix = attr.ib()
+    percentiles = attr.ib()
+    percentile_value_intervals = attr.ib(default=None)
+
+@attr.s(frozen=True, slots=True)
+class CutoffConfidence:
+
+    '''
+    Confidence intervals to estimate of the percentile cutoffs
+
+    Attributes
+    ----------
+    level : float
+        Confidence level of the intervals, in (0, 1).
+    tolerance : float or None
+        Maximum width of the intervals. While an interval is wider, the
+        sample size is doubled, up to a limit. None keeps the sample size.
+    resamples : int
+        Number of bootstrap resamples of the sample.
+    '''
+
+    level = attr.ib(default=.95)
+    tolerance = attr.ib(default=None)
+    resamples = attr.ib(default=200)
+
+    @level.validator
+    def _validate_level(self, attribute, value):
+        if not 0 < value < 1:
+            raise ValueError(f'Confidence level must be in (0, 1), got: {value}')
+
+    @tolerance.validator
+    def _validate_tolerance(self, attribute, value):
+        if value is not None and value <= 0:
+            raise ValueError(f'Tolerance must be positive, got: {value}')
+
+    @resamples.validator
+    def _validate_resamples(self, attribute, value):
+        if value < 1:
+            raise ValueError(f'Number of resamples must be at least 1, got: {value}')
+
+@attr.s(frozen=True, slots=True)
+class Preview:
+
+    '''
+    Subset of each expression matrix to correlate for a quick preview
+
+    Attributes
+    ----------
+    max_columns : int or None
+        Number of columns to keep, or None to keep all.
+    column_selection : str
+        How to select the columns: 'variance' keeps the columns in which
+        genes deviate most from their mean, 'random' a random sample.
+    max_genes : int or None
+        Number of non-bait genes to keep, those with the largest standard
+        deviation over the kept columns. None keeps all. Baits are always kept.
+    '''
+
+    column_selections = ('variance', 'random')
+
+    max_columns = attr.ib(default=None)
+    column_selection = attr.ib(default='variance')
+    max_genes = attr.ib(default=None)
+
+    @max_columns.validator
+    @max_genes.validator
+    def _validate_max(self, attribute, value):
+        if value is not None and value < 1:
+            raise ValueError(f'{attribute.name} must be at least 1, got: {value}')
+
+    @column_selection.validator
+    def _validate_column_selection(self, attribute, value):
+        if value not in self.column_selections:
+            raise ValueError(f'Invalid column selection: {value}')
+
+    def to_dict(self):
+        return attr.asdict(self)
+
+@attr.s(frozen=True, slots=True)
+class CorrelationSample:
+
+    '''
+    Distribution of the correlations between a sample of genes of a matrix
+
+    Only the upper triangle of the sample correlation matrix (minus the
+    diagonal) is kept, sorted and without NaN, which is all that is needed for
+    the cutoffs, histogram and CDF. The dense matrix is only kept when asked
+    for, to write it to a file.
+
+    Attributes
+    ----------
+    size : int
+        Number of genes in the sample.
+    values : ~numpy.ndarray
+        Sorted 1D array of the correlations between each distinct pair of
+        genes in the sample.
+    matrix : ~pandas.DataFrame or None
+        Sample correlation matrix, if it was asked for.
+    '''
+
+    size = attr.ib()
+    values = attr.ib()
+    matrix = attr.ib(default=None)
+
+    def percentiles(self, percentiles):
+        return np.percentile(self.values, percentiles)
+
+    def percentile_ranks(self, cutoffs):
+        '''
+        Get the percentiles at which the cutoffs lie
+
+        The lower percentile is the percentage of correlations at or below the
+        lower cutoff, the upper percentile that of correlations below the
+        upper cutoff.
+        '''
+        lower_cutoff, upper_cutoff = cutoffs
+        size = max(self.values.size, 1)
+        return (
+            np.searchsorted(self.values, lower_cutoff, side='right') / size * 100,
+            np.searchsorted(self.values, upper_cutoff, side='left') / size * 100,
+        )
+
+    def histogram(self, bins=60):
+        '''
+        Get histogram of the correlations
+
+        Returns
+        -------
+        counts : ~numpy.ndarray
+            Number of correlations in each bin.
+        edges : ~numpy.ndarray
+            Bin edges, ``len(counts) + 1`` of them.
+        '''
+        if self.values.size:
+            low, high = self.values[0], self.values[-1]
+        else:
+            low, high = 0, 1
+        if low == high:
+            low, high = low - .5, high + .5
+        edges = np.linspace(low, high, bins + 1)
+
+        # The values are sorted so we can count by searching for the edges,
+        # instead of binning each value. Like numpy.histogram, the last bin
+        # includes its right edge.
+        ends = np.searchsorted(self.values, edges, side='left')
+        ends[-1] = self.values.size
+        counts = np.diff(ends)
+        return counts, edges
 
 class RGB:
 
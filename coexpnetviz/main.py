@@ -26,30 +26,49 @@ import matplotlib
 matplotlib.use('Agg')
 
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from pathlib import Path
-from itertools import product
+from queue import Queue
 from textwrap import dedent
+from threading import Thread
 import csv
 import ctypes
 import json
 import logging
+import re
 import sys
 
 from varbio import (
     ExpressionMatrix, parse_baits, parse_csv, UserError,
     join_lines
 )
+import attr
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
 from coexpnetviz import __version__
 from coexpnetviz._algorithm import create_network
-from coexpnetviz._various import parse_gene_families
+from coexpnetviz._delta import network_delta
+from coexpnetviz._output import TableWriter, compressions, write_sqlite, zstandard
+from coexpnetviz._readers import (
+    h5py, hdf5_suffixes, read_hdf5_matrix, is_mtx, read_mtx_matrix,
+    read_sparse_csv_matrix,
+)
+from coexpnetviz._similarity import correlation_methods, is_sparse
+from coexpnetviz._various import CutoffConfidence, Preview, parse_gene_families
 
 
 _line_style = {'color': 'r', 'linewidth': 2}
 
+# Layouts of the JSON network, see _network_json
+response_formats = ('records', 'columnar')
+
+# Version of the columnar format, increment on incompatible changes
+_columnar_version = 1
+
 
 class App:
 
@@ -57,17 +76,40 @@ class App:
         try:
             _init()
             self._parse_input()
-            network = create_network(
-                self._baits,
-                self._expression_matrices,
-                self._gene_families,
-                self._percentiles,
+            with self._create_executor() as executor:
+                network = create_network(
+                    self._baits,
+                    self._expression_matrices,
+                    self._gene_families,
+                    self._percentiles,
+                    correlation_method=self._correlation_method,
+                    keep_sample_matrix=self._write_sample_matrix,
+                    threads=self._threads,
+                    max_homology_clique_size=self._max_homology_clique_size,
+                    max_cor_edges=self._max_cor_edges,
+                    max_non_bait_nodes=self._max_non_bait_nodes,
+                    fdr=self._fdr,
+                    screening_recall=self._screening_recall,
+                    top_k=self._top_k,
+                    index_dir=self._index_dir,
+                    executor=executor,
+                    progress=(
+                        partial(_print_progress, response_format=self._response_format)
+                        if self._progressive else None
+                    ),
+                    preview=self._preview,
+                    cutoff_confidence=self._cutoff_confidence,
+                )
+            _print_json_response(
+                network, self._progressive, self._response_format,
+                self._previous_response,
             )
-            _print_json_response(network)
             self._write_sample_graphs(network)
-            _write_matrix_intermediates(network, self._output_dir)
-            _write_percentile_values(network, self._output_dir)
-            _write_significant_cors(network, self._output_dir)
+            _write_matrix_intermediates(network, self._output_dir, self._writer)
+            _write_percentile_values(network, self._output_dir, self._writer)
+            _write_significant_cors(network, self._output_dir, self._writer)
+            if self._write_sqlite:
+                _write_sqlite(network, self._output_dir)
         except BrokenPipeError:
             # Broken pipe error tends to happen when our Cytoscape app stops
             # reading stdout/stderr. Sometimes this exits as 1, sometimes as
@@ -91,13 +133,17 @@ class App:
 
         # If file names are not unique across matrices, it's up to the user to
         # rename them to be unique
-        # TODO support non-csv formats too
-        self._expression_matrices = []
-        for matrix in args['expression_matrices']:
-            matrix = Path(matrix)
-            matrix = ExpressionMatrix.from_csv(matrix.name, parse_csv(matrix))
-            self._expression_matrices.append(matrix)
-        _validate_matrices(self._baits, self._expression_matrices)
+        #
+        # Matrices are read while create_network correlates the previous one
+        paths = [Path(matrix) for matrix in args['expression_matrices']]
+        _check_hdf5_support(paths)
+        # Keep the matrices sparse to save memory on data with many zeros,
+        # Matrix Market files are always read sparse
+        sparse = args.get('sparse', False)
+        self._expression_matrices = _read_matrices(
+            paths, _MatrixValidator(self._baits), _parse_columns(args, paths),
+            sparse,
+        )
 
         gene_families = args.get('gene_families', None)
         if gene_families:
@@ -105,25 +151,144 @@ class App:
         else:
             self._gene_families = pd.DataFrame(columns=('family', 'gene'))
 
-        self._percentiles = _parse_percentiles(args)
-        logging.info(f'percentiles: {self._percentiles}')
+        # When given, these override the percentiles
+        self._max_cor_edges = _parse_max_size(args, 'max_cor_edges')
+        self._max_non_bait_nodes = _parse_max_size(args, 'max_non_bait_nodes')
+
+        # With top_k or an fdr, significance no longer depends on percentiles
+        self._top_k = _parse_top_k(args)
+        self._fdr = _parse_fdr(args)
+        if self._top_k is None and self._fdr is None:
+            self._percentiles = _parse_percentiles(
+                args,
+                required=self._max_cor_edges is None and self._max_non_bait_nodes is None,
+            )
+            logging.info(f'percentiles: {self._percentiles}')
+        else:
+            self._percentiles = None
+            logging.info(f'top_k: {self._top_k}, fdr: {self._fdr}')
+        index_dir = args.get('index_dir', None)
+        self._index_dir = Path(index_dir) if index_dir else None
+        if self._index_dir:
+            self._index_dir.mkdir(parents=True, exist_ok=True)
+
+        self._correlation_method = _parse_correlation_method(args)
+        logging.info(f'correlation method: {self._correlation_method}')
+
+        # The dense sample matrix is only needed to write it to a file
+        self._write_sample_matrix = args.get('write_sample_matrix', False)
+
+        self._threads = _parse_threads(args)
+
+        self._max_homology_clique_size = _parse_max_homology_clique_size(args)
+
+        if self._fdr is not None and (
+            self._max_cor_edges is not None or self._max_non_bait_nodes is not None
+        ):
+            raise UserError(
+                'fdr cannot be combined with max_cor_edges or max_non_bait_nodes'
+            )
+
+        self._screening_recall = _parse_screening_recall(args)
+        if self._top_k is not None and any(
+            option is not None for option in (
+                self._fdr, self._max_cor_edges, self._max_non_bait_nodes,
+                self._screening_recall,
+            )
+        ):
+            raise UserError(join_lines(
+                '''
+                top_k cannot be combined with fdr, max_cor_edges,
+                max_non_bait_nodes or screening_recall
+                '''
+            ))
+        if self._top_k is not None and self._correlation_method != 'pearson':
+            raise UserError(join_lines(
+                f'''
+                top_k only works with the pearson correlation method. Got:
+                {self._correlation_method}
+                '''
+            ))
+        if self._screening_recall is not None and (
+            self._percentiles is None or self._max_cor_edges is not None
+            or self._max_non_bait_nodes is not None
+        ):
+            raise UserError(join_lines(
+                '''
+                screening_recall cannot be combined with fdr, max_cor_edges or
+                max_non_bait_nodes
+                '''
+            ))
+
+        # Bootstrap confidence intervals of the cutoffs estimated from the
+        # percentiles, optionally growing the sample until they are narrow
+        self._cutoff_confidence = _parse_cutoff_confidence(args)
+        if self._cutoff_confidence is not None and (
+            self._percentiles is None or self._max_cor_edges is not None
+            or self._max_non_bait_nodes is not None
+        ):
+            raise UserError(join_lines(
+                '''
+                cutoff_confidence and cutoff_tolerance cannot be combined with
+                top_k, fdr, max_cor_edges or max_non_bait_nodes
+                '''
+            ))
+
+        # Correlate on a pool of processes instead of on threads
+        self._processes = _parse_processes(args)
+        if self._processes is not None and (
+            self._percentiles is None or self._max_cor_edges is not None
+            or self._max_non_bait_nodes is not None
+            or self._screening_recall is not None
+        ):
+            raise UserError(join_lines(
+                '''
+                processes cannot be combined with top_k, fdr, max_cor_edges,
+                max_non_bait_nodes or screening_recall
+                '''
+            ))
+
+        self._writer = _parse_table_writer(args)
+
+        # A database of all output, for querying parts of the network
+        self._write_sqlite = args.get('write_sqlite', False)
+
+        # Print progress and the network of each matrix as soon as it is
+        # correlated, as lines of JSON
+        self._progressive = args.get('progressive', False)
+
+        # Layout of the JSON network on stdout
+        self._response_format = _parse_response_format(args)
+
+        # Print only the changes since the network of a previous response
+        self._previous_response = _parse_previous_response(args)
+        if self._previous_response is not None and self._response_format != 'records':
+            raise UserError(
+                'previous_response can only be combined with the records response format'
+            )
+
+        self._preview = _parse_preview(args)
+        if self._preview:
+            logging.warning('Preview: the network is approximate')
+
+    def _create_executor(self):
+        if self._processes is None:
+            return nullcontext()
+        return ProcessPoolExecutor(max_workers=self._processes)
 
     def _write_sample_graphs(self, network):
         for info in network.matrix_infos:
+            if info.sample is None:
+                continue
             name = info.matrix.name
-            sample_size = len(info.sample.index)
-
-            flat_sample = info.sample.values.copy()
-            # Ignore self correlations
-            np.fill_diagonal(flat_sample, np.nan)
-            # Flatten to a 1D array
-            flat_sample = flat_sample[~np.isnan(flat_sample)].ravel()
-
+            histogram = info.sample.histogram()
             _write_sample_histogram(
-                name, flat_sample, sample_size, self._output_dir, info.percentile_values
+                name, histogram, info.sample.size, self._output_dir,
+                info.percentile_values, self._correlation_method,
             )
             _write_sample_cdf(
-                name, flat_sample, sample_size, self._output_dir, self._percentiles
+                name, histogram, info.sample.size, self._output_dir,
+                info.percentiles, self._correlation_method,
             )
 
 
@@ -145,9 +310,24 @@ def _parse_json_baits(args):
             raise UserError(f'Need at least 2 baits, but got only {len(baits)}')
     return pd.Series(baits)
 
-def _parse_percentiles(args):
-    lower_percentile = args['lower_percentile']
-    upper_percentile = args['upper_percentile']
+def _parse_percentiles(args, required=True):
+    '''
+    Parse the lower and upper percentile
+
+    When not `required`, missing percentiles default to (5, 95). A max network
+    size overrides the percentiles, but they still determine the sample.
+    '''
+    lower_percentile = args.get('lower_percentile', None)
+    upper_percentile = args.get('upper_percentile', None)
+    if lower_percentile is None and upper_percentile is None and not required:
+        return np.array([5, 95])
+    if lower_percentile is None or upper_percentile is None:
+        raise UserError(join_lines(
+            '''
+            lower_percentile and upper_percentile are required unless top_k,
+            fdr, max_cor_edges or max_non_bait_nodes is given
+            '''
+        ))
     if lower_percentile < 0:
         raise UserError(
             f'Lower percentile must be at least 0. Got: {lower_percentile}'
@@ -165,38 +345,441 @@ def _parse_percentiles(args):
         ))
     return np.array([lower_percentile, upper_percentile])
 
-def _validate_matrices(baits, matrices):
-    if not matrices:
+def _parse_top_k(args):
+    top_k = args.get('top_k', None)
+    if top_k is not None and (not isinstance(top_k, int) or top_k < 1):
+        raise UserError(f'top_k must be a positive integer. Got: {top_k}')
+    return top_k
+
+def _parse_fdr(args):
+    fdr = args.get('fdr', None)
+    if fdr is not None and (
+        isinstance(fdr, bool) or not isinstance(fdr, (int, float))
+        or not 0 < fdr < 1
+    ):
+        raise UserError(f'fdr must be a number in (0, 1). Got: {fdr}')
+    return fdr
+
+def _parse_screening_recall(args):
+    recall = args.get('screening_recall', None)
+    if recall is not None and (
+        isinstance(recall, bool) or not isinstance(recall, (int, float))
+        or not 0 < recall < 1
+    ):
+        raise UserError(
+            f'screening_recall must be a number in (0, 1). Got: {recall}'
+        )
+    return recall
+
+def _parse_cutoff_confidence(args):
+    level = args.get('cutoff_confidence', None)
+    tolerance = args.get('cutoff_tolerance', None)
+    if level is None and tolerance is None:
+        return None
+    if level is not None and (
+        isinstance(level, bool) or not isinstance(level, (int, float))
+        or not 0 < level < 1
+    ):
+        raise UserError(f'cutoff_confidence must be a number in (0, 1). Got: {level}')
+    if tolerance is not None and (
+        isinstance(tolerance, bool) or not isinstance(tolerance, (int, float))
+        or tolerance <= 0
+    ):
+        raise UserError(
+            f'cutoff_tolerance must be a positive number. Got: {tolerance}'
+        )
+    if level is None:
+        return CutoffConfidence(tolerance=tolerance)
+    return CutoffConfidence(level, tolerance)
+
+def _parse_correlation_method(args):
+    correlation_method = args.get('correlation_method', 'pearson')
+    if correlation_method not in correlation_methods:
+        raise UserError(join_lines(
+            f'''
+            Correlation method must be one of {', '.join(correlation_methods)}.
+            Got: {correlation_method}
+            '''
+        ))
+    return correlation_method
+
+def _parse_threads(args):
+    threads = args.get('threads', None)
+    if threads is not None and (not isinstance(threads, int) or threads < 1):
+        raise UserError(f'Threads must be a positive integer. Got: {threads}')
+    return threads
+
+def _parse_response_format(args):
+    response_format = args.get('response_format', 'records')
+    if response_format not in response_formats:
+        raise UserError(join_lines(
+            f'''
+            Response format must be one of {', '.join(response_formats)}.
+            Got: {response_format}
+            '''
+        ))
+    return response_format
+
+def _parse_previous_response(args):
+    '''
+    Read the network of a previous response in the records format
+
+    The file has the JSON printed to stdout by a previous run. Of progressive
+    output, the network is on the last line.
+    '''
+    path = args.get('previous_response', None)
+    if path is None:
+        return None
+    try:
+        text = Path(path).read_text().strip()
+    except OSError as ex:
+        raise UserError(f'Could not read previous response: {ex}') from ex
+    try:
+        try:
+            response = json.loads(text)
+        except json.JSONDecodeError:
+            # Progressive output, a JSON object per line
+            response = json.loads(text.splitlines()[-1] if text else text)
+    except json.JSONDecodeError as ex:
+        raise UserError(f'Previous response is not valid JSON: {path}') from ex
+    if not isinstance(response, dict) or 'nodes' not in response:
+        raise UserError(f'Previous response has no network: {path}')
+    if not isinstance(response['nodes'], list):
+        raise UserError(join_lines(
+            f'''
+            Previous response must be in the records format, got the
+            {response.get('format', None)} format: {path}
+            '''
+        ))
+    return response
+
+def _parse_preview(args):
+    preview = args.get('preview', None)
+    if preview is None:
+        return None
+    if not isinstance(preview, dict) or set(preview) - set(attr.fields_dict(Preview)):
+        raise UserError(join_lines(
+            f'''
+            Preview must be an object with optional max_columns, max_genes and
+            column_selection. Got: {preview}
+            '''
+        ))
+    for key in ('max_columns', 'max_genes'):
+        value = preview.get(key, None)
+        if value is not None and (not isinstance(value, int) or value < 1):
+            raise UserError(
+                f'Preview {key} must be a positive integer. Got: {value}'
+            )
+    column_selection = preview.get('column_selection', 'variance')
+    if column_selection not in Preview.column_selections:
+        raise UserError(join_lines(
+            f'''
+            Preview column_selection must be one of
+            {', '.join(Preview.column_selections)}. Got: {column_selection}
+            '''
+        ))
+    return Preview(**preview)
+
+def _parse_columns(args, paths):
+    '''
+    Parse the columns to select of each matrix
+
+    columns maps matrix names to either a list of column names or a regex
+    string; a column is selected when the regex matches part of its name.
+    '''
+    columns = args.get('columns', None) or {}
+    if not isinstance(columns, dict):
+        raise UserError(
+            f'columns must map matrix names to columns. Got: {columns}'
+        )
+    unknown = sorted(set(columns) - {path.name for path in paths})
+    if unknown:
         raise UserError(join_lines(
             f'''
-            Must provide at least one expression matrix, got:
-            {matrices}
+            columns has selections for matrices which are not in
+            expression_matrices: {', '.join(unknown)}
             '''
         ))
-    names = [matrix.name for matrix in matrices]
-    if len(matrices) != len(set(names)):
+    selections = {}
+    for name, selection in columns.items():
+        if isinstance(selection, str):
+            try:
+                selections[name] = re.compile(selection)
+            except re.error as ex:
+                raise UserError(
+                    f'Invalid columns regex of {name}: {selection}. {ex}'
+                ) from ex
+        elif isinstance(selection, list) and all(isinstance(x, str) for x in selection):
+            selections[name] = selection
+        else:
+            raise UserError(join_lines(
+                f'''
+                columns of {name} must be a list of column names or a regex.
+                Got: {selection}
+                '''
+            ))
+    return selections
+
+def _parse_processes(args):
+    processes = args.get('processes', None)
+    if processes is not None and (not isinstance(processes, int) or processes < 1):
+        raise UserError(f'Processes must be a positive integer. Got: {processes}')
+    return processes
+
+def _parse_max_homology_clique_size(args):
+    max_size = args.get('max_homology_clique_size', None)
+    if max_size is not None and (not isinstance(max_size, int) or max_size < 1):
         raise UserError(
-            f'Expression matrices must have unique name, got: {sorted(names)}'
+            f'Max homology clique size must be a positive integer. Got: {max_size}'
         )
+    return max_size
 
-    # Check each bait occurs in exactly one matrix
-    bait_presence = np.array([
-        bait in matrix.data.index
-        for matrix, bait in product(matrices, baits)
-    ])
-    bait_presence = bait_presence.reshape(len(matrices), len(baits))
-    missing_bait_matrix = pd.DataFrame(
-        bait_presence,
-        index=matrices,
-        columns=baits
-    )
-    missing_bait_matrix = missing_bait_matrix.loc[:,bait_presence.sum(axis=0) != 1]
-    # pylint: disable=trailing-whitespace
-    if not missing_bait_matrix.empty:
+def _parse_max_size(args, key):
+    max_size = args.get(key, None)
+    if max_size is not None and (not isinstance(max_size, int) or max_size < 0):
+        raise UserError(f'{key} must be a non-negative integer. Got: {max_size}')
+    return max_size
+
+def _parse_table_writer(args):
+    float_precision = args.get('float_precision', None)
+    if float_precision is not None and (
+        not isinstance(float_precision, int) or float_precision < 0
+    ):
+        raise UserError(
+            f'Float precision must be a non-negative integer. Got: {float_precision}'
+        )
+    compression = args.get('compression', None)
+    if compression not in compressions:
+        raise UserError(join_lines(
+            f'''
+            Compression must be one of {', '.join(map(str, compressions))}.
+            Got: {compression}
+            '''
+        ))
+    if compression == 'zstd' and not zstandard:
+        raise UserError(
+            'zstd compression requires the zstandard package, please install it'
+        )
+    return TableWriter(float_precision, compression)
+
+def _read_matrices(paths, validator, column_selections=None, sparse=False):
+    '''
+    Read expression matrices in a background thread
+
+    Yields each matrix once it has been read and validated, while the next
+    matrix is being read. At most 1 read matrix waits to be yielded.
+    Validation which needs all matrices happens after yielding the last one.
+
+    column_selections maps matrix names to the columns to select, see
+    `_parse_columns`; other matrices keep all their columns. If sparse, the
+    data of each matrix is read into a sparse data frame, see `_read_matrix`.
+    '''
+    column_selections = column_selections or {}
+    queue = Queue(maxsize=1)
+    done = object()
+
+    def read():
+        try:
+            for path in paths:
+                queue.put(_read_matrix(
+                    path, column_selections.get(path.name, None), sparse
+                ))
+        except Exception as ex:  # pylint: disable=broad-except
+            queue.put(ex)
+        queue.put(done)
+
+    # Daemon as it may remain blocked on a full queue when we stop reading
+    # due to an exception
+    Thread(target=read, daemon=True).start()
+    while True:
+        matrix = queue.get()
+        if matrix is done:
+            break
+        if isinstance(matrix, Exception):
+            raise matrix
+        validator.add(matrix)
+        yield matrix
+    validator.finish()
+
+def _check_hdf5_support(paths):
+    hdf5_paths = [str(path) for path in paths if path.suffix in hdf5_suffixes]
+    if hdf5_paths and not h5py:
+        raise UserError(join_lines(
+            f'''
+            Reading {', '.join(hdf5_paths)} requires the h5py package, please
+            install it
+            '''
+        ))
+
+def _read_matrix(path, selection, sparse=False):
+    '''
+    Read expression matrix from a CSV, AnnData, loom or Matrix Market file
+
+    Of HDF5 files only the selected columns are read, of other files the
+    selection is made after reading.
+
+    Matrix Market files and sparse AnnData are always read sparse. If sparse,
+    CSV files are read sparse a chunk at a time and dense HDF5 files are
+    made sparse after reading.
+    '''
+    select_columns = None
+    if selection is not None:
+        def select_columns(columns):
+            return _column_positions(
+                f'expression matrix {path.name}', columns, selection
+            )
+    if path.suffix in hdf5_suffixes:
+        matrix = read_hdf5_matrix(path, select_columns)
+        if sparse and not is_sparse(matrix.data):
+            matrix = ExpressionMatrix(
+                matrix.name, matrix.data.astype(pd.SparseDtype(float, 0))
+            )
+        return matrix
+    if is_mtx(path):
+        return read_mtx_matrix(path, select_columns)
+    if sparse:
+        return read_sparse_csv_matrix(path, select_columns)
+    matrix = ExpressionMatrix.from_csv(path.name, parse_csv(path))
+    if selection is not None:
+        matrix = _select_columns(matrix, selection)
+    return matrix
+
+def _column_positions(matrix_description, columns, selection):
+    '''
+    Get the sorted positions of the columns selected by a list of names or a
+    compiled regex
+    '''
+    if isinstance(selection, list):
+        missing = sorted(set(selection) - set(columns))
+        if missing:
+            raise UserError(join_lines(
+                f'''
+                Cannot select columns of {matrix_description} which it does not
+                have: {', '.join(missing)}
+                '''
+            ))
+        positions = np.flatnonzero(columns.isin(selection))
+    else:
+        positions = np.flatnonzero([
+            selection.search(str(column)) is not None for column in columns
+        ])
+    if len(positions) < 2:
+        raise UserError(join_lines(
+            f'''
+            Need at least 2 columns to correlate genes but selected
+            {len(positions)} columns of {matrix_description}
+            '''
+        ))
+    return positions
+
+def _select_columns(matrix, selection):
+    '''
+    Select columns of a matrix by a list of names or a compiled regex
+
+    Columns keep their order in the matrix. A contiguous selection, such as
+    the conditions of one experiment, is a view on the data rather than a
+    copy.
+    '''
+    columns = matrix.data.columns
+    positions = _column_positions(str(matrix), columns, selection)
+    if len(positions) == len(columns):
+        return matrix
+
+    start = positions[0]
+    stop = positions[-1] + 1
+    if stop - start == len(positions):
+        data = matrix.data.iloc[:, start:stop]
+    else:
+        data = matrix.data.iloc[:, positions]
+    logging.info(f'Selected {len(positions)} of {len(columns)} columns of {matrix}')
+    return ExpressionMatrix(matrix.name, data)
+
+def _validate_matrices(baits, matrices):
+    validator = _MatrixValidator(baits)
+    for matrix in matrices:
+        validator.add(matrix)
+    validator.finish()
+
+class _MatrixValidator:
+
+    '''
+    Validate expression matrices one at a time
+
+    Each matrix is checked as soon as it is added, against the matrices added
+    before it. Checks which need all matrices are done by `finish`.
+    '''
+
+    def __init__(self, baits):
+        self._baits = baits
+        self._matrices = []
+        self._genes = pd.Index([], dtype=object)
+        self._bait_presence = np.empty((0, len(baits)), dtype=bool)
+
+    def add(self, matrix):
+        names = [matrix_.name for matrix_ in self._matrices]
+        if matrix.name in names:
+            raise UserError(
+                f'Expression matrices must have unique name, got: {sorted(names + [matrix.name])}'
+            )
+        self._matrices.append(matrix)
+
+        # Check no bait occurs in multiple matrices
+        bait_presence = self._baits.isin(matrix.data.index).values
+        self._bait_presence = np.vstack((self._bait_presence, bait_presence))
+        if (self._bait_presence.sum(axis=0) > 1).any():
+            self._raise_bait_presence()
+
+        # and the matrix has at least one bait
+        if not bait_presence.any():
+            raise UserError(join_lines(
+                f'''
+                Some expression matrices have no baits: {matrix}. Each
+                expression matrix must contain at least one bait. Either drop
+                the matrices or add some of their genes to the baits list.
+                '''
+            ))
+
+        # Check the matrix does not overlap the others (same gene in multiple
+        # matrices)
+        genes = matrix.data.index
+        overlapping_genes = genes[genes.isin(self._genes)]
+        if not overlapping_genes.empty:
+            raise UserError(join_lines(
+                f'''
+                The following genes appear in multiple expression matrices:
+                {', '.join(overlapping_genes)}. CoExpNetViz does not support
+                gene expression data from different matrices for the same
+                gene. Please remove rows from the given matrices such that no
+                gene appears in multiple matrices.
+                '''
+            ))
+        self._genes = self._genes.append(genes)
+
+    def finish(self):
+        if not self._matrices:
+            raise UserError(join_lines(
+                f'''
+                Must provide at least one expression matrix, got:
+                {self._matrices}
+                '''
+            ))
+
+        # Check each bait occurs in a matrix
+        if (self._bait_presence.sum(axis=0) != 1).any():
+            self._raise_bait_presence()
+
+    def _raise_bait_presence(self):
+        bait_presence = self._bait_presence
+        missing_bait_matrix = pd.DataFrame(
+            bait_presence,
+            index=[matrix.name for matrix in self._matrices],
+            columns=self._baits
+        )
+        missing_bait_matrix = missing_bait_matrix.loc[:,bait_presence.sum(axis=0) != 1]
         missing_bait_matrix = missing_bait_matrix.applymap(lambda x: 'present' if x else 'absent')
-        missing_bait_matrix.index = missing_bait_matrix.index.map(lambda matrix: matrix.name)
         missing_bait_matrix.index.name = 'Matrix name'
         missing_bait_matrix.columns.name = 'Gene name'
+        # pylint: disable=trailing-whitespace
         raise UserError(dedent(
             f'''\
             Each of the following baits is either missing from all or present in
@@ -208,102 +791,245 @@ def _validate_matrices(baits, matrices):
             multiple matrices have multiple "present" values in a column.'''
         ))
 
-    # and each matrix has at least one bait
-    is_baitless = bait_presence.sum(axis=1) == 0
-    if is_baitless.any():
-        matrices = np.array(matrices)[is_baitless]
-        matrices = ', '.join(map(str, matrices))
-        raise UserError(join_lines(
-            f'''
-            Some expression matrices have no baits: {matrices}. Each expression
-            matrix must contain at least one bait. Either drop the matrices or
-            add some of their genes to the baits list.
-            '''
-        ))
+def _print_json_response(network, progressive=False, response_format='records',
+                         previous_response=None):
+    '''
+    Print the network as JSON
 
-    # Check the matrices don't overlap (same gene in multiple matrices)
-    all_genes = pd.Series(sum((list(matrix.data.index) for matrix in matrices), []))
-    overlapping_genes = all_genes[all_genes.duplicated()]
-    if not overlapping_genes.empty:
-        raise UserError(join_lines(
-            f'''
-            The following genes appear in multiple expression matrices:
-            {', '.join(overlapping_genes)}. CoExpNetViz does not support gene
-            expression data from different matrices for the same gene. Please
-            remove rows from the given matrices such that no gene appears in
-            multiple matrices.
-            '''
-        ))
+    When progressive, the network is the last line of JSON after those of
+    `_print_progress`, with a network type.
+
+    Given the network of a previous response, print only the changes since,
+    see `coexpnetviz._delta.network_delta`.
+    '''
+    response = _network_json(network, response_format)
+    if previous_response is not None:
+        response = network_delta(previous_response, response)
+    if progressive:
+        _print_json_line({'type': 'network', **response})
+    else:
+        json.dump(response, sys.stdout)
+
+def _print_progress(event, response_format='records'):
+    'Print progress event of create_network as a line of JSON'
+    if event['type'] == 'matrix':
+        event = {**event, 'network': _network_json(event['network'], response_format)}
+    _print_json_line(event)
+
+def _print_json_line(data):
+    sys.stdout.write(json.dumps(data) + '\n')
+    sys.stdout.flush()
 
-def _print_json_response(network):
+def _network_json(network, response_format='records'):
+    if response_format == 'columnar':
+        return _columnar_network_json(network)
     response = {}
 
     nodes = network.nodes.copy()
     nodes['colour'] = nodes['colour'].apply(lambda x: x.to_hex())
-    # convert frozenset to tuple as json.dump does not support frozenset
-    nodes['genes'] = nodes['genes'].apply(tuple)
+    nodes['genes'] = nodes['id'].map(network.genes())
     response['nodes'] = nodes.to_dict('records')
 
     response['homology_edges'] = network.homology_edges.to_dict('records')
+    # Only present when families were too large to connect all their baits
+    if not network.homology_cliques.empty:
+        response['homology_cliques'] = network.homology_cliques.to_dict('records')
     response['cor_edges'] = network.cor_edges.to_dict('records')
+    # Only present in a preview, whose network is approximate
+    if network.preview is not None:
+        response['preview'] = network.preview.to_dict()
+    return response
 
-    json.dump(response, sys.stdout)
+def _columnar_network_json(network):
+    '''
+    Get the network as a table of parallel arrays per column
 
-def _write_sample_histogram(name, flat_sample, sample_size, output_dir, percentile_values):
+    The columns are those of the records format, but their values are
+    encoded as follows (version 1):
+
+    - Names of genes, families and of nodes are in ``strings``. Columns of
+      names, e.g. the label of each node, have the index into ``strings``
+      instead. A missing family is -1.
+    - Node types are in ``types``, the type column of the nodes indexes it.
+    - Partitions are a table of id and colour. The partition column of the
+      nodes has the index into this table.
+    - Lists per row, e.g. the genes of each node, are flattened into
+      ``values`` with ``offsets``: the values of row i are
+      ``values[offsets[i]:offsets[i+1]]``.
+    '''
+    nodes = network.nodes
+    node_genes = network.node_genes.assign(
+        position=network.node_genes['node'].map(
+            pd.Series(np.arange(len(nodes)), index=nodes['id'])
+        )
+    ).sort_values(['position', 'gene'])
+    cliques = network.homology_cliques
+    strings = pd.unique(np.concatenate([
+        nodes['label'].values, nodes['family'].dropna().values,
+        node_genes['gene'].values, cliques['family'].values,
+    ]))
+
+    def encode(values, categories=strings):
+        return pd.Categorical(values, categories=categories).codes.tolist()
+
+    types, type_codes = _factorize(nodes['type'])
+    partitions, first_nodes = np.unique(nodes['partition_id'].values, return_index=True)
+    response = {
+        'format': 'columnar',
+        'version': _columnar_version,
+        'strings': strings.tolist(),
+        'types': types,
+        'partitions': {
+            'id': partitions.tolist(),
+            'colour': [colour.to_hex() for colour in nodes['colour'].values[first_nodes]],
+        },
+        'nodes': {
+            'id': nodes['id'].tolist(),
+            'label': encode(nodes['label']),
+            'type': type_codes,
+            'family': encode(nodes['family']),
+            'partition': encode(nodes['partition_id'], partitions),
+            'genes': _flattened(
+                node_genes['position'].values, len(nodes), encode(node_genes['gene'])
+            ),
+        },
+        'homology_edges': _columns(network.homology_edges),
+        'cor_edges': _columns(network.cor_edges),
+    }
+    if not cliques.empty:
+        bait_nodes = cliques['bait_nodes']
+        response['homology_cliques'] = {
+            'family': encode(cliques['family']),
+            'bait_nodes': _flattened(
+                np.repeat(np.arange(len(cliques)), bait_nodes.str.len()),
+                len(cliques), [node for nodes_ in bait_nodes for node in nodes_],
+            ),
+        }
+    if network.preview is not None:
+        response['preview'] = network.preview.to_dict()
+    return response
+
+def _factorize(values):
+    codes, uniques = pd.factorize(values, sort=True)
+    return uniques.tolist(), codes.tolist()
+
+def _flattened(rows, row_count, values):
+    'Get offsets and values of a list per row, given the sorted row of each value'
+    offsets = np.searchsorted(rows, np.arange(row_count + 1))
+    return {'offsets': offsets.tolist(), 'values': values}
+
+def _columns(df):
+    return {column: df[column].tolist() for column in df.columns}
+
+def _write_sample_histogram(name, histogram, sample_size, output_dir, percentile_values,
+                            correlation_method):
+    counts, edges = histogram
     plt.clf()
-    pd.Series(flat_sample).plot.hist(bins=60)
+    plt.hist(edges[:-1], edges, weights=counts)
     plt.title(
         f'Correlations between sample of\n'
         f'{sample_size} genes in {name}'
     )
-    plt.xlabel('pearson')
+    plt.xlabel(correlation_method)
     plt.ylabel('frequency')
     plt.axvline(percentile_values[0], **_line_style)
     plt.axvline(percentile_values[1], **_line_style)
     plt.savefig(str(output_dir / f'{name}.sample_histogram.png'))
 
-def _write_sample_cdf(name, flat_sample, sample_size, output_dir, percentiles):
+def _write_sample_cdf(name, histogram, sample_size, output_dir, percentiles,
+                      correlation_method):
+    counts, edges = histogram
     plt.clf()
-    pd.Series(flat_sample).plot.hist(bins=60, cumulative=True, density=True)
+    plt.hist(edges[:-1], edges, weights=counts, cumulative=True, density=True)
     plt.title(
         f'Cumulative distribution of correlations\n'
         f'between sample of {sample_size} genes in '
         f'{name}'
     )
-    plt.xlabel('pearson')
+    plt.xlabel(correlation_method)
     plt.ylabel('Cumulative probability, i.e. $P(cor \\leq x)$')
     plt.axhline(percentiles[0]/100.0, **_line_style)
     plt.axhline(percentiles[1]/100.0, **_line_style)
     plt.savefig(str(output_dir / f'{name}.sample_cdf.png'))
 
-def _write_matrix_intermediates(network, output_dir):
+def _write_matrix_intermediates(network, output_dir, writer):
     for info in network.matrix_infos:
         name = info.matrix.name
 
-        sample = info.sample
-        sample.index.name = None
-        sample_file = str(output_dir / f'{name}.sample_matrix.txt')
-        sample.to_csv(sample_file, sep='\t', na_rep=str(np.nan))
+        sample = info.sample and info.sample.matrix
+        if sample is not None:
+            sample.index.name = None
+            writer.write(sample, output_dir / f'{name}.sample_matrix.txt', index=True)
 
         cor_matrix = info.cor_matrix
-        cor_matrix.index.name = None
-        cor_file = str(output_dir / f'{name}.correlation_matrix.txt')
-        cor_matrix.to_csv(cor_file, sep='\t', na_rep=str(np.nan))
+        if cor_matrix is not None:
+            cor_matrix.index.name = None
+            writer.write(
+                cor_matrix, output_dir / f'{name}.correlation_matrix.txt', index=True
+            )
+
+def _write_percentile_values(network, output_dir, writer):
+    writer.write(_percentile_values(network), output_dir / 'percentile_values.txt')
 
-def _write_percentile_values(network, output_dir):
+def _percentile_values(network):
     data = tuple(
-        (info.matrix.name,) + info.percentile_values
+        (info.matrix.name,) + tuple(info.percentile_values) + tuple(info.percentiles)
         for info in network.matrix_infos
     )
-    percentile_values = pd.DataFrame(data, columns=('expression_matrix', 'lower', 'upper'))
-    percentile_values_file = str(output_dir / 'percentile_values.txt')
-    percentile_values.to_csv(percentile_values_file, sep='\t', na_rep=str(np.nan), index=False)
-
-def _write_significant_cors(network, output_dir):
-    output_file = output_dir / 'significant_correlations.txt'
-    network.significant_cors.to_csv(
-        str(output_file), sep='\t', na_rep=str(np.nan), index=False,
+    columns = (
+        'expression_matrix', 'lower', 'upper', 'lower_percentile', 'upper_percentile'
     )
+    percentile_values = pd.DataFrame(data, columns=columns)
+    if any(info.percentile_value_intervals is not None for info in network.matrix_infos):
+        intervals = np.array([
+            np.full(4, np.nan) if info.percentile_value_intervals is None
+            else np.ravel(info.percentile_value_intervals)
+            for info in network.matrix_infos
+        ])
+        columns = ('lower_ci_low', 'lower_ci_high', 'upper_ci_low', 'upper_ci_high')
+        for column, values in zip(columns, intervals.T):
+            percentile_values[column] = values
+    return percentile_values
+
+def _write_significant_cors(network, output_dir, writer):
+    writer.write(
+        network.significant_cors, output_dir / 'significant_correlations.txt'
+    )
+
+def _write_sqlite(network, output_dir):
+    nodes = network.nodes.copy()
+    nodes['colour'] = nodes['colour'].apply(lambda x: x.to_hex())
+
+    # A row per bait of a clique instead of a tuple of baits
+    cliques = network.homology_cliques.explode('bait_nodes')
+    cliques = cliques.rename(columns={'bait_nodes': 'bait_node'})
+    cliques['bait_node'] = cliques['bait_node'].astype(int)
+
+    tables = {
+        'nodes': nodes,
+        'node_genes': network.node_genes,
+        'cor_edges': network.cor_edges,
+        'homology_edges': network.homology_edges,
+        'homology_cliques': cliques,
+        'significant_correlations': network.significant_cors,
+        'matrix_infos': _percentile_values(network),
+    }
+    indices = (
+        ('nodes', 'id'),
+        ('nodes', 'family'),
+        ('nodes', 'partition_id'),
+        ('node_genes', 'node'),
+        ('node_genes', 'gene'),
+        ('cor_edges', 'bait_node'),
+        ('cor_edges', 'node'),
+        ('homology_edges', 'bait_node1'),
+        ('homology_edges', 'bait_node2'),
+        ('homology_cliques', 'bait_node'),
+        ('significant_correlations', 'gene'),
+        ('significant_correlations', 'bait'),
+    )
+    write_sqlite(tables, output_dir / 'network.sqlite', indices)
+
 def _init_logging(log_file):
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
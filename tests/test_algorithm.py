@@ -21,6 +21,9 @@ Test _algorithm
 Too trivial to test: _create_nodes, _create_network.
 '''
 
+import itertools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
 from unittest.mock import Mock
 import pytest
 
@@ -30,7 +33,8 @@ from varbio import ExpressionMatrix
 import pandas as pd
 import numpy as np
 
-from coexpnetviz._various import RGB
+from coexpnetviz._similarity import is_sparse
+from coexpnetviz._various import RGB, CutoffConfidence, ExpressionMatrixInfo, Preview
 import coexpnetviz._algorithm as alg
 
 
@@ -76,7 +80,10 @@ class TestEstimateCutoffs:
         orig_matrix_df = matrix.data.copy()
         percentiles = np.array([20.0, 80.0])
         orig_percentiles = percentiles.copy()
-        cors, _ = alg._estimate_cutoffs(matrix, percentiles=percentiles)
+        sample, _ = alg._estimate_cutoffs(
+            matrix, percentiles=percentiles, correlation_method='pearson',
+            keep_sample_matrix=True,
+        )
 
         # Input is unchanged
         assert_df_equals(matrix.data, orig_matrix_df)
@@ -89,13 +96,106 @@ class TestEstimateCutoffs:
         assert_df_equals(args[1], matrix.data)
 
         # the actual sample cors are the one returned by pearson
-        assert_df_equals(cors, expected_cors)
+        assert_df_equals(sample.matrix, expected_cors)
+        assert sample.size == 3
 
-        # percentiles are calculated on a triangle minus the diagonal
+        # the sample distribution is the sorted triangle minus the diagonal
+        # and percentiles are calculated on it
+        assert np.allclose(sample.values, np.array([1.0, 2.0, 3.0]))
         args = percentile_mock.call_args.args
         assert np.allclose(args[0], np.array([1.0, 2.0, 3.0]))
         assert np.allclose(args[1], percentiles)
 
+    def test_drop_sample_matrix(self, pearson_df_mock, matrix, expected_cors):
+        'When not asked to keep the sample matrix, only keep the distribution'
+        sample, _ = alg._estimate_cutoffs(
+            matrix, percentiles=np.array([20.0, 80.0]),
+            correlation_method='pearson', keep_sample_matrix=False,
+        )
+        assert sample.matrix is None
+        assert np.allclose(sample.values, np.array([1.0, 2.0, 3.0]))
+
+class TestBootstrapCutoffs:
+
+    @pytest.fixture
+    def matrix(self):
+        random = np.random.RandomState(seed=0)
+        data = random.normal(size=(1000, 5))
+        return ExpressionMatrix(
+            'mat', pd.DataFrame(data, index=[f'gene{i}' for i in range(1000)])
+        )
+
+    def test(self, matrix):
+        'Intervals contain the cutoffs and do not change between runs'
+        sample_matrix = np.corrcoef(matrix.data.values[:300])
+        percentiles = np.array([5.0, 95.0])
+        expected = np.percentile(
+            sample_matrix[np.triu_indices(300, 1)], percentiles, method='inverted_cdf'
+        )
+        confidence = CutoffConfidence(resamples=50)
+        cutoffs, intervals = alg._bootstrap_cutoffs(sample_matrix, percentiles, confidence)
+        np.testing.assert_array_equal(cutoffs, expected)
+        assert intervals.shape == (2, 2)
+        assert (intervals[:, 0] <= cutoffs).all()
+        assert (cutoffs <= intervals[:, 1]).all()
+        assert np.array_equal(
+            intervals, alg._bootstrap_cutoffs(sample_matrix, percentiles, confidence)[1]
+        )
+
+    def test_small_sample(self, matrix):
+        'The cutoffs lie within their intervals, also when they are wide'
+        sample_matrix = np.corrcoef(matrix.data.values[:20])
+        for percentiles in ([5.0, 95.0], [0.0, 100.0], [30.0, 50.0]):
+            cutoffs, intervals = alg._bootstrap_cutoffs(
+                sample_matrix, np.array(percentiles), CutoffConfidence(resamples=200)
+            )
+            assert (intervals[:, 0] <= cutoffs).all()
+            assert (cutoffs <= intervals[:, 1]).all()
+
+    def test_batches(self, monkeypatch, matrix):
+        'Batching the resamples does not change the intervals'
+        sample_matrix = np.corrcoef(matrix.data.values[:50])
+        percentiles = np.array([5.0, 95.0])
+        confidence = CutoffConfidence(resamples=10)
+        expected = alg._bootstrap_cutoffs(sample_matrix, percentiles, confidence)
+        monkeypatch.setattr('coexpnetviz._algorithm._bootstrap_bytes', 3 * 8 * 1225)
+        actual = alg._bootstrap_cutoffs(sample_matrix, percentiles, confidence)
+        np.testing.assert_array_equal(actual[0], expected[0])
+        np.testing.assert_array_equal(actual[1], expected[1])
+
+    def test_narrower_with_lower_level(self, matrix):
+        sample_matrix = np.corrcoef(matrix.data.values[:300])
+        percentiles = np.array([5.0, 95.0])
+        _, wide = alg._bootstrap_cutoffs(
+            sample_matrix, percentiles, CutoffConfidence(.99, resamples=50)
+        )
+        _, narrow = alg._bootstrap_cutoffs(
+            sample_matrix, percentiles, CutoffConfidence(.5, resamples=50)
+        )
+        assert (np.diff(narrow) < np.diff(wide)).all()
+
+    def test_grow_sample(self, monkeypatch, matrix, caplog):
+        'Double the sample size until the tolerance or the max sample size'
+        monkeypatch.setattr('coexpnetviz._algorithm._max_sample_size', 1000)
+        confidence = CutoffConfidence(tolerance=1e-9, resamples=10)
+        sample, cutoffs, intervals = alg._estimate_confident_cutoffs(
+            matrix, np.array([5.0, 95.0]), correlation_method='pearson',
+            keep_sample_matrix=False, cutoff_confidence=confidence,
+        )
+        assert sample.size == 1000
+        assert sample.matrix is None
+        assert (intervals[:, 0] <= cutoffs).all()
+        assert 'wider than the tolerance' in caplog.text
+
+    def test_within_tolerance(self, matrix):
+        confidence = CutoffConfidence(tolerance=1, resamples=10)
+        sample, _, _ = alg._estimate_confident_cutoffs(
+            matrix, np.array([5.0, 95.0]), correlation_method='pearson',
+            keep_sample_matrix=True, cutoff_confidence=confidence,
+        )
+        assert sample.size == 800
+        assert sample.matrix is not None
+
 class TestCorrelateMatrix:
 
     '''
@@ -160,7 +260,8 @@ class TestCorrelateMatrix:
         orig_baits = baits.copy()
         orig_percentiles = percentiles.copy()
         cors, matrix_info = alg._correlate_matrix(
-            matrix, baits, percentiles
+            matrix, baits, percentiles, correlation_method='pearson',
+            keep_sample_matrix=False, threads=1, screening_recall=None,
         )
 
         # Then input unchanged
@@ -177,6 +278,7 @@ class TestCorrelateMatrix:
         # Matrix info is passed on unchanged
         assert_df_equals(matrix_info.cor_matrix, cor_matrix)
         assert np.allclose(matrix_info.percentile_values, cutoffs)
+        assert np.allclose(matrix_info.percentiles, percentiles)
         assert matrix_info.sample == 'sample'
 
         # Insignificant cors have been cut, but only those. And the cors df has
@@ -191,6 +293,270 @@ class TestCorrelateMatrix:
             cors, expected_cors, ignore_indices={0}, ignore_order={0, 1}
         )
 
+@pytest.mark.parametrize('correlation_method', (
+    'pearson', 'spearman', 'biweight_midcorrelation'
+))
+def test_correlate_matrix_sparse(correlation_method):
+    'Sparse data gives the same correlations and cutoffs as dense data'
+    random = np.random.RandomState(seed=0)
+    data = random.poisson(.3, size=(100, 12)).astype(float)
+    data[5] = 0  # no variance
+    data[6] = 4  # no variance either, but not sparse
+    data = pd.DataFrame(data, index=[f'gene{i:02}' for i in range(100)])
+    baits = pd.Series(['gene01', 'gene02', 'gene05'])
+    dense_cors, dense_info = alg._correlate_matrix(
+        ExpressionMatrix('mat', data), baits, (5, 95),
+        correlation_method=correlation_method, keep_sample_matrix=False,
+        threads=1, screening_recall=None,
+    )
+    sparse_data = data.astype(pd.SparseDtype(float, 0))
+    sparse_cors, sparse_info = alg._correlate_matrix(
+        ExpressionMatrix('mat', sparse_data), baits, (5, 95),
+        correlation_method=correlation_method, keep_sample_matrix=False,
+        threads=1, screening_recall=None,
+    )
+    assert_df_equals(sparse_info.cor_matrix, dense_info.cor_matrix, all_close=True)
+    assert np.allclose(sparse_info.percentile_values, dense_info.percentile_values)
+    assert_df_equals(sparse_cors, dense_cors, ignore_indices={0}, all_close=True)
+    assert {'gene05', 'gene06'}.isdisjoint(sparse_info.cor_matrix.index)
+
+def test_correlate_matrix_pairwise_complete():
+    'Missing values only leave out their pairs, also of baits and the sample'
+    random = np.random.RandomState(seed=0)
+    data = random.normal(size=(50, 10))
+    data[random.uniform(size=data.shape) < .1] = np.nan
+    data[1, 0] = np.nan
+    data = pd.DataFrame(data, index=[f'gene{i:02}' for i in range(50)])
+    baits = pd.Series(['gene01', 'gene02'])
+    cors, info = alg._correlate_matrix(
+        ExpressionMatrix('mat', data), baits, (5, 95),
+        correlation_method='pairwise_complete_pearson', keep_sample_matrix=False,
+        threads=1, screening_recall=.9,
+    )
+    expected = data.T.corr().loc[data.index, ['gene01', 'gene02']]
+    assert_df_equals(info.cor_matrix, expected, all_close=True)
+    assert info.sample.values.size == 50 * 49 / 2
+
+class TestUniqueRows:
+
+    def test(self):
+        values = np.array([
+            [1.0, 2, 3],
+            [np.nan, 0, 0],
+            [1.0, 2, 3],
+            [1.0, 2, 4],
+            [np.nan, 0, 0],
+            [1.0, 2, 3],
+        ])
+        first, inverse = alg._unique_rows(values)
+        assert len(first) == 3
+        np.testing.assert_array_equal(values[first][inverse], values)
+        assert inverse[0] == inverse[2] == inverse[5] != inverse[3]
+
+    def test_distinct(self):
+        'None when there are no duplicates, e.g. 0.0 and -0.0 are distinct'
+        assert alg._unique_rows(np.array([[0.0, 1], [-0.0, 1], [1, 0]])) is None
+        assert alg._unique_rows(np.array([[0.0, 1]])) is None
+
+def test_correlate_matrix_duplicates(caplog):
+    'Duplicate rows are correlated once, but each gene still has its correlations'
+    random = np.random.RandomState(seed=0)
+    data = random.normal(size=(30, 6))
+    data[10:20] = data[0]
+    data = pd.DataFrame(data, index=[f'gene{i:02}' for i in range(30)])
+    baits = pd.Series(['gene00', 'gene01'])
+    caplog.set_level('INFO')
+    cors, info = alg._correlate_matrix(
+        ExpressionMatrix('mat', data), baits, (5, 95), correlation_method='pearson',
+        keep_sample_matrix=False, threads=1, screening_recall=None,
+    )
+    expected = alg._correlate_tiled(
+        alg.pearson_df, data, data.loc[['gene00', 'gene01']], 1
+    )
+    assert_df_equals(info.cor_matrix, expected, all_close=True)
+    assert set(cors['gene']) >= {f'gene{i}' for i in range(10, 20)}
+    assert 'compression ratio of 1.50' in caplog.text
+
+class TestCorrelateTiled:
+
+    '''
+    When the matrix is split into multiple tiles, correlate each tile and
+    concat the results in the original order
+    '''
+
+    @pytest.fixture
+    def matrix_df(self):
+        random = np.random.RandomState(seed=0)
+        return pd.DataFrame(
+            random.normal(size=(10, 4)),
+            index=[f'gene{i}' for i in range(10)],
+        )
+
+    @pytest.fixture(autouse=True)
+    def tiny_tiles(self, monkeypatch):
+        'Tiles of 3 rows given 4 columns and 2 baits'
+        monkeypatch.setattr('coexpnetviz._algorithm._tile_bytes', 3 * 6 * 8)
+
+    @pytest.mark.parametrize('threads', (1, 3))
+    def test(self, matrix_df, threads):
+        baits = matrix_df.iloc[[2, 7]]
+        tile_sizes = []
+        def similarity_df(tile, baits):
+            tile_sizes.append(len(tile))
+            return pd.DataFrame(
+                np.outer(tile.sum(axis=1), baits.sum(axis=1)),
+                index=tile.index,
+                columns=baits.index,
+            )
+        actual = alg._correlate_tiled(similarity_df, matrix_df, baits, threads)
+        assert sorted(tile_sizes) == [1, 3, 3, 3]
+        expected = similarity_df(matrix_df, baits)
+        assert_df_equals(actual, expected, all_close=True)
+
+class TestScreenedSimilarity:
+
+    '''
+    Exact correlations of the candidates, which include (nearly) all pairs
+    beyond the cutoffs
+    '''
+
+    @pytest.fixture
+    def matrix_df(self):
+        'Genes of which some correlate strongly to a bait, most do not'
+        random = np.random.RandomState(seed=0)
+        data = random.normal(size=(2000, 300))
+        data[10:40] = data[0] + random.normal(scale=.5, size=(30, 300))
+        data[40:70] = -data[1] + random.normal(scale=.5, size=(30, 300))
+        data[5] = 1.0
+        return pd.DataFrame(data, index=[f'gene{i}' for i in range(2000)])
+
+    @pytest.mark.parametrize('correlation_method', ('pearson', 'spearman'))
+    @pytest.mark.parametrize('recall', (.8, .999))
+    def test(self, matrix_df, correlation_method, recall):
+        baits = matrix_df.iloc[:4]
+        cutoffs = (-.5, .5)
+        similarity_df = alg._screened_similarity(
+            alg.row_transforms[correlation_method], matrix_df, baits, cutoffs, recall
+        )
+        actual = similarity_df(matrix_df, baits)
+        expected = alg._get_similarity_function(correlation_method)(matrix_df, baits)
+
+        # Candidates are exact
+        is_candidate = actual.notna().values
+        np.testing.assert_allclose(
+            actual.values[is_candidate], expected.values[is_candidate]
+        )
+
+        # and contain about the requested recall of the cors beyond the
+        # cutoffs. For a high recall the sample has too few pairs beyond the
+        # cutoffs, so all are included.
+        is_beyond = (expected.abs() >= .5).values
+        actual_recall = (is_candidate & is_beyond).sum() / is_beyond.sum()
+        if recall == .999:
+            assert actual_recall == 1
+        else:
+            assert actual_recall > recall - .1
+
+        # But most pairs are screened out
+        assert is_candidate.mean() < .5
+
+    @pytest.mark.parametrize('pays', (False, True))
+    def test_correlate_matrix(self, monkeypatch, matrix_df, pays):
+        '''
+        _correlate_matrix screens when asked to, if that is cheaper than
+        correlating exactly
+        '''
+        monkeypatch.setattr(
+            'coexpnetviz._algorithm._estimate_cutoffs',
+            Mock(return_value=('sample', np.array([-.5, .5])))
+        )
+        monkeypatch.setattr(
+            'coexpnetviz._algorithm._screening_pays', Mock(return_value=pays)
+        )
+        matrix = ExpressionMatrix('matrix', matrix_df)
+        baits = pd.Series(matrix_df.index[:4])
+        cors, info = alg._correlate_matrix(
+            matrix, baits, [5, 95], correlation_method='pearson',
+            keep_sample_matrix=False, threads=1, screening_recall=.999,
+        )
+        cors_exact, info_exact = alg._correlate_matrix(
+            matrix, baits, [5, 95], correlation_method='pearson',
+            keep_sample_matrix=False, threads=1, screening_recall=None,
+        )
+        assert info.cor_matrix.isna().values.any() == pays
+        assert_df_equals(cors, cors_exact, ignore_indices={0}, all_close=True)
+
+class TestQueryMatrices:
+
+    @pytest.fixture
+    def matrix(self):
+        random = np.random.RandomState(seed=0)
+        data = pd.DataFrame(
+            random.normal(size=(20, 4)), index=[f'gene{i}' for i in range(20)]
+        )
+        data.iloc[1, 2] = np.nan
+        return ExpressionMatrix('matrix', data)
+
+    def test_dropped_baits(self, matrix, caplog):
+        'Warn about baits which get no correlations'
+        baits = pd.Series(['gene0', 'gene1'])
+        cors = alg.create_network(
+            baits, [matrix], pd.DataFrame(columns=['family', 'gene']), top_k=3
+        ).significant_cors
+        assert set(cors['bait']) == {'gene0'}
+        assert 'get no correlations: gene1' in caplog.text
+
+    def test_correlation_method(self, matrix):
+        'top_k is only implemented for pearson'
+        with pytest.raises(ValueError) as ex:
+            alg.create_network(
+                pd.Series(['gene0']), [matrix], pd.DataFrame(columns=['family', 'gene']),
+                correlation_method='spearman', top_k=3,
+            )
+        assert 'top_k only works with the pearson' in str(ex.value)
+
+class TestGetIndex:
+
+    '''
+    Cache an index per matrix data in index_dir
+    '''
+
+    def test(self, monkeypatch, temp_dir_cwd):
+        random = np.random.RandomState(seed=0)
+        data = pd.DataFrame(random.normal(size=(10, 4)), index=list('abcdefghij'))
+        matrix = ExpressionMatrix('matrix', data)
+        index_dir = Path()
+        index = alg._get_index(matrix, index_dir)
+        assert (index_dir / f'matrix.{index.digest}.index.npz').exists()
+
+        from_matrix = Mock(side_effect=alg.CoexpressionIndex.from_matrix)
+        monkeypatch.setattr(alg.CoexpressionIndex, 'from_matrix', from_matrix)
+        assert alg._get_index(matrix, index_dir).digest == index.digest
+        from_matrix.assert_not_called()
+
+        data = data.copy()
+        data.iloc[0, 0] += 1
+        changed_matrix = ExpressionMatrix('matrix', data)
+        assert alg._get_index(changed_matrix, index_dir).digest != index.digest
+        from_matrix.assert_called_once_with(changed_matrix)
+
+    def test_column_selections(self, monkeypatch, temp_dir_cwd):
+        'Switching between selections of columns does not rebuild'
+        random = np.random.RandomState(seed=0)
+        data = pd.DataFrame(random.normal(size=(10, 4)), index=list('abcdefghij'))
+        selections = [
+            ExpressionMatrix('matrix', data.iloc[:, columns])
+            for columns in ([0, 1, 2], [1, 2, 3])
+        ]
+        digests = [alg._get_index(matrix, Path()).digest for matrix in selections]
+        assert digests[0] != digests[1]
+
+        from_matrix = Mock(side_effect=alg.CoexpressionIndex.from_matrix)
+        monkeypatch.setattr(alg.CoexpressionIndex, 'from_matrix', from_matrix)
+        for matrix, digest in zip(selections, digests):
+            assert alg._get_index(matrix, Path()).digest == digest
+        from_matrix.assert_not_called()
+
 class TestCorrelateMatrices:
 
     '''
@@ -219,7 +585,11 @@ class TestCorrelateMatrices:
 
     def test(self, correlate_matrix_mock):
         # These args are invalid but is fine for this test as we mock _correlate_matrix
-        cors, matrix_infos = alg._correlate_matrices([1, 2], None, None)
+        cors, matrix_infos = alg._correlate_matrices(
+            [1, 2], None, None, correlation_method=None, keep_sample_matrix=None,
+            threads=None, max_cor_edges=None, max_non_bait_nodes=None, fdr=None,
+            screening_recall=None, executor=None, on_matrix=Mock(),
+        )
 
         # Then cors is concatenation of the cors of each matrix with self
         # comparisons and symmetrical cors dropped (i.e. only return
@@ -235,6 +605,321 @@ class TestCorrelateMatrices:
         # instead of MatrixInfo)
         assert matrix_infos == (3, 4)
 
+class TestCorrelateMatricesSharded:
+
+    '''
+    Same correlations as without sharding, in the same order
+    '''
+
+    @pytest.fixture
+    def matrices(self):
+        random = np.random.RandomState(seed=0)
+        return [
+            ExpressionMatrix(f'matrix{i}', pd.DataFrame(
+                random.normal(size=(200, 6)),
+                index=[f'gene{i}_{j}' for j in range(200)],
+            ))
+            for i in range(2)
+        ]
+
+    @pytest.fixture
+    def baits(self):
+        return pd.Series(['gene0_3', 'gene0_150', 'gene1_7'])
+
+    @pytest.fixture(autouse=True)
+    def tiny_shards(self, monkeypatch):
+        'Shards of 2 tiles of 5 rows'
+        monkeypatch.setattr('coexpnetviz._algorithm._tile_bytes', 5 * 8 * 8)
+        monkeypatch.setattr('coexpnetviz._algorithm._shard_tiles', 2)
+
+    @pytest.mark.parametrize('executor_type', (ThreadPoolExecutor, ProcessPoolExecutor))
+    def test(self, matrices, baits, executor_type):
+        expected = [
+            alg._correlate_matrix(
+                matrix, baits, (5, 95), correlation_method='pearson',
+                keep_sample_matrix=False, threads=1, screening_recall=None,
+            )
+            for matrix in matrices
+        ]
+        with executor_type(max_workers=2) as executor:
+            actual = list(alg._correlate_matrices_sharded(
+                matrices, baits, (5, 95), correlation_method='pearson',
+                keep_sample_matrix=False, executor=executor,
+            ))
+        for (cors, info), (expected_cors, expected_info) in zip(actual, expected):
+            assert_df_equals(cors, expected_cors, ignore_indices={0})
+            assert info.cor_matrix is None
+            assert info.percentile_values == expected_info.percentile_values
+            assert info.percentiles == expected_info.percentiles
+
+class TestProgress:
+
+    '''
+    Report each stage and the network of each matrix when its cors are final
+    '''
+
+    @pytest.fixture
+    def matrices(self):
+        random = np.random.RandomState(seed=0)
+        return [
+            ExpressionMatrix(f'matrix{i}', pd.DataFrame(
+                random.normal(size=(20, 6)),
+                index=[f'gene{i}_{j}' for j in range(20)],
+            ))
+            for i in range(2)
+        ]
+
+    @pytest.fixture
+    def baits(self):
+        return pd.Series(['gene0_3', 'gene1_7'])
+
+    @pytest.fixture
+    def gene_families(self):
+        return pd.DataFrame({'family': ['fam', 'fam'], 'gene': ['gene0_1', 'gene1_1']})
+
+    def test(self, matrices, baits, gene_families):
+        events = []
+        network = alg.create_network(
+            baits, matrices, gene_families, progress=events.append
+        )
+        stages = [
+            (event['type'], event.get('stage'), event.get('expression_matrix'))
+            for event in events
+        ]
+        assert stages == [
+            ('progress', 'correlate', 'matrix0'),
+            ('matrix', None, 'matrix0'),
+            ('progress', 'correlate', 'matrix1'),
+            ('matrix', None, 'matrix1'),
+            ('progress', 'nodes', None),
+            ('progress', 'homology_edges', None),
+            ('progress', 'cor_edges', None),
+        ]
+        assert all(event['seconds'] >= 0 for event in events if 'seconds' in event)
+
+        # The cors of the matrix networks make up those of the final network
+        matrix_cors = pd.concat([
+            event['network'].significant_cors
+            for event in events if event['type'] == 'matrix'
+        ])
+        assert_df_equals(matrix_cors, network.significant_cors, ignore_indices={0})
+        assert events[1]['network'].matrix_infos == network.matrix_infos[:1]
+
+    def test_not_final(self, matrices, baits, gene_families):
+        'With an fdr, the cors of a matrix are not final until all are correlated'
+        events = []
+        alg.create_network(
+            baits, matrices, gene_families, fdr=.5, progress=events.append
+        )
+        assert [event['type'] for event in events] == ['progress'] * 5
+
+class TestPreviewMatrix:
+
+    @pytest.fixture
+    def matrix(self):
+        return ExpressionMatrix('matrix', pd.DataFrame(
+            [
+                [0, 0, 0, 0],  # bait, no variance
+                [1, 1, 5, 1],
+                [1, 2, 1, 2],
+                [1, 1, 9, 1],
+            ],
+            index=['bait', 'gene1', 'gene2', 'gene3'],
+            columns=['c1', 'c2', 'c3', 'c4'],
+            dtype=float,
+        ))
+
+    def test_variance(self, matrix):
+        'Keep the columns which deviate most and the genes which vary most'
+        preview = Preview(max_columns=2, max_genes=1)
+        data = alg._preview_matrix(matrix, pd.Series(['bait']), preview).data
+        assert list(data.columns) == ['c1', 'c3']
+        assert list(data.index) == ['bait', 'gene3']
+
+    def test_sparse(self, matrix):
+        'Same preview of a sparse matrix, which stays sparse'
+        sparse_matrix = ExpressionMatrix(
+            'matrix', matrix.data.astype(pd.SparseDtype(float, 0))
+        )
+        preview = Preview(max_columns=2, max_genes=1)
+        data = alg._preview_matrix(sparse_matrix, pd.Series(['bait']), preview).data
+        assert is_sparse(data)
+        assert list(data.columns) == ['c1', 'c3']
+        assert list(data.index) == ['bait', 'gene3']
+
+    def test_column_deviations_sparse(self):
+        random = np.random.RandomState(seed=0)
+        data = pd.DataFrame(random.poisson(.3, size=(50, 8)).astype(float))
+        assert np.allclose(
+            alg._column_deviations(data.astype(pd.SparseDtype(float, 0))),
+            alg._column_deviations(data),
+        )
+
+    def test_random(self, matrix):
+        preview = Preview(max_columns=3, column_selection='random')
+        data = alg._preview_matrix(matrix, pd.Series(['bait']), preview).data
+        assert data.shape == (4, 3)
+        assert list(data.columns) == sorted(data.columns)
+
+    def test_create_network(self, matrix):
+        'The network remembers it is a preview'
+        preview = Preview(max_genes=2)
+        network = alg.create_network(
+            pd.Series(['gene1']), [matrix], pd.DataFrame(columns=['family', 'gene']),
+            preview=preview,
+        )
+        assert network.preview == preview
+        assert set(network.significant_cors['gene']) <= {'gene1', 'gene2', 'gene3'}
+
+class TestSolveCutoffs:
+
+    '''
+    Cutoffs for a network size, counting correlations like
+    _correlate_matrices does
+    '''
+
+    @pytest.fixture
+    def matrix_infos(self):
+        cor_matrix1 = pd.DataFrame(
+            [[1.0, -.9],
+             [-.9, 1.0],
+             [.5, -.8],
+             [.7, .2]],
+            index=['bait1', 'bait2', 'gene1', 'gene2'],
+            columns=['bait1', 'bait2'],
+        )
+        cor_matrix2 = pd.DataFrame(
+            [[1.0],
+             [-.6]],
+            index=['bait3', 'gene3'],
+            columns=['bait3'],
+        )
+        return tuple(
+            ExpressionMatrixInfo(None, None, None, cor_matrix, None)
+            for cor_matrix in (cor_matrix1, cor_matrix2)
+        )
+
+    @pytest.fixture
+    def baits(self):
+        return pd.Series(['bait1', 'bait2', 'bait3'])
+
+    @pytest.mark.parametrize('max_cor_edges, expected', (
+        # bait pairs only count once, so the 2 largest are -.9 and -.8 and the
+        # cutoff lies just above the next one
+        (2, .7),
+        (3, .6),
+        # more than all pairs: everything
+        (10, 0.0),
+        (0, .9),
+    ))
+    def test_max_cor_edges(self, matrix_infos, baits, max_cor_edges, expected):
+        lower, upper = alg._solve_cutoffs(matrix_infos, baits, max_cor_edges, None)
+        assert np.isclose(upper, expected)
+        assert lower == -upper
+
+        # Exclude ties with the largest excluded correlation
+        if expected:
+            assert upper > expected
+
+    def test_max_non_bait_nodes(self, matrix_infos, baits):
+        'Genes count by their max correlation: gene1 .8, gene2 .7, gene3 .6'
+        _, upper = alg._solve_cutoffs(matrix_infos, baits, None, 1)
+        assert .7 < upper < .71
+
+    def test_both(self, matrix_infos, baits):
+        'When both limits are given, stay within both'
+        _, upper = alg._solve_cutoffs(matrix_infos, baits, 3, 1)
+        assert .7 < upper < .71
+        _, upper = alg._solve_cutoffs(matrix_infos, baits, 4, 2)
+        assert .6 < upper < .61
+
+class TestFdrCors:
+
+    '''
+    Benjamini-Hochberg over the distinct pairs of all matrices, only
+    calculating p-values of pairs which can be significant
+    '''
+
+    @pytest.fixture
+    def baits(self):
+        return pd.Series(['bait1', 'bait2'])
+
+    @pytest.fixture
+    def matrix_infos(self):
+        random = np.random.RandomState(0)
+        infos = []
+        for i, column_count in enumerate((10, 20)):
+            data = pd.DataFrame(
+                random.rand(30, column_count),
+                index=['bait1', 'bait2'] + [f'gene{i}_{j}' for j in range(28)],
+            )
+            # Make some genes correlate strongly with bait1
+            data.iloc[2:8] = data.iloc[0].values + random.rand(6, column_count) * .2
+            cor_matrix = data.T.corr().loc[:, ['bait1', 'bait2']]
+            matrix = ExpressionMatrix(f'matrix{i}', data)
+            infos.append(ExpressionMatrixInfo(matrix, None, None, cor_matrix, None))
+        return tuple(infos)
+
+    def expected_cors(self, matrix_infos, baits):
+        'Brute force: p-value of each pair, then Benjamini-Hochberg'
+        scipy_stats = pytest.importorskip('scipy.stats')
+        cors = []
+        for info in matrix_infos:
+            cor_matrix = info.cor_matrix
+            mask = alg._distinct_pairs(cor_matrix, baits)
+            cors_ = cor_matrix.where(mask).rename_axis('gene').reset_index()
+            cors_ = cors_.melt(id_vars='gene', var_name='bait', value_name='correlation')
+            cors_ = cors_.dropna()
+            df = info.matrix.data.shape[1] - 2
+            t = cors_['correlation'] * np.sqrt(df / (1 - cors_['correlation']**2))
+            cors_['p_value'] = 2 * scipy_stats.t.sf(np.abs(t), df)
+            cors.append(cors_)
+        cors = pd.concat(cors, ignore_index=True)
+        cors['q_value'] = scipy_stats.false_discovery_control(cors['p_value'])
+        return cors
+
+    @pytest.mark.parametrize('fdr', (.001, .05, .5))
+    def test(self, matrix_infos, baits, fdr):
+        cors, matrix_infos_ = alg._fdr_cors(matrix_infos, baits, fdr)
+        expected = self.expected_cors(matrix_infos, baits)
+        expected = expected[expected['q_value'] <= fdr]
+        assert list(cors.columns) == ['gene', 'bait', 'correlation', 'q_value']
+        actual = cors.set_index(['gene', 'bait']).sort_index()
+        expected = expected.set_index(['gene', 'bait']).sort_index()
+        assert actual.index.equals(expected.index)
+        np.testing.assert_allclose(actual['q_value'], expected['q_value'])
+
+        # The cutoffs are the weakest significant correlation of each matrix
+        for info in matrix_infos_:
+            lower, upper = info.percentile_values
+            is_matrix = cors['gene'].isin(info.matrix.data.index)
+            assert np.isclose(upper, cors.loc[is_matrix, 'correlation'].abs().min())
+            assert lower == -upper
+
+    def test_skip_few_columns(self, matrix_infos, baits):
+        'Pairs of a matrix without p-values do not count as tests'
+        data = pd.DataFrame(
+            [[1, 2], [2, 1], [1, 3]], index=['bait1', 'bait2', 'gene2_0'], dtype=float
+        )
+        cor_matrix = data.T.corr().loc[:, ['bait1', 'bait2']]
+        info = ExpressionMatrixInfo(
+            ExpressionMatrix('matrix2', data), None, None, cor_matrix, None
+        )
+        expected, _ = alg._fdr_cors(matrix_infos, baits, .5)
+        actual, matrix_infos_ = alg._fdr_cors(matrix_infos + (info,), baits, .5)
+        pd.testing.assert_frame_equal(actual, expected)
+        assert np.isnan(matrix_infos_[-1].percentile_values).all()
+
+    @pytest.mark.parametrize('fdr', (0, 1))
+    def test_invalid_fdr(self, fdr):
+        with pytest.raises(ValueError):
+            alg.create_network(pd.Series(), [], pd.DataFrame(), fdr=fdr)
+
+    def test_none_significant(self, matrix_infos, baits):
+        cors, matrix_infos_ = alg._fdr_cors(matrix_infos, baits, 1e-300)
+        assert cors.empty
+        assert all(np.isnan(info.percentile_values).all() for info in matrix_infos_)
+
 class TestCreateBaitNodes:
 
     '''
@@ -264,12 +949,12 @@ class TestCreateBaitNodes:
 
         # and returns a table with family added
         colour = RGB((255, 255, 255))
-        partition = hash(frozenset())
+        partition = 0
         expected = pd.DataFrame(
-            [[frozenset({'bait1'}), 'bait', np.nan, 'bait1', colour, partition],
-             [frozenset({'bait2'}), 'bait', 'fam2', 'bait2', colour, partition]],
+            [['bait1', 'bait', np.nan, colour, partition],
+             ['bait2', 'bait', 'fam2', colour, partition]],
             columns=[
-                'genes', 'type', 'family', 'label', 'colour', 'partition_id'
+                'label', 'type', 'family', 'colour', 'partition_id'
             ],
         )
         assert_df_equals(
@@ -280,7 +965,8 @@ class TestCreateNonBaitNodes:
 
     '''
     Happy days, mostly check for a correct split between family/gene nodes,
-    check families are merged in correctly and baits are ignored.
+    check families are merged in correctly, baits are ignored and nodes are
+    partitioned by the baits they correlate to.
     '''
 
     @pytest.fixture
@@ -291,7 +977,8 @@ class TestCreateNonBaitNodes:
     def gene_families(self):
         return pd.DataFrame(
             [['gene1', 'fam'],
-             ['gene2', 'fam']],
+             ['gene2', 'fam'],
+             ['gene5', 'fam2']],
             columns=['gene', 'family'],
         )
 
@@ -302,6 +989,9 @@ class TestCreateNonBaitNodes:
              ['bait1', 'gene2', 2.0],
              ['bait2', 'gene1', 3.0],
              ['bait2', 'gene3', 4.0],
+             ['bait1', 'gene4', 4.0],
+             ['bait2', 'gene4', 4.0],
+             ['bait1', 'gene5', 4.0],
              ['bait1', 'bait2', 5.0]],
             columns=['bait', 'gene', 'correlation'],
         )
@@ -310,40 +1000,74 @@ class TestCreateNonBaitNodes:
         orig_baits = baits.copy()
         orig_cors = cors.copy()
         orig_gene_families = gene_families.copy()
-        family_nodes, gene_nodes = alg._create_non_bait_nodes(baits, cors, gene_families)
+        nodes, node_genes = alg._create_non_bait_nodes(baits, cors, gene_families)
 
         # Then input unchanged
         assert_series_equals(baits, orig_baits)
         assert_df_equals(cors, orig_cors)
         assert_df_equals(gene_families, orig_gene_families)
 
-        # gene nodes
+        # family nodes come first, then gene nodes
+        partition_ids = nodes.pop('partition_id')
         expected = pd.DataFrame(
-            [[frozenset({'bait2'}), 'gene3', 'gene', frozenset({'gene3'})]],
-            columns=[
-                'baits', 'label', 'type', 'genes'
-            ],
-        )
-        assert_df_equals(
-            gene_nodes, expected, ignore_indices={0}, ignore_order={0, 1}
+            [['fam', 'family', 'fam'],
+             ['fam2', 'family', 'fam2'],
+             ['gene3', 'gene', None],
+             ['gene4', 'gene', None]],
+            columns=['label', 'type', 'family'],
         )
+        assert_df_equals(nodes, expected)
 
-        # family nodes
+        # nodes are in the same partition iff they correlate to the same
+        # baits: fam and gene4 to both baits, fam2 to bait1, gene3 to bait2
+        assert partition_ids[0] == partition_ids[3]
+        assert len(set(partition_ids)) == 3
+
+        # and each gene maps to its node
         expected = pd.DataFrame(
-            [[
-                frozenset({'bait1', 'bait2'}),
-                'fam',
-                'family',
-                frozenset({'gene1', 'gene2'}),
-                'fam'
-            ]],
-            columns=[
-                'baits', 'label', 'type', 'genes', 'family'
-            ],
+            [[0, 'gene1'],
+             [0, 'gene2'],
+             [1, 'gene5'],
+             [2, 'gene3'],
+             [3, 'gene4']],
+            columns=['node', 'gene'],
         )
         assert_df_equals(
-            family_nodes, expected, ignore_indices={0}, ignore_order={0, 1}
+            node_genes, expected, ignore_indices={0}, ignore_order={0, 1}
+        )
+
+    def test_no_cors(self, baits, gene_families):
+        'When only baits correlate, return no nodes'
+        cors = pd.DataFrame(
+            [['bait1', 'bait2', 5.0]],
+            columns=['bait', 'gene', 'correlation'],
         )
+        nodes, node_genes = alg._create_non_bait_nodes(baits, cors, gene_families)
+        assert nodes.empty
+        assert node_genes.empty
+
+class TestPartitionIds:
+
+    '''
+    Partition ids only depend on the names of the baits, not on the process
+    (PYTHONHASHSEED) or the order of baits
+    '''
+
+    def test_regression(self):
+        '''
+        Ids equal those of a previous run
+
+        Nodes: 0 with bait1 and bait2, 1 with no baits, 2 with bait2.
+        '''
+        hashes = alg._stable_hashes(['bait1', 'bait2'])
+        ids = alg._partition_ids(np.array([0, 0, 2]), hashes[[0, 1, 1]], 3)
+        assert list(ids) == [-7978914492172324590, 0, -3177708419843828011]
+
+    def test_order_independent(self):
+        hashes = alg._stable_hashes(['bait1', 'bait2', 'bait3'])
+        ids1 = alg._partition_ids(np.array([0, 0, 0]), hashes[[0, 1, 2]], 1)
+        ids2 = alg._partition_ids(np.array([0, 0, 0]), hashes[[2, 0, 1]], 1)
+        assert ids1[0] == ids2[0]
 
 class TestConcatNodes:
 
@@ -354,40 +1078,33 @@ class TestConcatNodes:
         colour = 1
         partition = 1
         return pd.DataFrame(
-            [[frozenset({'bait1'}), 'bait', np.nan, 'bait1', colour, partition]],
+            [['bait1', 'bait', np.nan, colour, partition]],
             columns=[
-                'genes', 'type', 'family', 'label', 'colour', 'partition_id'
+                'label', 'type', 'family', 'colour', 'partition_id'
             ],
         )
 
     @pytest.fixture
-    def family_nodes(self):
+    def non_bait_nodes(self):
         return pd.DataFrame(
             [
-                [frozenset({'bait1', 'bait2'}),
-                 'fam',
-                 'family',
-                 frozenset({'gene1', 'gene2'}),
-                 'fam'],
-                [frozenset({'bait1'}),
-                 'fam2',
-                 'family',
-                 frozenset({'gene3'}),
-                 'fam2'],
+                ['fam', 'family', 'fam', 10],
+                ['fam2', 'family', 'fam2', 20],
+                ['gene4', 'gene', None, 10],
             ],
             columns=[
-                'baits', 'label', 'type', 'genes', 'family'
+                'label', 'type', 'family', 'partition_id'
             ],
         )
 
     @pytest.fixture
-    def gene_nodes(self):
+    def non_bait_genes(self):
         return pd.DataFrame(
-            [[frozenset({'bait1', 'bait2'}), 'gene4', 'gene',
-              frozenset({'gene4'})]],
-            columns=[
-                'baits', 'label', 'type', 'genes'
-            ],
+            [[0, 'gene1'],
+             [0, 'gene2'],
+             [1, 'gene3'],
+             [2, 'gene4']],
+            columns=['node', 'gene'],
         )
 
     @pytest.fixture
@@ -398,16 +1115,18 @@ class TestConcatNodes:
         monkeypatch.setattr('coexpnetviz._algorithm.distinct_colours', mock)
         return mock
 
-    def test(self, bait_nodes, family_nodes, gene_nodes, distinct_colours_mock):
+    def test(self, bait_nodes, non_bait_nodes, non_bait_genes, distinct_colours_mock):
         orig_bait_nodes = bait_nodes.copy()
-        orig_family_nodes = family_nodes.copy()
-        orig_gene_nodes = gene_nodes.copy()
-        nodes = alg._concat_nodes(bait_nodes, family_nodes, gene_nodes)
+        orig_non_bait_nodes = non_bait_nodes.copy()
+        orig_non_bait_genes = non_bait_genes.copy()
+        nodes, node_genes = alg._concat_nodes(
+            bait_nodes, non_bait_nodes, non_bait_genes
+        )
 
         # Then input unchanged
         assert_df_equals(bait_nodes, orig_bait_nodes)
-        assert_df_equals(family_nodes, orig_family_nodes)
-        assert_df_equals(gene_nodes, orig_gene_nodes)
+        assert_df_equals(non_bait_nodes, orig_non_bait_nodes)
+        assert_df_equals(non_bait_genes, orig_non_bait_genes)
 
         # All NaN replaced by None (e.g. when converting family col to json
         # later on we want missing values to become `null`, not `NaN`, in json)
@@ -419,27 +1138,58 @@ class TestConcatNodes:
         # partition
         distinct_colours_mock.assert_called_once_with(2)
 
-        # Do a plain simple concat with partitions being hashes of baits
-        del nodes['id']
+        # Do a plain simple concat with a colour per partition, in order of
+        # partition id
         expected = pd.DataFrame(
             [
-                ['bait1', 'bait', frozenset({'bait1'}), None,
-                 1, 1],
-                ['fam', 'family', frozenset({'gene1', 'gene2'}),
-                 'fam', hash(frozenset({'bait1', 'bait2'})), 2],
-                ['fam2', 'family', frozenset({'gene3'}),
-                 'fam2', hash(frozenset({'bait1'})), 3],
-                ['gene4', 'gene', frozenset({'gene4'}),
-                 None, hash(frozenset({'bait1', 'bait2'})), 2],
+                [0, 'fam', 'family', 'fam', 10, 2],
+                [1, 'fam2', 'family', 'fam2', 20, 3],
+                [2, 'gene4', 'gene', None, 10, 2],
+                [3, 'bait1', 'bait', None, 1, 1],
             ],
             columns = (
-                'label', 'type', 'genes', 'family', 'partition_id', 'colour'
+                'id', 'label', 'type', 'family', 'partition_id', 'colour'
             )
         )
         assert_df_equals(
-            nodes, expected, ignore_indices={0}, ignore_order={0,1}
+            nodes, expected, ignore_indices={0}, ignore_order={1}
+        )
+
+        # and genes of baits are added to the node genes
+        expected = pd.DataFrame(
+            [[0, 'gene1'],
+             [0, 'gene2'],
+             [1, 'gene3'],
+             [2, 'gene4'],
+             [3, 'bait1']],
+            columns=['node', 'gene'],
+        )
+        assert_df_equals(
+            node_genes, expected, ignore_indices={0}, ignore_order={0, 1}
         )
 
+def test_concat_nodes_distinct_colours():
+    'Distinct partitions get distinct colours, regardless of node order'
+    def colours(partition_ids):
+        non_bait_nodes = pd.DataFrame({
+            'label': [f'gene{i}' for i in range(len(partition_ids))],
+            'type': 'gene', 'family': None, 'partition_id': partition_ids,
+        })
+        non_bait_genes = pd.DataFrame({
+            'node': range(len(partition_ids)), 'gene': non_bait_nodes['label'],
+        })
+        bait_nodes = pd.DataFrame(columns=['label', 'type', 'family', 'colour', 'partition_id'])
+        nodes, _ = alg._concat_nodes(bait_nodes, non_bait_nodes, non_bait_genes)
+        return dict(zip(nodes['partition_id'], nodes['colour']))
+    partition_ids = [-7978914492172324590, 3022426385349044557, 42, 106, 170]
+    actual = colours(partition_ids + partition_ids[:2])
+    assert len(actual) == len(partition_ids)
+    assert all(
+        colour1 != colour2
+        for colour1, colour2 in itertools.combinations(actual.values(), 2)
+    )
+    assert actual == colours(partition_ids[::-1])
+
 class TestCreateHomologyEdges:
 
     'Happy days, edges between baits of the same family'
@@ -469,10 +1219,11 @@ class TestCreateHomologyEdges:
 
     def test(self, nodes):
         orig_nodes = nodes.copy()
-        edges = alg._create_homology_edges(nodes)
+        edges, cliques = alg._create_homology_edges(nodes)
 
         # Then input unchanged
         assert_df_equals(nodes, orig_nodes)
+        assert cliques.empty
 
         # and edges between baits of the same family except self/symmetric edges
         expected = pd.DataFrame(
@@ -485,6 +1236,47 @@ class TestCreateHomologyEdges:
             edges, expected, ignore_indices={0}, ignore_order={0, 1}
         )
 
+    def test_families_of_different_size(self):
+        '''
+        When families have a different number of baits in no particular order,
+        each gets the edges between its own baits
+        '''
+        nodes = pd.DataFrame(
+            [[1, 'bait', 'fam2'],
+             [2, 'bait', 'fam1'],
+             [3, 'bait', 'fam2'],
+             [4, 'bait', 'fam3'],
+             [5, 'bait', 'fam2'],
+             [6, 'bait', 'fam1'],
+             [7, 'bait', 'fam3']],
+            columns = ('id', 'type', 'family')
+        )
+        edges, _ = alg._create_homology_edges(nodes)
+        expected = pd.DataFrame(
+            [[1, 3],
+             [1, 5],
+             [3, 5],
+             [2, 6],
+             [4, 7]],
+            columns=('bait_node1', 'bait_node2'),
+        )
+        assert_df_equals(
+            edges, expected, ignore_indices={0}, ignore_order={0, 1}
+        )
+
+    def test_cliques(self, nodes):
+        '''
+        When a family has more baits than the max clique size, return it as a
+        clique instead of as edges
+        '''
+        edges, cliques = alg._create_homology_edges(nodes, max_clique_size=2)
+        assert edges.empty
+        expected = pd.DataFrame(
+            [['fam', (2, 3, 4)]],
+            columns=('family', 'bait_nodes'),
+        )
+        assert_df_equals(cliques, expected, ignore_indices={0})
+
 class TestCreateCorEdges:
 
     '''
@@ -492,9 +1284,10 @@ class TestCreateCorEdges:
     '''
 
     @pytest.fixture
-    def nodes(self):
+    def node_genes(self):
         '''
-        Nodes with just the columns relevant for this test
+        Genes of the nodes: bait1, bait2, bait3 nodes; a fam node with gene1
+        and gene2; a gene3 node.
 
         An edge for bait3 won't appear because nothing correlates with it.
         gene2 appears in both the edge to bait1 and bait2 but its homolog gene1
@@ -502,12 +1295,13 @@ class TestCreateCorEdges:
         its edge to bait1.
         '''
         return pd.DataFrame(
-            [[1, 'bait', frozenset({'bait1'})],
-             [2, 'fam', frozenset({'gene1', 'gene2'})],
-             [3, 'bait', frozenset({'bait2'})],
-             [4, 'gene', frozenset({'gene3'})],
-             [5, 'bait', frozenset({'bait3'})]],
-            columns=('id', 'type', 'genes')
+            [[1, 'bait1'],
+             [2, 'gene1'],
+             [2, 'gene2'],
+             [3, 'bait2'],
+             [4, 'gene3'],
+             [5, 'bait3']],
+            columns=('node', 'gene')
         )
 
     @pytest.fixture
@@ -522,13 +1316,13 @@ class TestCreateCorEdges:
             columns=('bait', 'gene', 'correlation'),
         )
 
-    def test(self, nodes, cors):
-        orig_nodes = nodes.copy()
+    def test(self, node_genes, cors):
+        orig_node_genes = node_genes.copy()
         orig_cors = cors.copy()
-        edges = alg._create_cor_edges(nodes, cors)
+        edges = alg._create_cor_edges(node_genes, cors)
 
         # Then input unchanged
-        assert_df_equals(nodes, orig_nodes)
+        assert_df_equals(node_genes, orig_node_genes)
         assert_df_equals(cors, orig_cors)
 
         # and correct edges
@@ -0,0 +1,241 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks
+
+These only print timings for a human to review, run them with:
+
+    pytest -m manual -s tests/test_benchmark.py
+'''
+
+from time import perf_counter
+import json
+import os
+import tracemalloc
+
+from varbio import ExpressionMatrix, pearson_df
+import numpy as np
+import pandas as pd
+import pytest
+
+from coexpnetviz import _kernels
+from coexpnetviz._index import CoexpressionIndex
+from coexpnetviz._various import Network, distinct_colours
+from coexpnetviz.main import _network_json, response_formats
+import coexpnetviz._algorithm as alg
+
+
+def timed(function, *args, repeat=3, **kwargs):
+    'Get best time in seconds of calling the function'
+    best = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        function(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+    return best
+
+@pytest.fixture
+def matrix_df():
+    'A realistic compendium: 20k genes, 200 conditions'
+    random = np.random.RandomState(seed=0)
+    return pd.DataFrame(
+        random.normal(size=(20000, 200)),
+        index=[f'gene{i}' for i in range(20000)],
+    )
+
+@pytest.fixture
+def baits_df(matrix_df):
+    return matrix_df.iloc[::200]
+
+@pytest.mark.manual
+def test_tiled_scaling(matrix_df, baits_df):
+    'Speedup of the tiled correlation with the number of threads'
+    cpus = os.cpu_count()
+    threads = [1]
+    while threads[-1] * 2 <= cpus:
+        threads.append(threads[-1] * 2)
+    if threads[-1] != cpus:
+        threads.append(cpus)
+
+    single = timed(alg._correlate_tiled, pearson_df, matrix_df, baits_df, 1)
+    print()
+    for count in threads:
+        seconds = timed(alg._correlate_tiled, pearson_df, matrix_df, baits_df, count)
+        print(f'{count:3} threads: {seconds:.3f}s, speedup {single / seconds:.1f}')
+
+@pytest.mark.manual
+def test_kernel_backends(matrix_df, baits_df):
+    'Time of each kernel backend against the pandas passes they replace'
+    cor_matrix = alg._correlate_tiled(pearson_df, matrix_df, baits_df, 1)
+    cutoffs = np.percentile(cor_matrix.values, (5, 95))
+    pandas_passes = {
+        'row_stds': lambda: matrix_df.std(axis=1),
+        'cut': lambda: (
+            cor_matrix[(cor_matrix <= cutoffs[0]) | (cor_matrix >= cutoffs[1])]
+            .reset_index()
+            .melt(id_vars='index')
+            .dropna()
+        ),
+    }
+    kernels = {
+        'row_stds': lambda backend: _kernels.row_stds(matrix_df.values, backend),
+        'cut': lambda backend: _kernels.cut(cor_matrix.values, *cutoffs, backend),
+    }
+    backends = [
+        backend for backend in _kernels.backends
+        if backend != 'numba' or _kernels.numba
+    ]
+    print()
+    for name, kernel in kernels.items():
+        print(f'{name:8} pandas: {timed(pandas_passes[name]):.3f}s')
+        for backend in backends:
+            kernel(backend)  # compile
+            print(f'{name:8} {backend:6}: {timed(kernel, backend):.3f}s')
+
+@pytest.mark.manual
+def test_screening():
+    'Recall and speedup of screening, on genes in co-expressed modules'
+    random = np.random.RandomState(seed=0)
+    gene_count, column_count, bait_count = 20000, 1000, 1000
+    modules = random.normal(size=(200, column_count))
+    data = (
+        modules[random.randint(len(modules), size=gene_count)]
+        + random.normal(scale=1.2, size=(gene_count, column_count))
+    )
+    matrix_df = pd.DataFrame(data, index=[f'gene{i}' for i in range(gene_count)])
+    baits_df = matrix_df.iloc[:bait_count]
+    cutoffs = (-.3, .3)
+    assert alg._screening_pays(column_count, bait_count)
+
+    exact_seconds = timed(
+        alg._correlate_tiled, pearson_df, matrix_df, baits_df, 1, repeat=1
+    )
+    exact = alg._correlate_tiled(pearson_df, matrix_df, baits_df, 1).values
+    is_significant = (exact <= cutoffs[0]) | (exact >= cutoffs[1])
+    print(f'\nexact: {exact_seconds:.3f}s, {is_significant.mean():.2%} significant')
+    for recall in (.9, .99, .999):
+        similarity_df = alg._screened_similarity(
+            alg.row_transforms['pearson'], matrix_df, baits_df, cutoffs, recall
+        )
+        seconds = timed(
+            alg._correlate_tiled, similarity_df, matrix_df, baits_df, 1, repeat=1
+        )
+        screened = alg._correlate_tiled(similarity_df, matrix_df, baits_df, 1).values
+        is_candidate = ~np.isnan(screened)
+        actual_recall = (is_candidate & is_significant).sum() / is_significant.sum()
+        print(
+            f'recall {recall}: {seconds:.3f}s, speedup {exact_seconds / seconds:.1f}, '
+            f'{is_candidate.mean():.2%} candidates, measured recall {actual_recall:.4f}'
+        )
+
+@pytest.mark.manual
+def test_index_query():
+    'Time of top k queries against correlating all genes, on co-expressed modules'
+    random = np.random.RandomState(seed=0)
+    gene_count, column_count = 100000, 100
+    modules = random.normal(size=(500, column_count))
+    data = (
+        modules[random.randint(len(modules), size=gene_count)]
+        + random.normal(scale=.3, size=(gene_count, column_count))
+    )
+    matrix_df = pd.DataFrame(data, index=[f'gene{i}' for i in range(gene_count)])
+    matrix = ExpressionMatrix('matrix', matrix_df)
+    baits = pd.Series(matrix_df.index[:10])
+    k = 50
+
+    print()
+    build_seconds = timed(CoexpressionIndex.from_matrix, matrix, repeat=1)
+    index = CoexpressionIndex.from_matrix(matrix)
+    query_seconds = timed(index.query, baits, k)
+    correlate_seconds = timed(
+        alg._correlate_tiled, pearson_df, matrix_df, matrix_df.loc[baits], 1
+    )
+    print(f'build: {build_seconds:.3f}s')
+    print(f'query top {k} of {len(baits)} baits: {query_seconds:.4f}s')
+    print(f'correlate all genes: {correlate_seconds:.4f}s')
+
+@pytest.mark.manual
+@pytest.mark.parametrize('zeros', (.7, .9, .99))
+def test_sparse(zeros):
+    'Time and peak memory of correlating a sparse matrix against a dense one'
+    random = np.random.RandomState(seed=0)
+    gene_count, column_count = 20000, 500
+    data = random.poisson(3, size=(gene_count, column_count)).astype(float)
+    data[random.uniform(size=data.shape) < zeros] = 0
+    matrix_df = pd.DataFrame(data, index=[f'gene{i}' for i in range(gene_count)])
+    baits = pd.Series(matrix_df.index[::200])
+    matrices = {
+        'dense': ExpressionMatrix('dense', matrix_df),
+        'sparse': ExpressionMatrix('sparse', matrix_df.astype(pd.SparseDtype(float, 0))),
+    }
+    del data, matrix_df
+
+    print(f'\n{zeros:.0%} zeros')
+    for name, matrix in matrices.items():
+        seconds = timed(
+            alg._correlate_matrix, matrix, baits, (5, 95), repeat=1,
+            correlation_method='pearson', keep_sample_matrix=False, threads=None,
+            screening_recall=None,
+        )
+        tracemalloc.start()
+        alg._correlate_matrix(
+            matrix, baits, (5, 95), correlation_method='pearson',
+            keep_sample_matrix=False, threads=None, screening_recall=None,
+        )
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        data_bytes = matrix.data.memory_usage(index=False).sum()
+        print(
+            f'{name:6}: {seconds:.3f}s, data {data_bytes / 2**20:.0f}MiB, '
+            f'peak while correlating {peak / 2**20:.0f}MiB'
+        )
+
+@pytest.mark.manual
+def test_response_formats():
+    'Time to serialise a 1M edge network and its size, per response format'
+    random = np.random.RandomState(seed=0)
+    bait_count, node_count, edge_count = 100, 50000, 1000000
+    partition_ids = random.randint(-2**62, 2**62, size=1000)
+    colours = list(distinct_colours(len(partition_ids)))
+    partitions = random.randint(len(partition_ids), size=node_count)
+    nodes = pd.DataFrame({
+        'id': np.arange(node_count),
+        'label': [f'gene{i}' for i in range(node_count)],
+        'type': np.where(np.arange(node_count) < bait_count, 'bait', 'gene'),
+        'family': None,
+        'partition_id': partition_ids[partitions],
+        'colour': [colours[partition] for partition in partitions],
+    })
+    node_genes = pd.DataFrame({'node': nodes['id'], 'gene': nodes['label']})
+    cor_edges = pd.DataFrame({
+        'bait_node': random.randint(bait_count, size=edge_count),
+        'node': random.randint(node_count, size=edge_count),
+        'max_correlation': random.uniform(-1, 1, size=edge_count),
+    })
+    network = Network(
+        nodes, node_genes, pd.DataFrame(columns=['bait_node1', 'bait_node2']),
+        pd.DataFrame(columns=['family', 'bait_nodes']), cor_edges, None, (),
+    )
+
+    print()
+    for response_format in response_formats:
+        seconds = timed(
+            lambda: json.dumps(_network_json(network, response_format)), repeat=1
+        )
+        size = len(json.dumps(_network_json(network, response_format)))
+        print(f'{response_format:8}: {seconds:.3f}s, {size / 2**20:.1f}MiB')
@@ -0,0 +1,175 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from varbio import ExpressionMatrix
+import numpy as np
+import pandas as pd
+import pytest
+
+from coexpnetviz._algorithm import create_network
+from coexpnetviz._delta import network_delta
+from coexpnetviz.main import _network_json
+
+
+def node(id_, label, type_, family=None, partition_id=0, colour='#ffffff', genes=None):
+    return {
+        'id': id_, 'label': label, 'type': type_, 'family': family,
+        'colour': colour, 'partition_id': partition_id,
+        'genes': genes if genes is not None else [label],
+    }
+
+@pytest.fixture
+def previous():
+    return {
+        'nodes': [
+            node(0, 'fam1', 'family', 'fam1', 7, '#cccccc', ['gene1', 'gene2']),
+            node(1, 'gene3', 'gene', None, 7, '#cccccc'),
+            node(2, 'gene4', 'gene', None, 8, '#aaaaaa'),
+            node(3, 'bait1', 'bait', 'fam2'),
+            node(4, 'bait2', 'bait', 'fam2'),
+        ],
+        'homology_edges': [{'bait_node1': 3, 'bait_node2': 4}],
+        'cor_edges': [
+            {'bait_node': 3, 'node': 0, 'max_correlation': .9},
+            {'bait_node': 3, 'node': 1, 'max_correlation': .8},
+            {'bait_node': 4, 'node': 2, 'max_correlation': -.8},
+        ],
+    }
+
+def test_same(previous):
+    'Nothing changed, regardless of ids'
+    current = json.loads(json.dumps(previous))
+    ids = {3: 0, 4: 1, 0: 2, 1: 3, 2: 4}
+    current['nodes'] = [{**node_, 'id': ids[node_['id']]} for node_ in current['nodes']]
+    current['homology_edges'] = [{'bait_node1': 0, 'bait_node2': 1}]
+    for edge in current['cor_edges']:
+        edge['bait_node'] = ids[edge['bait_node']]
+        edge['node'] = ids[edge['node']]
+    delta = network_delta(previous, current)
+    assert dict(zip(delta['node_ids']['previous'], delta['node_ids']['current'])) == ids
+    for table in ('nodes', 'cor_edges', 'homology_edges', 'homology_cliques'):
+        assert not any(delta[table].values()), table
+
+def test_changes(previous):
+    current = {
+        'nodes': [
+            # The genes of the family changed
+            node(0, 'fam1', 'family', 'fam1', 7, '#cccccc', ['gene2', 'gene1', 'gene5']),
+            # The partition changed
+            node(1, 'gene3', 'gene', None, 9, '#cccccc'),
+            # gene4 was removed, gene6 added
+            node(2, 'gene6', 'gene', None, 7, '#cccccc'),
+            node(3, 'bait1', 'bait', 'fam2'),
+            node(4, 'bait2', 'bait', 'fam2'),
+        ],
+        'homology_edges': [],
+        'homology_cliques': [{'family': 'fam2', 'bait_nodes': [3, 4]}],
+        'cor_edges': [
+            {'bait_node': 3, 'node': 0, 'max_correlation': .9},
+            {'bait_node': 3, 'node': 1, 'max_correlation': .85},
+            {'bait_node': 3, 'node': 2, 'max_correlation': .8},
+        ],
+        'preview': {'max_columns': 2, 'column_selection': 'variance', 'max_genes': None},
+    }
+    delta = network_delta(previous, current)
+    assert delta['format'] == 'delta' and delta['version'] == 1
+    assert delta['nodes'] == {
+        'added': [current['nodes'][2]],
+        'removed': [2],
+        'changed': current['nodes'][:2],
+    }
+    assert delta['cor_edges'] == {
+        'added': [current['cor_edges'][2]],
+        'removed': [previous['cor_edges'][2]],
+        'changed': [current['cor_edges'][1]],
+    }
+    assert delta['homology_edges'] == {
+        'added': [], 'removed': previous['homology_edges'],
+    }
+    assert delta['homology_cliques'] == {
+        'added': current['homology_cliques'], 'removed': [], 'changed': [],
+    }
+    assert delta['preview'] == current['preview']
+
+def test_network():
+    'Delta of networks of different percentiles'
+    matrix = ExpressionMatrix('matrix', pd.DataFrame(
+        [[1, 2, 3, 4], [4, 3, 2, 1], [1, 3, 2, 4], [2, 1, 4, 3], [1, 2, 4, 3]],
+        index=['bait1', 'bait2', 'gene1', 'gene2', 'gene3'], dtype=float,
+    ))
+    baits = pd.Series(['bait1', 'bait2'])
+    gene_families = pd.DataFrame({
+        'family': ['fam1', 'fam1', 'fam1', 'fam2'],
+        'gene': ['bait1', 'bait2', 'gene1', 'gene2'],
+    })
+    previous = json.loads(json.dumps(_network_json(create_network(
+        baits, [matrix], gene_families, (30, 70)
+    ))))
+    current = _network_json(create_network(baits, [matrix], gene_families, (10, 90)))
+    delta = json.loads(json.dumps(network_delta(previous, current)))
+
+    # Applying the delta to the previous network gives the current one
+    ids = dict(zip(delta['node_ids']['previous'], delta['node_ids']['current']))
+    nodes = {
+        ids[node_['id']]: {**node_, 'id': ids[node_['id']]}
+        for node_ in previous['nodes'] if node_['id'] not in delta['nodes']['removed']
+    }
+    for node_ in delta['nodes']['added'] + delta['nodes']['changed']:
+        nodes[node_['id']] = node_
+    expected = {node_['id']: node_ for node_ in json.loads(json.dumps(current['nodes']))}
+    assert nodes == expected
+
+    def edge_key(edge, ids=None):
+        ids = ids or {}
+        return ids.get(edge['bait_node'], edge['bait_node']), ids.get(edge['node'], edge['node'])
+    removed = {edge_key(edge) for edge in delta['cor_edges']['removed']}
+    edges = {
+        edge_key(edge, ids): edge['max_correlation']
+        for edge in previous['cor_edges'] if edge_key(edge) not in removed
+    }
+    for edge in delta['cor_edges']['added'] + delta['cor_edges']['changed']:
+        edges[edge_key(edge)] = edge['max_correlation']
+    assert edges == {edge_key(edge): edge['max_correlation'] for edge in current['cor_edges']}
+
+def test_remove_bait():
+    'Removing a bait only changes the nodes it correlated to'
+    random = np.random.RandomState(seed=0)
+    matrix = ExpressionMatrix('matrix', pd.DataFrame(
+        random.normal(size=(200, 10)), index=[f'gene{i}' for i in range(200)],
+    ))
+    gene_families = pd.DataFrame(columns=['family', 'gene'])
+    baits = ['gene0', 'gene1', 'gene2', 'gene3']
+    previous = _network_json(create_network(
+        pd.Series(baits), [matrix], gene_families, (10, 90)
+    ))
+    current = _network_json(create_network(
+        pd.Series(baits[:-1]), [matrix], gene_families, (10, 90)
+    ))
+    delta = network_delta(previous, current)
+
+    labels = {node_['id']: node_['label'] for node_ in previous['nodes']}
+    bait3 = next(node_['id'] for node_ in previous['nodes'] if node_['label'] == 'gene3')
+    of_bait3 = {
+        labels[edge['node']] for edge in previous['cor_edges']
+        if edge['bait_node'] == bait3
+    }
+    changed = {node_['label'] for node_ in delta['nodes']['changed']}
+    assert changed
+    assert changed <= of_bait3
+    assert len(of_bait3) < len(previous['nodes']) - len(baits)
@@ -0,0 +1,96 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+from pytil.data_frame import assert_df_equals
+from varbio import ExpressionMatrix, pearson_df
+import numpy as np
+import pandas as pd
+import pytest
+
+from coexpnetviz._index import CoexpressionIndex, digest
+
+
+@pytest.fixture
+def matrix():
+    random = np.random.RandomState(seed=0)
+    data = random.normal(size=(300, 8))
+    data[7] = 1.0  # no variance
+    data[20] = -data[0]
+    data[30, 3] = np.nan
+    data[40, 5] = np.nan
+    return ExpressionMatrix('matrix', pd.DataFrame(
+        data, index=[f'gene{i}' for i in range(300)]
+    ))
+
+@pytest.fixture
+def index(matrix):
+    return CoexpressionIndex.from_matrix(matrix)
+
+def expected_top_k(matrix, baits, k):
+    'Brute force top k by absolute correlation'
+    data = matrix.data.drop(['gene7', 'gene30', 'gene40'])
+    cors = pearson_df(data, data.loc[baits])
+    cors = cors.rename_axis('gene').reset_index()
+    cors = cors.melt(id_vars='gene', var_name='bait', value_name='correlation')
+    cors = cors[cors['gene'] != cors['bait']]
+    cors = cors.loc[cors['correlation'].abs().sort_values(ascending=False).index]
+    return cors.groupby('bait').head(k)
+
+@pytest.mark.parametrize('k', (1, 5, 296, 1000))
+def test_query(matrix, index, k):
+    'Same as brute force, ignoring unknown baits, genes without variance or with NaN'
+    cors = index.query(pd.Series(['gene0', 'gene1', 'gene7', 'gene30', 'unknown']), k)
+    expected = expected_top_k(matrix, ['gene0', 'gene1'], k)
+    assert_df_equals(
+        cors, expected, ignore_indices={0}, ignore_order={0}, all_close=True
+    )
+    if k == 1:
+        assert cors.set_index('bait').loc['gene0', 'gene'] == 'gene20'
+
+def test_no_rows(matrix):
+    'Clear error when all rows have NaN'
+    data = matrix.data.copy()
+    data[0] = np.nan
+    with pytest.raises(ValueError) as ex:
+        CoexpressionIndex.from_matrix(ExpressionMatrix('matrix', data))
+    assert 'no rows without NaN values' in str(ex.value)
+
+def test_query_no_baits(index):
+    cors = index.query(pd.Series(['unknown']), 5)
+    assert cors.empty
+    assert list(cors.columns) == ['gene', 'bait', 'correlation']
+
+def test_save_load(matrix, index, temp_dir_cwd):
+    index.save('index.npz')
+    loaded = CoexpressionIndex.load('index.npz')
+    assert loaded.digest == index.digest == digest(matrix)
+    baits = pd.Series(['gene3'])
+    assert_df_equals(loaded.query(baits, 10), index.query(baits, 10))
+
+def test_digest(matrix):
+    'Changes with the data'
+    data = matrix.data.copy()
+    data.iloc[3, 3] += 1
+    assert digest(matrix) != digest(ExpressionMatrix('matrix', data))
+
+def test_digest_columns(matrix):
+    'Changes with the selected columns, even if their values are the same'
+    data = matrix.data.copy()
+    data[8] = data[0]
+    assert digest(ExpressionMatrix('matrix', data.iloc[:, [0, 1]])) != digest(
+        ExpressionMatrix('matrix', data.iloc[:, [8, 1]])
+    )
@@ -0,0 +1,64 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coexpnetviz import _kernels
+
+
+@pytest.fixture(params=_kernels.backends)
+def backend(request):
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+    return request.param
+
+@pytest.fixture
+def data():
+    random = np.random.RandomState(seed=0)
+    data = random.normal(size=(50, 7))
+    data[3] = 2.0
+    data[4, 2] = np.nan
+    data[5, 1:] = np.nan
+    return data
+
+def test_row_stds(data, backend):
+    'Same as pandas, which ignores NaN'
+    stds = _kernels.row_stds(data, backend)
+    np.testing.assert_allclose(stds, pd.DataFrame(data).std(axis=1), atol=1e-15)
+    assert stds[3] == 0
+
+def test_cut(data, backend):
+    'Same triples as masking and melting the data'
+    rows, columns, values = _kernels.cut(data, -.5, .8, backend)
+
+    df = pd.DataFrame(data)
+    df = df[(df <= -.5) | (df >= .8)].reset_index()
+    expected = df.melt(id_vars='index').dropna()
+    np.testing.assert_array_equal(rows, expected['index'])
+    np.testing.assert_array_equal(columns, expected['variable'])
+    np.testing.assert_array_equal(values, expected['value'])
+
+def test_cut_nan_cutoffs(data, backend):
+    'NaN cutoffs cut nothing'
+    rows, columns, values = _kernels.cut(data, np.nan, np.nan, backend)
+    assert rows.size == columns.size == values.size == 0
+
+def test_invalid_backend(data):
+    with pytest.raises(ValueError):
+        _kernels.row_stds(data, 'fortran')
@@ -27,6 +27,7 @@ from pathlib import Path
 from textwrap import dedent
 import io
 import json
+import sys
 
 from pytil.data_frame import assert_df_equals
 from varbio import ExpressionMatrix, UserError
@@ -34,7 +35,13 @@ import numpy as np
 import pandas as pd
 import pytest
 
-from coexpnetviz.main import main, _validate_matrices
+from coexpnetviz._algorithm import create_network
+from coexpnetviz._various import CutoffConfidence
+from coexpnetviz.main import (
+    main, _validate_matrices, _read_matrices, _MatrixValidator, _parse_columns,
+    _select_columns, _network_json, _parse_cutoff_confidence, _percentile_values,
+    _parse_previous_response, _parse_percentiles, _parse_fdr,
+)
 
 
 class TestHappyDays:
@@ -90,6 +97,7 @@ class TestHappyDays:
             'output_dir': str(output_dir),
             'lower_percentile': 5,
             'upper_percentile': 95,
+            'write_sample_matrix': True,
         }
         path = (Path(tmpdir) / 'input.json')
         path.write_text(json.dumps(args))
@@ -129,9 +137,12 @@ class TestHappyDays:
         # Percentile values file
         expected = pd.DataFrame(
             [
-                ['matrix1', -0.95073877, 0.44702967]
+                ['matrix1', -0.95073877, 0.44702967, 5.0, 95.0]
+            ],
+            columns=[
+                'expression_matrix', 'lower', 'upper', 'lower_percentile',
+                'upper_percentile'
             ],
-            columns=['expression_matrix', 'lower', 'upper'],
         )
         actual = pd.read_table(str(output_dir / 'percentile_values.txt'), index_col=None)
         assert_df_equals(actual, expected, ignore_order={0,1}, ignore_indices={0}, all_close=True)
@@ -151,6 +162,15 @@ class TestHappyDays:
         for file_name in ('matrix1.sample_histogram.png', 'matrix1.sample_cdf.png'):
             assert (output_dir / file_name).exists()
 
+    def test_top_k_correlation_method(self, mock_json_input):
+        'top_k is only implemented for pearson'
+        path = Path(sys.argv[1])
+        args = json.loads(path.read_text())
+        path.write_text(json.dumps({**args, 'top_k': 2, 'correlation_method': 'spearman'}))
+        with pytest.raises(UserError) as ex:
+            main()
+        assert 'top_k only works with the pearson' in str(ex.value)
+
 class TestValidateMatrices:
 
     def create_matrix(self, name, index):
@@ -209,3 +229,256 @@ class TestValidateMatrices:
         with pytest.raises(UserError) as ex:
             _validate_matrices(baits0, [matrix_bait1])
         assert 'matrices have no baits' in str(ex.value)
+
+class TestReadMatrices:
+
+    @pytest.fixture
+    def paths(self, temp_dir_cwd):
+        paths = [Path('matrix1'), Path('matrix2')]
+        paths[0].write_text('mygene\tc1\tc2\nbait1\t1\t2\ngene1\t2\t1')
+        paths[1].write_text('mygene\tc1\tc2\nbait2\t1\t2\ngene1\t2\t1')
+        return paths
+
+    def test_validate_each_matrix_when_read(self, paths):
+        '''
+        When the second matrix is invalid, yield the first matrix before
+        raising
+        '''
+        matrices = _read_matrices(paths, _MatrixValidator(pd.Series(['bait1', 'bait2'])))
+        assert next(matrices).name == 'matrix1'
+        with pytest.raises(UserError) as ex:
+            next(matrices)
+        assert 'genes appear in multiple' in str(ex.value)
+
+    def test_raise_read_error(self, paths):
+        'When a matrix cannot be read, raise its error when yielding it'
+        paths[1] = Path('missing')
+        matrices = _read_matrices(paths, _MatrixValidator(pd.Series(['bait1'])))
+        assert next(matrices).name == 'matrix1'
+        with pytest.raises(FileNotFoundError):
+            next(matrices)
+
+    @pytest.fixture
+    def wide_path(self, temp_dir_cwd):
+        path = Path('matrix')
+        path.write_text(dedent('''\
+            mygene\tcontrol1\tstress1\tstress2\tcontrol2\tstress3
+            bait1\t1\t2\t3\t4\t5
+            gene1\t2\t1\t3\t5\t4'''
+        ))
+        return path
+
+    @pytest.mark.parametrize('selection, columns', (
+        (['stress2', 'stress1'], ['stress1', 'stress2']),
+        (['control1', 'control2'], ['control1', 'control2']),
+        ('^stress', ['stress1', 'stress2', 'stress3']),
+    ))
+    def test_select_columns(self, wide_path, selection, columns):
+        'Select by names or regex, keeping the order of the matrix'
+        args = {'columns': {'matrix': selection}}
+        selections = _parse_columns(args, [wide_path])
+        matrices = _read_matrices(
+            [wide_path], _MatrixValidator(pd.Series(['bait1'])), selections
+        )
+        matrix = next(matrices)
+        assert list(matrix.data.columns) == columns
+
+    def test_select_columns_view(self, wide_path):
+        'A contiguous selection does not copy'
+        matrix = ExpressionMatrix('matrix', pd.read_table(wide_path, index_col=0).astype(float))
+        selected = _select_columns(matrix, ['stress1', 'stress2'])
+        assert np.shares_memory(selected.data.values, matrix.data.values)
+
+    @pytest.mark.parametrize('columns, message', (
+        ({'other': ['c1']}, 'not in expression_matrices'),
+        ({'matrix': '('}, 'Invalid columns regex'),
+        ({'matrix': 3}, 'list of column names or a regex'),
+    ))
+    def test_parse_columns_invalid(self, wide_path, columns, message):
+        with pytest.raises(UserError) as ex:
+            _parse_columns({'columns': columns}, [wide_path])
+        assert message in str(ex.value)
+
+    @pytest.mark.parametrize('selection, message', (
+        (['stress1', 'unknown'], 'does not have: unknown'),
+        ('stress1', 'at least 2 columns'),
+    ))
+    def test_select_columns_invalid(self, wide_path, selection, message):
+        selections = _parse_columns({'columns': {'matrix': selection}}, [wide_path])
+        matrices = _read_matrices(
+            [wide_path], _MatrixValidator(pd.Series(['bait1'])), selections
+        )
+        with pytest.raises(UserError) as ex:
+            next(matrices)
+        assert message in str(ex.value)
+
+    def test_read_hdf5(self, temp_dir_cwd):
+        'Read only the selected columns of an AnnData file'
+        h5py = pytest.importorskip('h5py')
+        path = Path('matrix.h5ad')
+        with h5py.File(path, 'w') as file:
+            for key, index in (('obs', ['c1', 'c2', 'c3']), ('var', ['bait1', 'gene1'])):
+                file.create_group(key)['_index'] = np.array(index, dtype='S')
+            file['X'] = np.array([[1, 2], [2, 1], [3, 3]], dtype=float)
+        selections = _parse_columns({'columns': {'matrix.h5ad': ['c1', 'c3']}}, [path])
+        matrices = _read_matrices(
+            [path], _MatrixValidator(pd.Series(['bait1'])), selections
+        )
+        expected = pd.DataFrame(
+            [[1, 3], [2, 3]], index=['bait1', 'gene1'], columns=['c1', 'c3'],
+            dtype=float,
+        )
+        assert_df_equals(next(matrices).data, expected)
+
+def decode_columnar(response):
+    'Get the records format of a columnar response'
+    strings = response['strings'] + [None]  # -1 is None
+    partitions = response['partitions']
+    columns = response['nodes']
+    offsets = columns['genes']['offsets']
+    genes = columns['genes']['values']
+    nodes = [
+        {
+            'id': id_,
+            'label': strings[label],
+            'type': response['types'][type_],
+            'family': strings[family],
+            'partition_id': partitions['id'][partition],
+            'colour': partitions['colour'][partition],
+            'genes': [strings[gene] for gene in genes[offsets[i]:offsets[i+1]]],
+        }
+        for i, (id_, label, type_, family, partition) in enumerate(zip(
+            columns['id'], columns['label'], columns['type'], columns['family'],
+            columns['partition'],
+        ))
+    ]
+    records = {'nodes': nodes}
+    for key in ('homology_edges', 'cor_edges'):
+        columns = response[key]
+        records[key] = [dict(zip(columns, row)) for row in zip(*columns.values())]
+    if 'homology_cliques' in response:
+        cliques = response['homology_cliques']
+        offsets = cliques['bait_nodes']['offsets']
+        bait_nodes = cliques['bait_nodes']['values']
+        records['homology_cliques'] = [
+            {'family': strings[family], 'bait_nodes': bait_nodes[offsets[i]:offsets[i+1]]}
+            for i, family in enumerate(cliques['family'])
+        ]
+    return records
+
+@pytest.mark.parametrize('max_homology_clique_size', (None, 1))
+def test_columnar_network_json(max_homology_clique_size):
+    'Same network as the records format'
+    matrix = ExpressionMatrix('matrix', pd.DataFrame(
+        [[1, 2, 3, 4], [4, 3, 2, 1], [1, 3, 2, 4], [2, 1, 4, 3], [1, 2, 4, 3]],
+        index=['bait1', 'bait2', 'gene1', 'gene2', 'gene3'], dtype=float,
+    ))
+    gene_families = pd.DataFrame({
+        'family': ['fam1', 'fam1', 'fam1', 'fam2'],
+        'gene': ['bait1', 'bait2', 'gene1', 'gene2'],
+    })
+    network = create_network(
+        pd.Series(['bait1', 'bait2']), [matrix], gene_families, (30, 70),
+        max_homology_clique_size=max_homology_clique_size,
+    )
+    response = _network_json(network, 'columnar')
+    assert response['format'] == 'columnar' and response['version'] == 1
+    records = json.loads(json.dumps(_network_json(network)))
+    for node in records['nodes']:
+        node['genes'] = sorted(node['genes'])
+    for clique in records.get('homology_cliques', []):
+        clique['bait_nodes'] = list(clique['bait_nodes'])
+    assert decode_columnar(json.loads(json.dumps(response))) == records
+    assert ('homology_cliques' in records) == (max_homology_clique_size == 1)
+
+@pytest.mark.parametrize('args, expected', (
+    ({}, None),
+    ({'cutoff_confidence': .9}, CutoffConfidence(.9)),
+    ({'cutoff_tolerance': .01}, CutoffConfidence(tolerance=.01)),
+    ({'cutoff_confidence': .9, 'cutoff_tolerance': .01}, CutoffConfidence(.9, .01)),
+))
+def test_parse_cutoff_confidence(args, expected):
+    assert _parse_cutoff_confidence(args) == expected
+
+@pytest.mark.parametrize('args', (
+    {'cutoff_confidence': 1},
+    {'cutoff_confidence': True},
+    {'cutoff_tolerance': 0},
+    {'cutoff_tolerance': '.1'},
+))
+def test_parse_cutoff_confidence_invalid(args):
+    with pytest.raises(UserError):
+        _parse_cutoff_confidence(args)
+
+@pytest.mark.parametrize('args, required, expected', (
+    ({'lower_percentile': 10, 'upper_percentile': 90}, True, [10, 90]),
+    ({'lower_percentile': 10, 'upper_percentile': 90}, False, [10, 90]),
+    ({}, False, [5, 95]),
+))
+def test_parse_percentiles(args, required, expected):
+    assert _parse_percentiles(args, required).tolist() == expected
+
+@pytest.mark.parametrize('args, required', (
+    ({}, True),
+    ({'lower_percentile': 10}, True),
+    ({'upper_percentile': 90}, False),
+    ({'lower_percentile': -1, 'upper_percentile': 90}, False),
+))
+def test_parse_percentiles_invalid(args, required):
+    with pytest.raises(UserError):
+        _parse_percentiles(args, required)
+
+@pytest.mark.parametrize('fdr', (0, 1, 1.5, True, '.05'))
+def test_parse_fdr_invalid(fdr):
+    with pytest.raises(UserError):
+        _parse_fdr({'fdr': fdr})
+
+def test_percentile_values_intervals():
+    'Has CI columns only when intervals were estimated'
+    matrix = ExpressionMatrix('matrix', pd.DataFrame(
+        [[1, 2, 3, 4], [4, 3, 2, 1], [1, 3, 2, 4], [2, 1, 4, 3], [1, 2, 4, 3]],
+        index=['bait1', 'bait2', 'gene1', 'gene2', 'gene3'], dtype=float,
+    ))
+    baits = pd.Series(['bait1', 'bait2'])
+    gene_families = pd.DataFrame(columns=['family', 'gene'])
+    network = create_network(baits, [matrix], gene_families, (5, 95))
+    assert 'lower_ci_low' not in _percentile_values(network)
+
+    network = create_network(
+        baits, [matrix], gene_families, (5, 95),
+        cutoff_confidence=CutoffConfidence(resamples=20),
+    )
+    values = _percentile_values(network).iloc[0]
+    assert values['lower_ci_low'] <= values['lower'] <= values['lower_ci_high']
+    assert values['upper_ci_low'] <= values['upper'] <= values['upper_ci_high']
+
+class TestParsePreviousResponse:
+
+    @pytest.fixture
+    def network(self):
+        return {'nodes': [], 'homology_edges': [], 'cor_edges': []}
+
+    def test(self, network, temp_dir_cwd):
+        Path('previous.json').write_text(json.dumps(network, indent=2))
+        assert _parse_previous_response({'previous_response': 'previous.json'}) == network
+
+    def test_progressive(self, network, temp_dir_cwd):
+        'The network is on the last line'
+        lines = [{'type': 'matrix', 'network': {}}, {'type': 'network', **network}]
+        Path('previous.json').write_text('\n'.join(map(json.dumps, lines)) + '\n')
+        response = _parse_previous_response({'previous_response': 'previous.json'})
+        assert response == {'type': 'network', **network}
+
+    @pytest.mark.parametrize('text, message', (
+        ('', 'not valid JSON'),
+        ('[]', 'no network'),
+        ('{"format": "columnar", "nodes": {}}', 'records format'),
+    ))
+    def test_invalid(self, text, message, temp_dir_cwd):
+        Path('previous.json').write_text(text)
+        with pytest.raises(UserError, match=message):
+            _parse_previous_response({'previous_response': 'previous.json'})
+
+    def test_missing(self, temp_dir_cwd):
+        with pytest.raises(UserError, match='Could not read'):
+            _parse_previous_response({'previous_response': 'previous.json'})
@@ -0,0 +1,113 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'Test coexpnetviz._output'
+
+from pathlib import Path
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coexpnetviz._output import TableWriter, write_sqlite
+
+
+class TestTableWriter:
+
+    @pytest.fixture
+    def data(self):
+        return pd.DataFrame(
+            {
+                'gene': ['gene1', 'gene2', 'gene3'],
+                'correlation': [0.59603956067926978, -1.0, np.nan],
+            },
+            index=['a', 'b', 'c'],
+        )
+
+    @pytest.mark.parametrize('compression, suffix', (
+        (None, ''),
+        ('gzip', '.gz'),
+        ('zstd', '.zst'),
+    ))
+    def test_round_trip(self, temp_dir_cwd, data, compression, suffix):
+        'When written in chunks, read back the same table'
+        if compression == 'zstd':
+            pytest.importorskip('zstandard')
+        writer = TableWriter(compression=compression, chunk_rows=2)
+        path = writer.write(data, Path('table.txt'))
+        assert path == Path('table.txt' + suffix)
+        actual = pd.read_table(
+            path, compression='zstd' if compression == 'zstd' else 'infer'
+        )
+        pd.testing.assert_frame_equal(actual, data.reset_index(drop=True))
+
+    def test_float_precision(self, temp_dir_cwd, data):
+        'When given a precision, write rounded floats and the index if asked'
+        writer = TableWriter(float_precision=3)
+        path = writer.write(data, Path('table.txt'), index=True)
+        assert path.read_text().splitlines() == [
+            '\tgene\tcorrelation',
+            'a\tgene1\t0.596',
+            'b\tgene2\t-1.0',
+            'c\tgene3\tnan',
+        ]
+
+    def test_empty(self, temp_dir_cwd):
+        'When no rows, still write the header'
+        writer = TableWriter()
+        path = writer.write(pd.DataFrame(columns=['a', 'b']), Path('table.txt'))
+        assert path.read_text() == 'a\tb\n'
+
+def test_write_sqlite(temp_dir_cwd):
+    'Write tables with indices, replacing an existing database'
+    path = Path('network.sqlite')
+    path.write_text('old')
+    edges = pd.DataFrame({'node': [1, 2, 2], 'correlation': [.5, -1.0, np.nan]})
+    genes = pd.DataFrame({'node': [1, 2], 'gene': ['gene1', 'gene2']})
+    write_sqlite(
+        {'edges': edges, 'genes': genes, 'empty': pd.DataFrame(columns=['a'])},
+        path, [('edges', 'node'), ('genes', 'gene')],
+    )
+
+    connection = sqlite3.connect(str(path))
+    try:
+        actual = pd.read_sql('SELECT * FROM edges', connection)
+        pd.testing.assert_frame_equal(actual, edges)
+        actual = pd.read_sql('SELECT * FROM genes WHERE gene = "gene2"', connection)
+        assert actual.to_dict('records') == [{'node': 2, 'gene': 'gene2'}]
+        assert pd.read_sql('SELECT * FROM empty', connection).empty
+        plan = connection.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM genes WHERE gene = "gene2"'
+        ).fetchall()
+        assert 'genes_gene' in str(plan)
+    finally:
+        connection.close()
+
+def test_write_sqlite_transaction(temp_dir_cwd):
+    'Write all tables or none'
+    path = Path('network.sqlite')
+    edges = pd.DataFrame({'node': [1, 2]})
+    invalid = pd.DataFrame({'node': [{1}]})  # sqlite cannot store a set
+    with pytest.raises(sqlite3.Error):
+        write_sqlite({'edges': edges, 'invalid': invalid}, path, [])
+    connection = sqlite3.connect(str(path))
+    try:
+        tables = connection.execute('SELECT name FROM sqlite_master').fetchall()
+        assert not tables
+    finally:
+        connection.close()
@@ -0,0 +1,204 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+from pathlib import Path
+
+from pytil.data_frame import assert_df_equals
+from varbio import UserError
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.io
+import scipy.sparse
+
+from coexpnetviz import _readers
+from coexpnetviz._readers import (
+    read_hdf5_matrix, read_mtx_matrix, read_sparse_csv_matrix
+)
+from coexpnetviz._similarity import is_sparse
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+needs_h5py = pytest.mark.skipif(not h5py, reason='h5py is not installed')
+
+
+@pytest.fixture
+def expected():
+    'Genes as rows, samples as columns, mostly zeros like counts'
+    random = np.random.RandomState(seed=0)
+    values = random.poisson(.5, size=(7, 5)).astype(float)
+    return pd.DataFrame(
+        values,
+        index=[f'gene{i}' for i in range(7)],
+        columns=[f'sample{i}' for i in range(5)],
+    )
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    'Read a few rows at a time so chunking is tested too'
+    monkeypatch.setattr(_readers, '_chunk_bytes', 8 * 2 * 7)
+
+def write_h5ad(path, expected, encoding):
+    x = expected.values.T
+    with h5py.File(path, 'w') as file:
+        if encoding == 'old':
+            # AnnData < 0.7
+            for key, index in (('obs', expected.columns), ('var', expected.index)):
+                file[key] = np.array(
+                    [(name.encode(),) for name in index], dtype=[('index', 'S10')]
+                )
+        else:
+            for key, index in (('obs', expected.columns), ('var', expected.index)):
+                group = file.create_group(key)
+                group.attrs['_index'] = '_index'
+                group['_index'] = np.array(index, dtype=h5py.string_dtype())
+        if encoding in ('dense', 'old'):
+            file['X'] = x
+        else:
+            sparse = scipy.sparse.csr_matrix(x) if encoding == 'csr' else scipy.sparse.csc_matrix(x)
+            group = file.create_group('X')
+            group.attrs['encoding-type'] = f'{encoding}_matrix'
+            group.attrs['shape'] = x.shape
+            group['data'] = sparse.data
+            group['indices'] = sparse.indices
+            group['indptr'] = sparse.indptr
+
+def write_loom(path, expected):
+    with h5py.File(path, 'w') as file:
+        file['matrix'] = expected.values
+        file['row_attrs/Gene'] = np.array(expected.index, dtype='S')
+        file['col_attrs/CellID'] = np.array(expected.columns, dtype='S')
+
+@pytest.fixture(params=('dense', 'old', 'csr', 'csc', 'loom'))
+def encoding(request):
+    return request.param
+
+@pytest.fixture
+def path(encoding, expected, temp_dir_cwd):
+    if encoding == 'loom':
+        path = Path('matrix.loom')
+        write_loom(path, expected)
+    else:
+        path = Path('matrix.h5ad')
+        write_h5ad(path, expected, encoding)
+    return path
+
+def dense(data):
+    return data.sparse.to_dense() if is_sparse(data) else data
+
+@needs_h5py
+def test_read(path, encoding, expected):
+    'A sparse X stays sparse'
+    matrix = read_hdf5_matrix(path)
+    assert matrix.name == path.name
+    assert is_sparse(matrix.data) == (encoding in ('csr', 'csc'))
+    assert_df_equals(dense(matrix.data), expected)
+
+@needs_h5py
+def test_select_columns(path, expected):
+    'Only read the selected columns'
+    def select_columns(columns):
+        assert list(columns) == list(expected.columns)
+        return np.array([0, 3, 4])
+    matrix = read_hdf5_matrix(path, select_columns)
+    assert_df_equals(dense(matrix.data), expected.iloc[:, [0, 3, 4]])
+
+@needs_h5py
+def test_duplicate_genes(encoding, expected, temp_dir_cwd):
+    'AnnData var names need not be unique, but genes must be'
+    expected = expected.rename(index={'gene5': 'gene1'})
+    if encoding == 'loom':
+        path = Path('matrix.loom')
+        write_loom(path, expected)
+    else:
+        path = Path('matrix.h5ad')
+        write_h5ad(path, expected, encoding)
+    with pytest.raises(UserError) as ex:
+        read_hdf5_matrix(path)
+    assert 'duplicate genes: gene1' in str(ex.value)
+
+class TestReadMtx:
+
+    @pytest.fixture
+    def path(self, expected, temp_dir_cwd):
+        '''
+        Matrix Market file as Cell Ranger writes it, names in gzipped
+        tsv files
+        '''
+        path = Path('matrix.mtx')
+        scipy.io.mmwrite(str(path), scipy.sparse.coo_matrix(expected.values))
+        pd.DataFrame({'id': expected.index, 'name': 'symbol'}).to_csv(
+            'features.tsv.gz', sep='\t', header=False, index=False
+        )
+        pd.Series(expected.columns).to_csv(
+            'barcodes.tsv', sep='\t', header=False, index=False
+        )
+        return path
+
+    def test_read(self, path, expected):
+        matrix = read_mtx_matrix(path)
+        assert matrix.name == 'matrix.mtx'
+        assert is_sparse(matrix.data)
+        assert_df_equals(matrix.data.sparse.to_dense(), expected)
+
+    def test_select_columns(self, path, expected):
+        matrix = read_mtx_matrix(path, lambda columns: np.array([1, 2]))
+        assert_df_equals(matrix.data.sparse.to_dense(), expected.iloc[:, [1, 2]])
+
+    def test_missing_names(self, path):
+        Path('barcodes.tsv').unlink()
+        with pytest.raises(ValueError) as ex:
+            read_mtx_matrix(path)
+        assert 'no barcodes.tsv' in str(ex.value)
+
+    def test_duplicate_genes(self, path, expected):
+        genes = expected.index.to_series().replace('gene5', 'gene1')
+        pd.DataFrame({'id': genes, 'name': 'symbol'}).to_csv(
+            'features.tsv.gz', sep='\t', header=False, index=False
+        )
+        with pytest.raises(UserError) as ex:
+            read_mtx_matrix(path)
+        assert 'duplicate genes: gene1' in str(ex.value)
+
+class TestReadSparseCsv:
+
+    @pytest.fixture
+    def path(self, expected, temp_dir_cwd):
+        path = Path('matrix.csv')
+        expected.rename_axis('gene').to_csv(path, sep='\t')
+        return path
+
+    def test_read(self, path, expected):
+        matrix = read_sparse_csv_matrix(path)
+        assert matrix.name == 'matrix.csv'
+        assert is_sparse(matrix.data)
+        assert_df_equals(matrix.data.sparse.to_dense(), expected)
+
+    def test_select_columns(self, path, expected):
+        matrix = read_sparse_csv_matrix(path, lambda columns: np.array([1, 2]))
+        assert_df_equals(matrix.data.sparse.to_dense(), expected.iloc[:, [1, 2]])
+
+    def test_duplicate_genes(self, path):
+        'Also across chunks'
+        lines = path.read_text().splitlines()
+        path.write_text('\n'.join(lines + lines[1:2]))
+        with pytest.raises(UserError) as ex:
+            read_sparse_csv_matrix(path)
+        assert 'duplicate genes' in str(ex.value)
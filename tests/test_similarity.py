@@ -0,0 +1,153 @@
+# Copyright (C) 2021 VIB/BEG/UGent - Tim Diels <tim@diels.me>
+#
+# This file is part of CoExpNetViz.
+#
+# CoExpNetViz is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CoExpNetViz is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with CoExpNetViz.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Test coexpnetviz._similarity
+
+Compares the vectorised measures to naive per pair implementations.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from coexpnetviz._similarity import (
+    spearman_df, bicor_df, sparse_pearson_df, sparse_rows, centred_norms,
+    is_sparse, pairwise_pearson_df,
+)
+
+
+def naive_pearson(x, y):
+    x = x - x.mean()
+    y = y - y.mean()
+    return (x * y).sum() / np.sqrt((x**2).sum() * (y**2).sum())
+
+def naive_spearman(x, y):
+    return naive_pearson(
+        pd.Series(x).rank().values, pd.Series(y).rank().values
+    )
+
+def naive_bicor(x, y):
+    def weighted(x):
+        median = np.median(x)
+        mad = np.median(np.abs(x - median))
+        u = (x - median) / (9 * mad)
+        weights = (1 - u**2)**2 * (np.abs(u) < 1)
+        weighted = (x - median) * weights
+        return weighted / np.sqrt((weighted**2).sum())
+    return (weighted(x) * weighted(y)).sum()
+
+@pytest.fixture
+def data():
+    'Random data with ties and an outlier'
+    random = np.random.RandomState(seed=0)
+    data = random.normal(size=(6, 8))
+    data[0, :2] = data[0, 2]
+    data[1, 3] = 100
+    return pd.DataFrame(data, index=[f'gene{i}' for i in range(6)])
+
+@pytest.mark.parametrize('similarity_df, naive', (
+    (spearman_df, naive_spearman),
+    (bicor_df, naive_bicor),
+))
+def test_matches_naive(data, similarity_df, naive):
+    'Happy days, correlating all rows against a subset of rows'
+    orig_data = data.copy()
+    baits = data.iloc[[1, 4]]
+    actual = similarity_df(data, baits)
+
+    # Input unchanged
+    pd.testing.assert_frame_equal(data, orig_data)
+
+    expected = pd.DataFrame(
+        [[naive(data.loc[gene].values, baits.loc[bait].values) for bait in baits.index]
+         for gene in data.index],
+        index=data.index,
+        columns=baits.index,
+    )
+    pd.testing.assert_frame_equal(actual, expected)
+
+def test_bicor_zero_mad_falls_back_to_pearson():
+    'When rows have a MAD of 0, use pearson for them instead of returning NaN'
+    data = pd.DataFrame([
+        [1.0, 1, 1, 1, 5],
+        [2.0, 2, 2, 3, 9],
+    ])
+    actual = bicor_df(data, data)
+    assert not actual.isnull().any(axis=None)
+    assert np.isclose(
+        actual.iloc[0, 1], naive_pearson(data.iloc[0].values, data.iloc[1].values)
+    )
+
+def test_sparse_pearson_matches_naive():
+    'Pearson of mostly zero rows, without densifying them'
+    random = np.random.RandomState(seed=0)
+    data = random.poisson(.5, size=(20, 9)).astype(float)
+    data[0, 0] = 7.0  # only 1 nonzero
+    data = pd.DataFrame(data, index=[f'gene{i}' for i in range(20)])
+    sparse_data = data.astype(pd.SparseDtype(float, 0))
+    assert is_sparse(sparse_data) and not is_sparse(data)
+    baits = data.iloc[[0, 3]]
+    actual = sparse_pearson_df(sparse_data, baits)
+    expected = pd.DataFrame(
+        [[naive_pearson(data.loc[gene].values, baits.loc[bait].values) for bait in baits.index]
+         for gene in data.index],
+        index=data.index,
+        columns=baits.index,
+    )
+    pd.testing.assert_frame_equal(actual, expected, check_exact=False)
+
+def test_centred_norms_constant_rows():
+    'Constant rows have an exact 0 norm, implicit zeros included'
+    data = pd.DataFrame([[3.0, 3, 3], [0, 0, 0], [0, 1e8, 0]])
+    norms = centred_norms(sparse_rows(data.astype(pd.SparseDtype(float, 0))))
+    expected = np.linalg.norm(data.values - data.values.mean(axis=1, keepdims=True), axis=1)
+    assert norms[0] == norms[1] == 0
+    np.testing.assert_allclose(norms, expected)
+
+class TestPairwisePearson:
+
+    @pytest.fixture
+    def data(self, data):
+        'Data with missing values, a row with 1 value and a large offset'
+        data = data.copy()
+        data.iloc[0, [1, 5]] = np.nan
+        data.iloc[1, 0] = np.nan
+        data.iloc[2, 1:] = np.nan
+        data.iloc[3] += 1e4
+        data.iloc[4, 2:5] = np.nan
+        return data
+
+    def test_matches_pandas(self, data):
+        'Same as pandas, which correlates each pair on its common values'
+        baits = data.iloc[[0, 3, 4]]
+        actual = pairwise_pearson_df(data, baits)
+        expected = data.T.corr().loc[data.index, baits.index]
+        pd.testing.assert_frame_equal(actual, expected, check_exact=False, atol=1e-10)
+        assert actual.loc['gene2'].isnull().all()
+
+    def test_no_missing_values(self, data):
+        'Same as pearson'
+        data = data.dropna()
+        actual = pairwise_pearson_df(data, data)
+        expected = pd.DataFrame(
+            [[naive_pearson(data.loc[gene1].values, data.loc[gene2].values) for gene2 in data.index]
+             for gene1 in data.index],
+            index=data.index,
+            columns=data.index,
+        )
+        pd.testing.assert_frame_equal(actual, expected)
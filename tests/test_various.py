@@ -24,7 +24,10 @@ import numpy as np
 import pandas as pd
 import pytest
 
-from coexpnetviz._various import distinct_colours, _validate_gene_families
+from coexpnetviz._various import (
+    distinct_colours, _validate_gene_families, CorrelationSample, CutoffConfidence,
+    Preview,
+)
 
 
 @pytest.mark.xfail(reason='Will probably remove this feature')
@@ -143,3 +146,50 @@ class TestValidateGeneFamilies:
                 families, columns=['family', 'gene']
             ))
         assert error in ex.value.args[0]
+
+class TestCorrelationSample:
+
+    def test_histogram(self):
+        'Counts match numpy.histogram, including the closed last bin'
+        random = np.random.RandomState(seed=0)
+        values = np.sort(random.uniform(-1, 1, 1000))
+        sample = CorrelationSample(size=46, values=values)
+        counts, edges = sample.histogram(bins=7)
+        expected_counts, expected_edges = np.histogram(values, bins=7)
+        assert np.allclose(edges, expected_edges)
+        assert (counts == expected_counts).all()
+        assert counts.sum() == len(values)
+
+    def test_histogram_single_value(self):
+        'When all values are equal, put them all in a bin around the value'
+        sample = CorrelationSample(size=2, values=np.array([.5]))
+        counts, edges = sample.histogram(bins=3)
+        assert counts.sum() == 1
+        assert edges[0] < .5 < edges[-1]
+
+class TestPreview:
+
+    def test_to_dict(self):
+        preview = Preview(max_columns=10, column_selection='random')
+        assert preview.to_dict() == {
+            'max_columns': 10, 'column_selection': 'random', 'max_genes': None,
+        }
+
+    @pytest.mark.parametrize('kwargs', (
+        {'column_selection': 'first'},
+        {'max_columns': 0},
+        {'max_genes': -1},
+    ))
+    def test_invalid(self, kwargs):
+        with pytest.raises(ValueError):
+            Preview(**kwargs)
+
+@pytest.mark.parametrize('kwargs', (
+    {'level': 0},
+    {'level': 1},
+    {'tolerance': 0},
+    {'resamples': 0},
+))
+def test_cutoff_confidence_invalid(kwargs):
+    with pytest.raises(ValueError):
+        CutoffConfidence(**kwargs)